@@ -0,0 +1,65 @@
+#!/usr/bin/python3
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+from components import MergeFolders
+
+# Capture our command line parameters
+parser = argparse.ArgumentParser(description='Benchmark for MergeFolders.merge_folders on a synthetic install prefix.')
+parser.add_argument('--directories', type=int, default=500, help='Number of directories in the synthetic prefix')
+parser.add_argument('--files-per-directory', type=int, default=40, help='Number of files in each directory')
+parser.add_argument('--file-size', type=int, default=4096, help='Size of each file in bytes')
+parser.add_argument('--jobs', type=int, nargs='+', default=[1, 4], help='Worker counts to benchmark')
+parser.add_argument('--workdir', type=str, default=None, help='Where to create the synthetic prefix (defaults to a temporary directory)')
+arguments = parser.parse_args()
+
+# Create a prefix resembling an installed set of packages: nested folders, regular files and a few symlinks
+def createPrefix(path):
+    payload = os.urandom(arguments.file_size)
+    for directoryIndex in range(arguments.directories):
+        directory = os.path.join(path, 'lib{}'.format(directoryIndex % 10), 'module{}'.format(directoryIndex))
+        os.makedirs(directory)
+        for fileIndex in range(arguments.files_per_directory):
+            with open(os.path.join(directory, 'file{}.so'.format(fileIndex)), 'wb') as f:
+                f.write(payload)
+        os.symlink('file0.so', os.path.join(directory, 'link.so'))
+
+def timed(label, function):
+    start = time.perf_counter()
+    function()
+    duration = time.perf_counter() - start
+    print('{:<48} {:8.3f}s'.format(label, duration))
+    return duration
+
+workdir = tempfile.mkdtemp(dir=arguments.workdir)
+try:
+    sourcePath = os.path.join(workdir, 'source')
+    createPrefix(sourcePath)
+
+    fileCount = arguments.directories * (arguments.files_per_directory + 1)
+    print('## Synthetic prefix: {} directories, {} files, {:.1f} MB'.format(
+        arguments.directories, fileCount, arguments.directories * arguments.files_per_directory * arguments.file_size / (1024 * 1024)))
+
+    # Reference point: plain shutil.copytree
+    timed('shutil.copytree (reference)', lambda: shutil.copytree(sourcePath, os.path.join(workdir, 'reference'), symlinks=True))
+    shutil.rmtree(os.path.join(workdir, 'reference'))
+
+    for jobs in arguments.jobs:
+        destinationPath = os.path.join(workdir, 'destination-{}'.format(jobs))
+        # Into an empty prefix...
+        timed('merge_folders copy, empty prefix, {} jobs'.format(jobs), lambda: MergeFolders.merge_folders(sourcePath, destinationPath, jobs=jobs))
+        # ... and over a prefix which already contains everything
+        timed('merge_folders copy, full prefix, {} jobs'.format(jobs), lambda: MergeFolders.merge_folders(sourcePath, destinationPath, jobs=jobs))
+        shutil.rmtree(destinationPath)
+
+    # Moving files around is what happens when merging a freshly extracted tree
+    movedSourcePath = os.path.join(workdir, 'moved-source')
+    shutil.copytree(sourcePath, movedSourcePath, symlinks=True)
+    timed('merge_folders move, empty prefix', lambda: MergeFolders.merge_folders(movedSourcePath, os.path.join(workdir, 'moved'), move_files=True))
+finally:
+    shutil.rmtree(workdir)
+
+sys.exit(0)
@@ -0,0 +1,90 @@
+#!/usr/bin/python3
+import os
+import sys
+import time
+import yaml
+import shutil
+import fnmatch
+import argparse
+import tempfile
+from components import Dependencies, PlatformFlavor
+
+# Capture our command line parameters
+parser = argparse.ArgumentParser(description='Benchmark for Dependencies.Resolver on a synthetic repo-metadata tree.')
+parser.add_argument('--projects', type=int, default=3000, help='Number of projects in the synthetic repo-metadata tree')
+parser.add_argument('--rounds', type=int, default=200, help='Number of times the set of rules is resolved')
+parser.add_argument('--workdir', type=str, default=None, help='Where to create the synthetic tree (defaults to a temporary directory)')
+arguments = parser.parse_args()
+
+# Groups resembling the layout of invent.kde.org, with most projects living outside of frameworks
+groups = ['frameworks', 'plasma', 'graphics', 'multimedia', 'network', 'office', 'pim', 'sdk', 'system', 'utilities', 'education', 'games']
+
+# Create a repo-metadata tree, with a branch-rules.yml using the same kind of rules as the real one
+def createRepoMetadata(path):
+    repositoryPaths = []
+    for projectIndex in range(arguments.projects):
+        repositoryPath = '{}/project{}'.format(groups[projectIndex % len(groups)], projectIndex)
+        projectPath = os.path.join(path, 'projects-invent', repositoryPath)
+        os.makedirs(projectPath)
+        with open(os.path.join(projectPath, 'metadata.yaml'), 'w') as metadataFile:
+            yaml.safe_dump({'repopath': repositoryPath, 'identifier': 'project{}'.format(projectIndex), 'name': 'Project {}'.format(projectIndex)}, metadataFile)
+        repositoryPaths.append(repositoryPath)
+
+    branchRules = {
+        '@stable': dict([('frameworks/*', 'master'), ('plasma/*', 'Plasma/6.0')] + [(repositoryPath, 'release/24.02') for repositoryPath in repositoryPaths[::7]] + [('*', 'release/24.02')]),
+        '@latest': dict([('{}/*'.format(group), 'master') for group in groups] + [('*', 'master')]),
+    }
+    with open(os.path.join(path, 'branch-rules.yml'), 'w') as branchRulesFile:
+        yaml.safe_dump(branchRules, branchRulesFile)
+
+    return repositoryPaths
+
+# Resolve requirements the way the resolver used to: test every project and every branch rule with fnmatch
+def referenceResolve(resolver, rules):
+    foundDependencies = {}
+    for dependencyRuleset in rules:
+        for requirement, requirementBranch in dependencyRuleset['require'].items():
+            for repositoryPath, project in resolver.projects.items():
+                if not fnmatch.fnmatch(repositoryPath, requirement):
+                    continue
+                branch = requirementBranch
+                if requirementBranch in resolver.branchRules:
+                    branch = resolver.branchRules[requirementBranch].get(repositoryPath, None)
+                    if branch is None:
+                        branch = next((ruleBranch for repositoryRule, ruleBranch in resolver.branchRules[requirementBranch].items() if fnmatch.fnmatch(repositoryPath, repositoryRule)), requirementBranch)
+                foundDependencies[project['identifier']] = branch
+    return foundDependencies
+
+def timed(label, function):
+    start = time.perf_counter()
+    for round in range(arguments.rounds):
+        result = function()
+    duration = time.perf_counter() - start
+    print('{:<48} {:8.3f}s'.format(label, duration))
+    return result
+
+workdir = tempfile.mkdtemp(dir=arguments.workdir)
+try:
+    repositoryPaths = createRepoMetadata(workdir)
+    platform = PlatformFlavor.PlatformFlavor('Linux/Qt6/Shared')
+
+    start = time.perf_counter()
+    resolver = Dependencies.Resolver(os.path.join(workdir, 'projects-invent'), os.path.join(workdir, 'branch-rules.yml'), platform)
+    print('## Synthetic repo-metadata: {} projects, loaded in {:.3f}s'.format(len(resolver.projects), time.perf_counter() - start))
+
+    # A typical .kde-ci.yml: a handful of literal requirements plus a glob or two
+    rules = [{
+        'on': ['@all'],
+        'require': dict([(repositoryPath, '@stable') for repositoryPath in repositoryPaths[:40:3]] + [('frameworks/*', '@latest'), ('plasma/project1?', '@stable')]),
+    }]
+
+    referenceResult = timed('fnmatch over all projects (reference)', lambda: referenceResolve(resolver, rules))
+    indexedResult = timed('Resolver.resolve', lambda: resolver.resolve(rules, 'master'))
+
+    if referenceResult != indexedResult:
+        print('## ERROR: results differ from the reference implementation')
+        sys.exit(1)
+finally:
+    shutil.rmtree(workdir)
+
+sys.exit(0)
@@ -0,0 +1,66 @@
+import os
+import json
+import tempfile
+import threading
+
+# Bump this whenever the layout of the history file changes, so old history files are no longer used
+HISTORY_FORMAT = 1
+
+# How much weight the latest build gets when updating the expected duration of a project
+# Lower values smooth out the odd slow (or fast) build, higher values follow changes in build times quicker
+SMOOTHING = 0.3
+
+# Record of how long building each project took, per platform
+# Rather than keeping every build around, we keep an exponentially weighted moving average of the durations
+class History(object):
+
+    # Load the history for the given platform from the given file, if there is one
+    def __init__(self, historyPath, platform):
+        self.historyPath = historyPath
+        self.platform = str(platform)
+        self.lock = threading.Lock()
+        self.durations = self._load().get( self.platform, {} )
+
+    def _load(self):
+        try:
+            with open( self.historyPath, 'r' ) as historyFile:
+                history = json.load( historyFile )
+        except (OSError, ValueError):
+            return {}
+
+        if history.get('format') != HISTORY_FORMAT:
+            return {}
+        return history['platforms']
+
+    # Retrieve the expected duration (in seconds) of building a project, None if it was never built before
+    def expectedDuration(self, identifier):
+        details = self.durations.get( identifier, None )
+        if details is None:
+            return None
+        return details['duration']
+
+    # Record how long building a project took
+    # As the file may be shared with other runs (and other platforms) we merge our update with what is on disk at that moment
+    def record(self, identifier, duration):
+        with self.lock:
+            details = self.durations.get( identifier, None )
+            if details is None:
+                details = {'duration': duration, 'builds': 0}
+            else:
+                details['duration'] = SMOOTHING * duration + (1 - SMOOTHING) * details['duration']
+            details['builds'] += 1
+            self.durations[ identifier ] = details
+
+            platforms = self._load()
+            platforms.setdefault( self.platform, {} )[ identifier ] = details
+
+            try:
+                historyDirectory = os.path.dirname( os.path.abspath(self.historyPath) )
+                os.makedirs( historyDirectory, exist_ok=True )
+                historyFile = tempfile.NamedTemporaryFile( mode='w', delete=False, dir=historyDirectory, prefix='.build-history-' )
+                json.dump( {'format': HISTORY_FORMAT, 'platforms': platforms}, historyFile, indent = 1 )
+                historyFile.close()
+                os.replace( historyFile.name, self.historyPath )
+            except OSError as e:
+                # Without the history builds are simply scheduled less cleverly next time
+                print('## WARNING: unable to store the build history at {}: {}'.format(self.historyPath, e))
@@ -1,7 +1,8 @@
 import os
 import sys
 import yaml
-from components import CommonUtils, Dependencies, Package
+import hashlib
+from components import CommonUtils, Dependencies, RepoMetadataSnapshot, DependencyGraph, ReverseDependencyIndex
 
 
 ####
@@ -39,14 +40,36 @@ def loadProjectConfiguration(projectRoot, projectName):
 # Prepare to resolve and fetch our project dependencies
 ####
 def prepareDependenciesResolver(platform):
+    # If we have been given a repo-metadata snapshot (path or URL), there is no need for a repo-metadata checkout
+    if 'KDECI_REPO_METADATA_SNAPSHOT' in os.environ:
+        snapshot = RepoMetadataSnapshot.retrieve( os.environ['KDECI_REPO_METADATA_SNAPSHOT'], os.environ.get('KDECI_CACHE_PATH', None) )
+        print('## Using repo-metadata snapshot (revision: {}, content hash: {})'.format(snapshot['revision'], snapshot['contentHash']))
+        return Dependencies.Resolver.fromSnapshot( snapshot, platform )
+
     metadataFolderPath = os.environ.get('KDECI_REPO_METADATA_PATH', os.path.join(CommonUtils.scriptsBaseDirectory(), 'repo-metadata'))
 
     # Determine where some key resources we need for resolving dependencies will be found...
     projectsMetadataPath = os.path.join( metadataFolderPath, 'projects-invent' )
     branchRulesPath = os.path.join( metadataFolderPath, 'branch-rules.yml' )
 
+    # Determine where the compiled index of the projects metadata should be kept, if anywhere
+    indexPath = os.environ.get('KDECI_REPO_METADATA_INDEX_PATH', None)
+    if indexPath is None and 'KDECI_CACHE_PATH' in os.environ:
+        indexPath = os.path.join( os.environ['KDECI_CACHE_PATH'], 'repo-metadata-index.pickle' )
+
     # Bring our dependency resolver online...
-    return Dependencies.Resolver( projectsMetadataPath, branchRulesPath, platform )
+    return Dependencies.Resolver( projectsMetadataPath, branchRulesPath, platform, indexPath )
+
+####
+# Retrieve the dependency graph shared by everything resolving dependencies
+# for projects checked out in the given working directory
+####
+dependencyGraphs = {}
+def dependencyGraphFor(workingDirectory, dependencyResolver):
+    key = (os.path.abspath(workingDirectory), id(dependencyResolver))
+    if key not in dependencyGraphs or dependencyGraphs[key].dependencyResolver is not dependencyResolver:
+        dependencyGraphs[key] = DependencyGraph.Graph(dependencyResolver, workingDirectory)
+    return dependencyGraphs[key]
 
 ####
 # Lazily retrieve project dependency information either from a local build or
@@ -54,27 +77,8 @@ def prepareDependenciesResolver(platform):
 ####
 packageRegistry = None
 def lazyResolveProjectDeps(workingDirectory, projectId, projectBranch, dependencyResolver):
-    exisitingDeps = set()
-    projectDirectory = os.path.join(workingDirectory, projectId)
-
-    if not os.path.exists(projectDirectory):
-        localCachePath = os.environ['KDECI_CACHE_PATH']
-        gitlabInstance = os.environ['KDECI_GITLAB_SERVER']
-        packageProject = os.environ['KDECI_PACKAGE_PROJECT']
-
-        packageRegistry = Package.Registry( localCachePath, gitlabInstance, None, packageProject )
-        allDependencies = packageRegistry.retrieveDependencies( {projectId: projectBranch}, onlyMetadata=True )
-
-        exisitingDeps.update([item[1]['identifier'] for item in allDependencies])
-    else:
-        configuration = loadProjectConfiguration(projectDirectory, projectId)
-        projectBuildDependencies = dependencyResolver.resolve( configuration['Dependencies'], projectBranch )
-
-        for childDep, childBranch in projectBuildDependencies.items():
-            exisitingDeps.add(childDep)
-            exisitingDeps.update(lazyResolveProjectDeps(workingDirectory, childDep, childBranch, dependencyResolver))
-
-    return exisitingDeps
+    dependencyGraph = dependencyGraphFor(workingDirectory, dependencyResolver)
+    return set(dependencyGraph.closure(projectId, projectBranch).keys())
 
 ####
 # Generate reverse dependencies mapping, e.g.
@@ -82,43 +86,18 @@ def lazyResolveProjectDeps(workingDirectory, projectId, projectBranch, dependenc
 #    ext_qt -> ext_kimageformats
 ####
 def genReverseDeps(workingDirectory, dependencyResolver, branch, debug = False, onlyPlatformDeps = None):
-    reverseDeps = {}
-    for subdir, dirs, files in os.walk(workingDirectory):
-        relative = os.path.relpath(subdir, workingDirectory)
-        depth = os.path.normpath(relative).count(os.sep) + 1
-
-        if depth >= 2:
-            dirs.clear()
+    reverseDependencyIndex = reverseDependencyIndexFor(workingDirectory, dependencyResolver, branch)
+    reverseDependencyIndex.update(debug)
+    return reverseDependencyIndex.reverseDependencies(onlyPlatformDeps)
 
-        subDirName = os.path.basename(subdir)
-
-        if subDirName == os.path.basename(workingDirectory):
-            continue
-
-        if not subDirName.startswith('ext_'):
-            dirs.clear()
-            continue
-
-        checkAllowed = lambda name: (name in onlyPlatformDeps) if not onlyPlatformDeps is None else True
-
-        projectName = subDirName
-
-        if not checkAllowed(projectName): continue
-
-        if os.path.exists(os.path.join(subdir, 'CMakeLists.txt')):
-            configuration = loadProjectConfiguration(subdir, projectName)
-            projectBuildDependencies = list(dependencyResolver.resolve( configuration['Dependencies'], branch ).keys())
-            projectBuildDependencies = list(filter(checkAllowed, projectBuildDependencies))
-
-            if debug:
-                print ("##  project: {} depends: {}".format(projectName, projectBuildDependencies))
-
-            # found the project, don't check subdirs anymore
-            dirs.clear()
+####
+# Retrieve the (persistent) reverse dependency index of the projects in a working directory
+# The index is kept at KDECI_REVERSE_DEPS_INDEX_PATH, or in KDECI_CACHE_PATH if that isn't set
+####
+def reverseDependencyIndexFor(workingDirectory, dependencyResolver, branch):
+    indexPath = os.environ.get('KDECI_REVERSE_DEPS_INDEX_PATH', None)
+    if indexPath is None and 'KDECI_CACHE_PATH' in os.environ:
+        workingDirectoryHash = hashlib.sha256(os.path.abspath(workingDirectory).encode('utf-8')).hexdigest()[:16]
+        indexPath = os.path.join(os.environ['KDECI_CACHE_PATH'], 'reverse-deps-index-{}.json'.format(workingDirectoryHash))
 
-            for dep in projectBuildDependencies:
-                if dep in reverseDeps:
-                    reverseDeps[dep].add(projectName)
-                else:
-                    reverseDeps[dep] = set([projectName])
-    return reverseDeps
+    return ReverseDependencyIndex.ReverseDependencyIndex(workingDirectory, dependencyGraphFor(workingDirectory, dependencyResolver), branch, indexPath)
@@ -1,47 +1,73 @@
 import os
-import sys
-import copy
+import re
+import json
 import yaml
+import bisect
+import pickle
+import hashlib
 import fnmatch
+import tempfile
 import subprocess
 
+# Use the much faster LibYAML based loader if it is available
+YamlLoader = getattr( yaml, 'CSafeLoader', yaml.SafeLoader )
+
+# Bump this whenever the contents of the compiled metadata index change, so old indexes are no longer used
+INDEX_FORMAT = 1
+
 # Class to handle resolving dependencies for projects
 class Resolver(object):
 
     # Set ourselves up
     # This should receive the path to the projects metadata
     # as well as the path to a YAML file containing the magic branches resolution information
-    def __init__( self, projectsMetadata, branchRules, platform ):
+    # If an index path is given, the projects metadata is compiled into an index stored there, which is reused as long as the metadata doesn't change
+    def __init__( self, projectsMetadata, branchRules, platform, indexPath = None ):
         # Start by initialising a data store for all of the projects
-        self.projects = {}
+        self.projects = None
         self.projectsByIdentifier = {}
         # Store our platform for future use
         self.platform = platform
 
-        # Start reading in the metadata tree
-        for currentPath, subdirectories, filesInFolder in os.walk( projectsMetadata, topdown=False, followlinks=False ):
-            # Do we have a metadata.yaml file?
-            if 'metadata.yaml' not in filesInFolder:
-                # We're not interested then....
-                continue
+        # Try to use the compiled index first, and read in the metadata tree if that isn't possible
+        if indexPath is not None:
+            indexKey = metadataFingerprint( projectsMetadata, branchRules )
+            self.projects = loadIndex( indexPath, indexKey )
 
-            # Now that we know we have something to work with....
-            # Lets load the current metadata up
-            metadataPath = os.path.join( currentPath, 'metadata.yaml' )
-            metadataFile = open( metadataPath, 'r', encoding="utf8")
-            metadata = yaml.safe_load( metadataFile )
-            
-            # Extract the repository path, then save the details on the project we have found
-            repositoryPath = metadata['repopath']
-            self.projects[ repositoryPath ] = metadata
+        if self.projects is None:
+            self.projects = readProjectsMetadata( projectsMetadata )
+            if indexPath is not None:
+                saveIndex( indexPath, indexKey, self.projects )
 
-            # We also store an equivalent using the project identifier (used by seed-package-registry.py)
-            identifier = metadata['identifier']
-            self.projectsByIdentifier[ identifier ] = metadata
+        # We also store an equivalent using the project identifier (used by seed-package-registry.py)
+        for repositoryPath, metadata in self.projects.items():
+            self.projectsByIdentifier[ metadata['identifier'] ] = metadata
 
         # Now read in the magic branches resolution information
         branchRulesFile = open( branchRules, 'r' )
-        self.branchRules = yaml.safe_load( branchRulesFile )
+        self.branchRules = yaml.load( branchRulesFile, Loader=YamlLoader )
+
+        # Finally prepare everything we need to quickly match requirements and branch rules
+        self._buildIndexes()
+
+    # Set up a resolver from a repo-metadata snapshot (see RepoMetadataSnapshot) instead of a repo-metadata checkout
+    @classmethod
+    def fromSnapshot( cls, snapshot, platform ):
+        resolver = cls.__new__( cls )
+        resolver.platform = platform
+        resolver.projects = snapshot['projects']
+        resolver.projectsByIdentifier = { metadata['identifier']: metadata for metadata in resolver.projects.values() }
+        resolver.branchRules = snapshot['branchRules']
+        resolver._buildIndexes()
+        return resolver
+
+    # Build the indexes used to match requirements against repository paths, and the branch rules against projects
+    def _buildIndexes( self ):
+        self.projectsIndex = PathIndex( self.projects.keys() )
+        self.compiledBranchRules = {}
+        for branchRule, repositoryRules in self.branchRules.items():
+            if isinstance( repositoryRules, dict ):
+                self.compiledBranchRules[ branchRule ] = [ (compilePattern(repositoryRule), branch) for repositoryRule, branch in repositoryRules.items() ]
 
     # Determine the correct branch to use for this project
     def _resolveDependencyBranch( self, dependency, branchRule, projectBranch ):
@@ -69,9 +95,10 @@ class Resolver(object):
 
         # Final check to do is to go over each of the rules and see if they match as a glob pattern
         # This allows for rules like frameworks/* to be specified
-        for repositoryRule, branch in self.branchRules[ branchRule ].items():
+        normalisedPath = os.path.normcase( dependency['repopath'] )
+        for repositoryPattern, branch in self.compiledBranchRules.get( branchRule, [] ):
             # Check if it matches...
-            if fnmatch.fnmatch(dependency['repopath'], repositoryRule):
+            if repositoryPattern.match( normalisedPath ):
                 return branch
 
         # Finally if we found no match, just return the branch rule back as it is the best we can do...
@@ -92,36 +119,37 @@ class Resolver(object):
             # If we are then we assume the target is reasonable and try to use that
             return os.environ['CI_MERGE_REQUEST_TARGET_BRANCH_NAME']
 
-        # Before we can begin, on Windows we don't natively have grep/sort available to us (or many other unix utilities for that matter)
-        # Git for Windows includes them, but they are not always on PATH, so we need to locate git.exe and add its /usr/bin directory manually.
-        commandEnvironment = copy.deepcopy(dict(os.environ))
-        if sys.platform == 'win32':
-            git_usrbin_directory = os.path.normpath(os.path.join(os.path.dirname(subprocess.check_output("where git", text=True)), '..\\usr\\bin'))
-            commandEnvironment['PATH'] = git_usrbin_directory + ';' + commandEnvironment['PATH']
-
-        # To do this we need to first get a list of commits that are in the branch we are building (HEAD) which aren't in any mainline branch
-        # This is done by asking Git to print a list of all refs it knows of, prefixed by the negate operator (^)
-        # We then reduce that to just mainline branches prior to passing it to git rev-list
-        # Finally, we run git rev-list in reverse mode so it puts the oldest commit at the top (whose parent commit will be on a release branch)
-        command = 'git for-each-ref --format="^%(refname)" | grep -E "refs/heads/master|refs/heads/kf[56]|refs/heads/.*[0-9]\.[0-9]+" | git rev-list --stdin --reverse HEAD | head -n1'
-        process = subprocess.Popen(command, shell=True, env=commandEnvironment, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
-        firstBranchCommit = process.stdout.readline().strip().decode('utf-8')
-
-        # Make sure we ended up with a valid 'first branch commit'
-        # If we are on a newly formed branch or tag that is identical in commit structure to an existing protected branch then the above will return nothing
-        if firstBranchCommit == "":
-            # Fallback to HEAD
-            firstBranchCommit = "HEAD"
-
-        # With the first branch commit now being known, we can do the second phase of this
-        # This involves asking Git to print a list of all references that contain the given commit
-        # Once again, we also filter this to only leave behind release branches - as that is what we are trying to resolve to
-        command = 'git for-each-ref --contains {0}^ --format="%(refname)" | grep -E "refs/heads/master|refs/heads/kf[56]|refs/heads/.*[0-9]\.[0-9]+" | sort -r -n'.format( firstBranchCommit )
-        process = subprocess.Popen(command, shell=True, env=commandEnvironment, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
-        rawPotentialBranches = process.stdout.readlines()
-
-        # The output we receive from git for-each-ref will need some cleanup before we can start examining it
-        cleanedBranches = [entry.strip().decode('utf-8').replace('refs/heads/', '') for entry in rawPotentialBranches]
+        # The answer only depends on the commit we are building and the mainline branches Git knows about, so ask Git for both first
+        # If neither changed since the last time we were asked, we can reuse the previous answer
+        headCommit, mainlineRefs = listMainlineRefs()
+        cacheKey = hashlib.sha256( '\n'.join([headCommit] + mainlineRefs).encode('utf-8') ).hexdigest()
+        cleanedBranches = loadSameBranchCache().get( cacheKey, None )
+
+        if cleanedBranches is None:
+            # Working out the answer takes two more Git calls, which can't be merged into one as the second needs the output of the first
+            # To do this we need to first get a list of commits that are in the branch we are building (HEAD) which aren't in any mainline branch
+            # This is done by handing Git all mainline branches prefixed by the negate operator (^)
+            # We run git rev-list in reverse mode so it puts the oldest commit at the top (whose parent commit will be on a release branch)
+            mainlineNegations = ''.join( '^{}\n'.format(ref.split(' ', 1)[1]) for ref in mainlineRefs )
+            branchCommits = runGit( ['rev-list', '--stdin', '--reverse', 'HEAD'], mainlineNegations ).splitlines()
+            firstBranchCommit = branchCommits[0].strip() if branchCommits else ""
+
+            # Make sure we ended up with a valid 'first branch commit'
+            # If we are on a newly formed branch or tag that is identical in commit structure to an existing protected branch then the above will return nothing
+            if firstBranchCommit == "":
+                # Fallback to HEAD
+                firstBranchCommit = "HEAD"
+
+            # With the first branch commit now being known, we can do the second phase of this
+            # This involves asking Git to print a list of all references that contain the given commit
+            # Once again, we also filter this to only leave behind release branches - as that is what we are trying to resolve to
+            rawPotentialBranches = runGit( ['for-each-ref', '--contains', firstBranchCommit + '^', '--format=%(refname)'] ).splitlines()
+            potentialBranches = [ entry.strip() for entry in rawPotentialBranches if MainlineBranchPattern.search(entry) ]
+
+            # The output we receive from git for-each-ref will need some cleanup before we can start examining it
+            # Reverse sorting puts the largest version number at the top
+            cleanedBranches = sorted( [entry.replace('refs/heads/', '') for entry in potentialBranches], reverse=True )
+            saveSameBranchCache( cacheKey, cleanedBranches )
 
         # Did we get anything back?
         # If not (which can only happen in very rare edge cases) fallback to 'master'
@@ -152,7 +180,7 @@ class Resolver(object):
             # Now that we have that sorted, start going over the actual project specifications...
             for requirement, requirementBranch in dependencyRuleset['require'].items():
                 # Find the projects that match the specification we have been given
-                matchingProjects = [ project for repositoryPath, project in self.projects.items() if fnmatch.fnmatch(repositoryPath, requirement) ]
+                matchingProjects = [ self.projects[ repositoryPath ] for repositoryPath in self.projectsIndex.match( requirement ) ]
 
                 if not matchingProjects:
                     raise Exception("Unable to resolve metadata for the requested dependency: {} (branch: {})".format(requirement, requirementBranch))
@@ -176,3 +204,227 @@ class Resolver(object):
 
         # With the rulesets all processed, we now have the immediate dependencies of this project - our job is therefore done here
         return foundDependencies
+
+# Branches we consider to be mainline branches when resolving @same: master, kf5/kf6 and release branches (anything with a version number in it)
+MainlineBranchPattern = re.compile( r'refs/heads/master|refs/heads/kf[56]|refs/heads/.*[0-9]\.[0-9]+' )
+
+# Name of the file (inside the .git folder of the project) where @same resolutions are kept between runs
+SAME_BRANCH_CACHE_NAME = 'kdeci-same-branch-cache.json'
+SAME_BRANCH_CACHE_SIZE = 64
+
+# @same resolutions we already know about during this run, keyed by Git folder
+sameBranchCaches = {}
+
+# Run git in the current directory, returning its output (or nothing if it failed)
+def runGit( arguments, input = None ):
+    try:
+        process = subprocess.run( ['git'] + arguments, input=input, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True )
+    except OSError:
+        return ''
+    return process.stdout
+
+# Determine the commit HEAD points at, and the list of mainline branches (as "sha1 refname" lines) in a single Git call
+def listMainlineRefs():
+    headCommit = ''
+    mainlineRefs = []
+    for line in runGit( ['show-ref', '--head'] ).splitlines():
+        commit, refName = line.strip().split(' ', 1)
+        if refName == 'HEAD':
+            headCommit = commit
+        elif MainlineBranchPattern.search( refName ):
+            mainlineRefs.append( line.strip() )
+    return headCommit, sorted(mainlineRefs)
+
+# Retrieve the @same resolutions known for the Git checkout in the current directory
+def loadSameBranchCache():
+    gitDirectory = findGitDirectory( os.getcwd() )
+    if gitDirectory not in sameBranchCaches:
+        sameBranchCaches[ gitDirectory ] = {}
+        if gitDirectory is not None:
+            try:
+                with open( os.path.join(gitDirectory, SAME_BRANCH_CACHE_NAME), 'r' ) as cacheFile:
+                    sameBranchCaches[ gitDirectory ] = json.load( cacheFile )
+            except (OSError, ValueError):
+                pass
+    return sameBranchCaches[ gitDirectory ]
+
+# Remember an @same resolution for the Git checkout in the current directory, both for this run and for future ones
+def saveSameBranchCache( cacheKey, branches ):
+    gitDirectory = findGitDirectory( os.getcwd() )
+    cache = loadSameBranchCache()
+    cache[ cacheKey ] = branches
+
+    # Only the most recent answers are worth keeping around
+    while len(cache) > SAME_BRANCH_CACHE_SIZE:
+        del cache[ next(iter(cache)) ]
+    if gitDirectory is None:
+        return
+
+    try:
+        cacheFile = tempfile.NamedTemporaryFile( mode='w', delete=False, dir=gitDirectory, prefix='.kdeci-' )
+        json.dump( cache, cacheFile )
+        cacheFile.close()
+        os.replace( cacheFile.name, os.path.join(gitDirectory, SAME_BRANCH_CACHE_NAME) )
+    except OSError:
+        pass
+
+# Compile a glob pattern, matching the same way fnmatch.fnmatch() does
+def compilePattern( pattern ):
+    return re.compile( fnmatch.translate(os.path.normcase(pattern)) )
+
+# Index of repository paths, to find the paths matching a glob pattern without testing every single one of them
+# Literal paths are looked up directly, while patterns are only tested against the paths starting with the part of the pattern before the first wildcard
+# (so frameworks/* only looks at frameworks/...) - matches are returned in the order the paths were given in, like a plain fnmatch over all of them would
+class PathIndex(object):
+
+    def __init__( self, paths ):
+        self.literalPaths = {}
+        self.sortedPaths = []
+        for position, path in enumerate( paths ):
+            normalisedPath = os.path.normcase( path )
+            self.literalPaths.setdefault( normalisedPath, [] ).append( (position, path) )
+            self.sortedPaths.append( (normalisedPath, position, path) )
+        self.sortedPaths.sort()
+        self.compiledPatterns = {}
+
+    # Find all the paths matching the given glob pattern
+    def match( self, pattern ):
+        normalisedPattern = os.path.normcase( pattern )
+
+        # Plain paths are easy
+        wildcardPosition = min( [ normalisedPattern.find(character) for character in '*?[' if character in normalisedPattern ], default=None )
+        if wildcardPosition is None:
+            return [ path for position, path in self.literalPaths.get( normalisedPattern, [] ) ]
+
+        # Otherwise look at the range of paths sharing the literal prefix of the pattern
+        if pattern not in self.compiledPatterns:
+            self.compiledPatterns[ pattern ] = compilePattern( pattern )
+        compiledPattern = self.compiledPatterns[ pattern ]
+
+        prefix = normalisedPattern[:wildcardPosition]
+        matches = []
+        for normalisedPath, position, path in self.sortedPaths[ bisect.bisect_left(self.sortedPaths, (prefix,)): ]:
+            if not normalisedPath.startswith( prefix ):
+                break
+            if compiledPattern.match( normalisedPath ):
+                matches.append( (position, path) )
+
+        return [ path for position, path in sorted(matches) ]
+
+# Read in the metadata tree, returning the metadata of each project keyed by its repository path
+def readProjectsMetadata( projectsMetadata ):
+    projects = {}
+    for currentPath, subdirectories, filesInFolder in os.walk( projectsMetadata, topdown=False, followlinks=False ):
+        # Do we have a metadata.yaml file?
+        if 'metadata.yaml' not in filesInFolder:
+            # We're not interested then....
+            continue
+
+        # Now that we know we have something to work with....
+        # Lets load the current metadata up
+        metadataPath = os.path.join( currentPath, 'metadata.yaml' )
+        with open( metadataPath, 'r', encoding="utf8" ) as metadataFile:
+            metadata = yaml.load( metadataFile, Loader=YamlLoader )
+
+        # Extract the repository path, then save the details on the project we have found
+        projects[ metadata['repopath'] ] = metadata
+
+    return projects
+
+# Find the Git folder of the checkout the given path is part of, None if it isn't part of one
+def findGitDirectory( path ):
+    # Find the top of the checkout
+    path = os.path.abspath( path )
+    while not os.path.exists( os.path.join(path, '.git') ):
+        if os.path.dirname( path ) == path:
+            return None
+        path = os.path.dirname( path )
+
+    gitDirectory = os.path.join( path, '.git' )
+
+    # Worktrees and submodules have a .git file pointing to the real Git folder
+    if os.path.isfile( gitDirectory ):
+        try:
+            with open( gitDirectory, 'r' ) as gitFile:
+                gitDirectory = os.path.join( path, gitFile.read().strip().split('gitdir:', 1)[1].strip() )
+        except (OSError, IndexError):
+            return None
+
+    return os.path.normpath( gitDirectory )
+
+# Find the commit a Git checkout is at, by reading the files in the .git folder directly (which is far cheaper than running git)
+# Returns None if the path isn't part of a Git checkout or the commit can't be determined
+def gitCheckoutHead( path ):
+    gitDirectory = findGitDirectory( path )
+    if gitDirectory is None:
+        return None
+
+    try:
+        with open( os.path.join(gitDirectory, 'HEAD'), 'r' ) as headFile:
+            head = headFile.read().strip()
+
+        # A detached HEAD is the commit itself
+        if not head.startswith('ref:'):
+            return head
+
+        # Otherwise look for the branch, either as a loose ref or in the packed refs
+        refName = head.split(':', 1)[1].strip()
+        refPath = os.path.join( gitDirectory, refName )
+        if os.path.exists( refPath ):
+            with open( refPath, 'r' ) as refFile:
+                return refFile.read().strip()
+
+        with open( os.path.join(gitDirectory, 'packed-refs'), 'r' ) as packedRefsFile:
+            for line in packedRefsFile:
+                if line.strip().endswith( ' ' + refName ):
+                    return line.split(' ', 1)[0]
+    except (OSError, IndexError):
+        pass
+
+    return None
+
+# Calculate a fingerprint of the projects metadata and branch rules which changes whenever they do
+# For Git checkouts (the normal case) this is the commit they are at, otherwise the modification times of all the folders and files involved
+def metadataFingerprint( projectsMetadata, branchRules ):
+    fingerprint = hashlib.sha256()
+    fingerprint.update( 'format {} {} {}\n'.format(INDEX_FORMAT, os.path.abspath(projectsMetadata), os.path.abspath(branchRules)).encode('utf-8') )
+
+    head = gitCheckoutHead( projectsMetadata )
+    if head is not None and head == gitCheckoutHead( branchRules ):
+        fingerprint.update( 'git {}\n'.format(head).encode('utf-8') )
+        return fingerprint.hexdigest()
+
+    # Adding, removing or replacing a file changes the folder it is in, but files can also be written in place so those need to be checked too
+    for currentPath, subdirectories, filesInFolder in os.walk( projectsMetadata, followlinks=False ):
+        subdirectories.sort()
+        fingerprint.update( '{} {}\n'.format(currentPath, os.stat(currentPath).st_mtime_ns).encode('utf-8') )
+        if 'metadata.yaml' in filesInFolder:
+            metadataStat = os.stat( os.path.join(currentPath, 'metadata.yaml') )
+            fingerprint.update( '{} {}\n'.format(metadataStat.st_mtime_ns, metadataStat.st_size).encode('utf-8') )
+
+    return fingerprint.hexdigest()
+
+# Load the compiled metadata index, returns None if there is no index or it was made from different metadata
+def loadIndex( indexPath, indexKey ):
+    try:
+        with open( indexPath, 'rb' ) as indexFile:
+            index = pickle.load( indexFile )
+    except (OSError, EOFError, pickle.UnpicklingError, AttributeError, ValueError):
+        return None
+
+    if not isinstance(index, dict) or index.get('format') != INDEX_FORMAT or index.get('key') != indexKey:
+        return None
+
+    return index['projects']
+
+# Store the compiled metadata index, replacing any previous version atomically
+def saveIndex( indexPath, indexKey, projects ):
+    try:
+        os.makedirs( os.path.dirname(os.path.abspath(indexPath)), exist_ok=True )
+        indexFile = tempfile.NamedTemporaryFile( delete=False, dir=os.path.dirname(os.path.abspath(indexPath)), prefix='.incoming-' )
+        pickle.dump( {'format': INDEX_FORMAT, 'key': indexKey, 'projects': projects}, indexFile, protocol=pickle.HIGHEST_PROTOCOL )
+        indexFile.close()
+        os.replace( indexFile.name, indexPath )
+    except OSError as e:
+        # Not being able to store the index only makes the next run slower
+        print('## WARNING: unable to store the repo-metadata index at {}: {}'.format(indexPath, e))
@@ -0,0 +1,150 @@
+import os
+from components import CiConfigurationUtils, Package
+
+# Raised when projects (directly or indirectly) depend on each other
+class DependencyCycleError(Exception):
+    pass
+
+# Graph of the dependencies between projects, resolved lazily and only ever once
+# The dependencies of a project come from its .kde-ci.yml if we have a checkout of it, otherwise from the metadata of its package in the registry
+# Transitive closures are memoized per (project, branch), so shared subtrees (ECM, kcoreaddons, ...) are only walked once no matter how many projects use them
+class Graph(object):
+
+    # Setup the graph
+    # Projects found in workingDirectory (as <workingDirectory>/<identifier>) are resolved from their checkout
+    # If no package registry is given, one is brought up from the environment the first time it is needed
+    def __init__(self, dependencyResolver, workingDirectory = None, packageRegistry = None):
+        self.dependencyResolver = dependencyResolver
+        self.workingDirectory = workingDirectory
+        self.packageRegistry = packageRegistry
+
+        # Projects we have a checkout of outside of workingDirectory: identifier -> (path, configuration)
+        self.localProjects = {}
+
+        # Direct dependencies, keyed by (identifier, branch, kind) with kind being 'build' or 'runtime'
+        self.dependencies = {}
+        # Transitive dependencies, keyed by (identifier, branch, runtime)
+        self.closures = {}
+        # Reverse of the closures computed so far, built when first needed
+        self.ancestorsIndex = None
+
+    # Register a project we have a checkout of, optionally along with its already loaded configuration
+    def addLocalProject(self, identifier, path, configuration = None):
+        self.localProjects[ identifier ] = (path, configuration)
+
+    # Determine where the checkout of a project is, None if we don't have one
+    def _localProjectPath(self, identifier):
+        if identifier in self.localProjects:
+            return self.localProjects[ identifier ][0]
+        if self.workingDirectory is not None and os.path.exists( os.path.join(self.workingDirectory, identifier) ):
+            return os.path.join( self.workingDirectory, identifier )
+        return None
+
+    # Bring up the package registry if we haven't done so yet
+    def registry(self):
+        if self.packageRegistry is None:
+            localCachePath = os.environ['KDECI_CACHE_PATH']
+            gitlabInstance = os.environ['KDECI_GITLAB_SERVER']
+            packageProject = os.environ['KDECI_PACKAGE_PROJECT']
+            self.packageRegistry = Package.Registry( localCachePath, gitlabInstance, None, packageProject )
+        return self.packageRegistry
+
+    # Resolve the direct dependencies of a project, kind being either 'build' or 'runtime'
+    def _resolveDependencies(self, identifier, branch, kind):
+        projectPath = self._localProjectPath( identifier )
+
+        # Without a checkout the package metadata will have to do
+        if projectPath is None:
+            packageContents, packageMetadata, cacheStatus = self.registry().retrieve( identifier, branch, onlyMetadata=True )
+            if packageMetadata is None:
+                raise Exception("Unable to locate requested dependency in the registry: {} (branch: {})".format( identifier, branch ))
+            return packageMetadata.get( 'dependencies' if kind == 'build' else 'runtime-dependencies', {} )
+
+        configuration = self.localProjects.get( identifier, (None, None) )[1]
+        if configuration is None:
+            configuration = CiConfigurationUtils.loadProjectConfiguration( projectPath, identifier )
+
+        # The Dependency Resolver requires the current working directory to be in the project it is resolving (due to @same)
+        previousDirectory = os.getcwd()
+        os.chdir( projectPath )
+        try:
+            return self.dependencyResolver.resolve( configuration['Dependencies' if kind == 'build' else 'RuntimeDependencies'], branch )
+        finally:
+            os.chdir( previousDirectory )
+
+    # Retrieve the direct build dependencies of a project, as a dictionary of identifier -> branch
+    def buildDependencies(self, identifier, branch):
+        key = (identifier, branch, 'build')
+        if key not in self.dependencies:
+            self.dependencies[ key ] = self._resolveDependencies( identifier, branch, 'build' )
+        return self.dependencies[ key ]
+
+    # Retrieve the direct runtime dependencies of a project, as a dictionary of identifier -> branch
+    def runtimeDependencies(self, identifier, branch):
+        key = (identifier, branch, 'runtime')
+        if key not in self.dependencies:
+            self.dependencies[ key ] = self._resolveDependencies( identifier, branch, 'runtime' )
+        return self.dependencies[ key ]
+
+    # Retrieve everything a project needs, directly or indirectly, as a dictionary of identifier -> branch
+    # With runtime set, runtime dependencies (of the project and of all its dependencies) are followed as well
+    # Should a project be reached on different branches, the branch closest to the project wins
+    def closure(self, identifier, branch, runtime = False):
+        return self._closure( identifier, branch, runtime, [] )
+
+    def _closure(self, identifier, branch, runtime, visiting):
+        key = (identifier, branch, runtime)
+        if key in self.closures:
+            return self.closures[ key ]
+
+        if key in visiting:
+            cycle = [ project for project, projectBranch, projectRuntime in visiting[ visiting.index(key): ] ] + [ identifier ]
+            raise DependencyCycleError( "Dependency cycle detected: {}".format(' -> '.join(cycle)) )
+
+        visiting.append( key )
+
+        directDependencies = dict( self.buildDependencies(identifier, branch) )
+        if runtime:
+            for dependency, dependencyBranch in self.runtimeDependencies( identifier, branch ).items():
+                directDependencies.setdefault( dependency, dependencyBranch )
+
+        # Our direct dependencies come first, then whatever they need in turn
+        result = dict( directDependencies )
+        for dependency, dependencyBranch in directDependencies.items():
+            for childDependency, childBranch in self._closure( dependency, dependencyBranch, runtime, visiting ).items():
+                result.setdefault( childDependency, childBranch )
+
+        visiting.pop()
+        self.closures[ key ] = result
+        self.ancestorsIndex = None
+        return result
+
+    # Find the projects (among those whose closure has been computed so far) which need the given project, directly or indirectly
+    def ancestors(self, identifier, runtime = False):
+        if self.ancestorsIndex is None:
+            self.ancestorsIndex = {}
+            for (project, branch, closureRuntime), dependencies in self.closures.items():
+                for dependency in dependencies:
+                    self.ancestorsIndex.setdefault( (dependency, closureRuntime), set() ).add( project )
+        return self.ancestorsIndex.get( (identifier, runtime), set() )
+
+    # Make sure the given projects (a dictionary of identifier -> branch) don't depend on each other in a cycle, raises DependencyCycleError if they do
+    # Only the build dependencies between the given projects are looked at, so nothing outside of them needs to be resolved
+    def checkCycles(self, projects):
+        finished = set()
+
+        def visit(identifier, path):
+            if identifier in finished:
+                return
+            if identifier in path:
+                raise DependencyCycleError( "Dependency cycle detected: {}".format(' -> '.join(path[ path.index(identifier): ] + [identifier])) )
+
+            path.append( identifier )
+            for dependency in self.buildDependencies( identifier, projects[identifier] ):
+                if dependency in projects:
+                    visit( dependency, path )
+            path.pop()
+            finished.add( identifier )
+
+        for identifier in projects:
+            visit( identifier, [] )
@@ -0,0 +1,194 @@
+import os
+import time
+import tarfile
+import multiprocessing
+import concurrent.futures
+from components import MergeFolders, Package
+
+# Determine how many packages we should be unpacking at the same time
+def unpackJobs():
+    return int( os.environ.get('KDECI_UNPACK_JOBS', multiprocessing.cpu_count()) )
+
+# Grab the list of members shipped by the package in an opened archive, as (normalised path, type) tuples
+# The archive keeps the members it read, so extracting it afterwards doesn't need to read it again
+def listArchiveMembers( archive ):
+    members = []
+    for member in archive.getmembers():
+        if member.isdir():
+            memberType = 'dir'
+        elif member.issym():
+            memberType = 'symlink'
+        else:
+            memberType = 'file'
+        members.append( (os.path.normpath(member.name), memberType) )
+    return members
+
+# Work out how to unpack a set of packages which do not depend on each other
+# Packages in the same level cannot rely on each other, so when two of them ship the same file we need a rule which doesn't depend on timing:
+#  - regular files shipped by several packages are provided by the package whose identifier sorts last, all the others skip them
+#  - packages which disagree on the type of an entry (symlink vs folder vs file) are unpacked one after another once the rest of the level is done,
+#    in identifier order, so the usual merge rules of MergeFolders apply to them exactly as they would for a sequential unpack
+# Returns a dictionary of paths each package should skip and the list of identifiers which have to be unpacked sequentially
+def planLevel( packageMembers ):
+    # Determine who provides each path
+    providers = {}
+    symlinks = {}
+    for identifier in sorted(packageMembers.keys()):
+        for path, memberType in packageMembers[ identifier ]:
+            providers.setdefault( path, [] ).append( (identifier, memberType) )
+            if memberType == 'symlink':
+                symlinks[ path ] = identifier
+
+    skipPaths = { identifier: set() for identifier in packageMembers.keys() }
+    sequentialPackages = set()
+
+    for path, pathProviders in providers.items():
+        if len(pathProviders) == 1:
+            continue
+
+        memberTypes = set( memberType for identifier, memberType in pathProviders )
+
+        # Folders can be shared without any problem
+        if memberTypes == {'dir'}:
+            continue
+
+        # Regular files are taken from the last package (in identifier order)
+        if memberTypes == {'file'}:
+            for identifier, memberType in pathProviders[:-1]:
+                skipPaths[ identifier ].add( path )
+            continue
+
+        # Anything else needs the ordering guarantees of a sequential unpack
+        sequentialPackages.update( identifier for identifier, memberType in pathProviders )
+
+    # Packages which place content below a symlink shipped by another package of this level also need to be ordered
+    if symlinks:
+        for identifier, members in packageMembers.items():
+            for path, memberType in members:
+                parentPath = os.path.dirname( path )
+                while parentPath:
+                    if parentPath in symlinks and symlinks[ parentPath ] != identifier:
+                        sequentialPackages.update( [identifier, symlinks[ parentPath ]] )
+                        break
+                    parentPath = os.path.dirname( parentPath )
+
+    # Sequentially unpacked packages follow the normal merge rules, so they don't need to skip anything
+    for identifier in sequentialPackages:
+        skipPaths[ identifier ] = set()
+
+    return skipPaths, sorted(sequentialPackages)
+
+# Unpack a single package into the install directory, either directly or by linking it in from the package store
+# When extracting directly, an archive opened by listPackageMembers can be given so it isn't read again,
+# and the folders created can be collected in deferredDirs to have their attributes applied later (see MergeFolders.extract_archive)
+def unpackPackage( packageContents, packageMetadata, installPath, packageStore = None, skipPaths = None, archive = None, deferredDirs = None ):
+    if packageStore is None:
+        MergeFolders.extract_archive( packageContents, installPath, skipPaths, archive, deferredDirs )
+        return
+
+    entryPath = packageStore.ensureExtracted( packageContents, packageMetadata )
+    packageStore.linkInto( entryPath, installPath, skipPaths )
+
+# Grab the list of members of a package, using the package store if it has already been extracted there
+# Returns the members along with the archive if it had to be opened to find out, which the caller should use for extracting it and close afterwards
+def listPackageMembers( packageContents, packageMetadata, packageStore = None ):
+    if packageStore is not None:
+        entryPath = packageStore.ensureExtracted( packageContents, packageMetadata )
+        return packageStore.listEntryMembers( entryPath ), None
+
+    # Packages published with a manifest tell us what they contain without us having to read the archive
+    manifest = Package.loadManifest( packageMetadata )
+    if manifest is not None:
+        return Package.manifestMembers( manifest ), None
+
+    archive = tarfile.open( name=packageContents, mode='r' )
+    try:
+        return listArchiveMembers( archive ), archive
+    except Exception:
+        archive.close()
+        raise
+
+# Register the files shipped by the given packages in the install database, which the caller has to hold the lock of
+def recordPackages( installDatabase, packagesByIdentifier, packageMembers ):
+    for identifier, members in packageMembers.items():
+        packageMetadata = packagesByIdentifier[ identifier ][1]
+        files = [ path for path, memberType in members if memberType != 'dir' ]
+        installDatabase.record( identifier, packageMetadata['version'], files )
+
+# Unpack one level of packages into the install directory, using a pool of workers
+# Each package is given as a (packageContents, packageMetadata, cacheStatus) tuple as returned by Package.Registry
+# If an install database is given, the files of each package are registered in it
+# The database stays locked until then, as other builds sharing the install directory would otherwise take files nobody owns yet for leaked ones
+def unpackLevel( packages, installPath, levelNumber, packageStore = None, installDatabase = None ):
+    if installDatabase is None:
+        _unpackLevel( packages, installPath, levelNumber, packageStore, listMembers=False )
+        return
+
+    with installDatabase.locked():
+        packagesByIdentifier = { packageMetadata['identifier']: (packageContents, packageMetadata) for packageContents, packageMetadata, cacheStatus in packages }
+        packageMembers = _unpackLevel( packages, installPath, levelNumber, packageStore )
+        # Each package owns everything it ships, even the files another package of the level ended up providing
+        recordPackages( installDatabase, packagesByIdentifier, packageMembers )
+
+# Unpack one level of packages into the install directory, returning the members of each package (by identifier)
+# Unpacking a single package doesn't require knowing its members, so in that case they are only listed if listMembers is set
+def _unpackLevel( packages, installPath, levelNumber, packageStore = None, listMembers = True ):
+    levelStart = time.time()
+
+    packagesByIdentifier = { packageMetadata['identifier']: (packageContents, packageMetadata) for packageContents, packageMetadata, cacheStatus in packages }
+    for packageContents, packageMetadata, cacheStatus in packages:
+        print('## Unpacking dependency: {} ({})'.format(packageMetadata['identifier'], cacheStatus.name))
+
+    # Nothing can conflict if we only have a single package
+    if len(packages) == 1:
+        identifier = packages[0][1]['identifier']
+        if not listMembers:
+            unpackPackage( packages[0][0], packages[0][1], installPath, packageStore )
+            print('## Unpacked level {} (1 package) in {:.2f}s'.format(levelNumber, time.time() - levelStart))
+            return None
+
+        members, archive = listPackageMembers( packages[0][0], packages[0][1], packageStore )
+        try:
+            unpackPackage( packages[0][0], packages[0][1], installPath, packageStore, archive=archive )
+        finally:
+            if archive is not None:
+                archive.close()
+        print('## Unpacked level {} (1 package) in {:.2f}s'.format(levelNumber, time.time() - levelStart))
+        return {identifier: members}
+
+    # Archives opened to find out what they contain, kept open so they are only read once
+    archives = {}
+    try:
+        with concurrent.futures.ThreadPoolExecutor( max_workers=unpackJobs() ) as executor:
+            # First find out what the packages contain so we can work out who provides what
+            # When using the package store, this is also where packages not seen before get extracted into it
+            identifiers = sorted(packagesByIdentifier.keys())
+            packageMembers = {}
+            for identifier, (members, archive) in zip( identifiers, executor.map(lambda identifier: listPackageMembers(*packagesByIdentifier[identifier], packageStore), identifiers) ):
+                packageMembers[ identifier ] = members
+                if archive is not None:
+                    archives[ identifier ] = archive
+            skipPaths, sequentialPackages = planLevel( packageMembers )
+
+            # Then unpack everything that can go in parallel
+            # A folder created by one package may still be receiving files from another, so their attributes are only applied once all are done
+            deferredDirs = []
+            futures = [
+                executor.submit( unpackPackage, *packagesByIdentifier[identifier], installPath, packageStore, skipPaths[identifier], archives.get(identifier), deferredDirs )
+                for identifier in identifiers if identifier not in sequentialPackages
+            ]
+            for future in futures:
+                future.result()
+
+        MergeFolders.apply_directory_attributes( deferredDirs )
+
+        # Followed by the packages which have to be unpacked in order
+        for identifier in sequentialPackages:
+            print('## Unpacking dependency sequentially due to conflicting entries: {}'.format(identifier))
+            unpackPackage( *packagesByIdentifier[identifier], installPath, packageStore, archive=archives.get(identifier) )
+    finally:
+        for archive in archives.values():
+            archive.close()
+
+    print('## Unpacked level {} ({} packages) in {:.2f}s'.format(levelNumber, len(packages), time.time() - levelStart))
+    return packageMembers
@@ -0,0 +1,53 @@
+import os
+import sys
+import subprocess
+import contextlib
+
+# Determine how projects should be cloned: 'full', 'blobless' (all history, but file contents are only fetched when checked out) or 'shallow' (latest commit only)
+def cloneMode():
+    return os.environ.get('KDECI_GIT_CLONE_MODE', 'blobless')
+
+# Hold an exclusive lock on a mirror while it is being created or updated, as other jobs on this machine may be using it as well
+@contextlib.contextmanager
+def _lockedMirror( mirrorPath ):
+    os.makedirs( os.path.dirname(mirrorPath), exist_ok=True )
+    with open( mirrorPath + '.lock', 'a' ) as lockFile:
+        if sys.platform != 'win32':
+            import fcntl
+            fcntl.flock( lockFile.fileno(), fcntl.LOCK_EX )
+        try:
+            yield
+        finally:
+            if sys.platform != 'win32':
+                fcntl.flock( lockFile.fileno(), fcntl.LOCK_UN )
+
+# Make sure the local mirror of a repository exists and is up to date, returns the path to it
+# Mirrors are plain bare repositories, so only objects which are new since the last update have to be transferred
+def updateMirror( gitUrl, repositoryPath, mirrorsPath ):
+    mirrorPath = os.path.join( mirrorsPath, repositoryPath + '.git' )
+    with _lockedMirror( mirrorPath ):
+        if os.path.exists( mirrorPath ):
+            subprocess.check_call( ['git', 'remote', 'update', '--prune'], stdout=subprocess.DEVNULL, cwd=mirrorPath )
+        else:
+            subprocess.check_call( ['git', 'clone', '--quiet', '--mirror', gitUrl, mirrorPath] )
+    return mirrorPath
+
+# Clone a project into the given destination
+# If a folder holding mirrors is given the clone borrows its objects from the mirror of the project, otherwise a clone of the given mode is made (defaults to cloneMode())
+def cloneProject( gitUrl, repositoryPath, branch, destination, mirrorsPath = None, mode = None ):
+    if mode is None:
+        mode = cloneMode()
+
+    command = ['git', 'clone', '--quiet', '--branch={}'.format(branch)]
+
+    if mirrorsPath is not None:
+        # The clone takes what it can from the mirror, and is then made independent of it so the mirror can be updated (or removed) at any time
+        mirrorPath = updateMirror( gitUrl, repositoryPath, mirrorsPath )
+        command += ['--reference', mirrorPath, '--dissociate']
+    elif mode == 'blobless':
+        command += ['--filter=blob:none']
+    elif mode == 'shallow':
+        command += ['--depth=1']
+
+    print('## Cloning {} (branch: {})'.format(gitUrl, branch))
+    subprocess.check_call( command + [gitUrl, destination] )
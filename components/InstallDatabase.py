@@ -0,0 +1,124 @@
+import os
+import sys
+import json
+import tempfile
+import contextlib
+
+# Name of the database file, stored at the top of the install prefix it describes
+DATABASE_NAME = '.kdeci-installed.json'
+
+# Keeps track of which package (and which version of it) provided each file of an install prefix
+# This allows packages in a shared prefix to be skipped when they are up to date, and to be replaced without rebuilding the whole prefix
+class Database(object):
+
+    # Setup the database for the given install prefix
+    def __init__(self, installPath):
+        self.installPath = installPath
+        self.databasePath = os.path.join( installPath, DATABASE_NAME )
+        self.lockPath = self.databasePath + '.lock'
+        self.packages = {}
+        self._owners = None
+        self.load()
+
+    # Read the database from disk
+    def load(self):
+        self.packages = {}
+        self._owners = None
+        if os.path.exists( self.databasePath ):
+            with open( self.databasePath, 'r' ) as databaseFile:
+                self.packages = json.load( databaseFile )
+
+    # Write the database back to disk, replacing the previous version atomically
+    def save(self):
+        os.makedirs( self.installPath, exist_ok=True )
+        databaseFile = tempfile.NamedTemporaryFile( mode='w', delete=False, dir=self.installPath, prefix='.kdeci-installed-' )
+        json.dump( self.packages, databaseFile, indent = 1 )
+        databaseFile.close()
+        os.replace( databaseFile.name, self.databasePath )
+
+    # Hold an exclusive lock on the database while it is being updated, as other builds may share the same prefix
+    # The database is reloaded when the lock is taken and saved when it is released
+    @contextlib.contextmanager
+    def locked(self):
+        os.makedirs( self.installPath, exist_ok=True )
+        with open( self.lockPath, 'a' ) as lockFile:
+            if sys.platform != 'win32':
+                import fcntl
+                fcntl.flock( lockFile.fileno(), fcntl.LOCK_EX )
+            try:
+                self.load()
+                yield self
+                self.save()
+            finally:
+                if sys.platform != 'win32':
+                    fcntl.flock( lockFile.fileno(), fcntl.LOCK_UN )
+
+    # Determine which version of a package is installed, None if we don't know about it
+    def installedVersion(self, identifier):
+        if identifier not in self.packages:
+            return None
+        return self.packages[ identifier ]['version']
+
+    # Retrieve the files (relative to the prefix) a package installed
+    def filesOf(self, identifier):
+        if identifier not in self.packages:
+            return []
+        return self.packages[ identifier ]['files']
+
+    # Determine which package installed a given file (relative to the prefix), None if it isn't known
+    def owner(self, relativePath):
+        if self._owners is None:
+            self._owners = {}
+            for identifier, details in self.packages.items():
+                for path in details['files']:
+                    self._owners[ path ] = identifier
+        return self._owners.get( os.path.normpath(relativePath) )
+
+    # Register the files a package has installed
+    def record(self, identifier, version, files):
+        self.packages[ identifier ] = {
+            'version': version,
+            'files': sorted( set(os.path.normpath(path) for path in files) ),
+        }
+        self._owners = None
+
+    # Remove a package from the prefix, deleting all of its files which are not provided by another package as well
+    def remove(self, identifier):
+        if identifier not in self.packages:
+            return
+
+        # Files which other packages ship as well have to stay
+        sharedFiles = set()
+        for otherIdentifier, details in self.packages.items():
+            if otherIdentifier != identifier:
+                sharedFiles.update( details['files'] )
+
+        parentDirectories = set()
+        for path in self.packages[ identifier ]['files']:
+            if path in sharedFiles:
+                continue
+
+            fullPath = os.path.join( self.installPath, path )
+            if os.path.islink( fullPath ) or ( os.path.lexists(fullPath) and not os.path.isdir(fullPath) ):
+                os.unlink( fullPath )
+            parentDirectories.add( os.path.dirname(path) )
+
+        # Clean up folders which are now empty, deepest first
+        for directory in sorted( parentDirectories, key=lambda path: path.count(os.sep), reverse=True ):
+            while directory:
+                try:
+                    os.rmdir( os.path.join(self.installPath, directory) )
+                except OSError:
+                    break
+                directory = os.path.dirname( directory )
+
+        del self.packages[ identifier ]
+        self._owners = None
+
+# Grab the list of files (including symlinks to folders) below rootPath, relative to it
+def listFiles(rootPath):
+    files = []
+    for root, dirs, filenames in os.walk( rootPath ):
+        for name in filenames + [ name for name in dirs if os.path.islink(os.path.join(root, name)) ]:
+            files.append( os.path.relpath(os.path.join(root, name), rootPath) )
+    return files
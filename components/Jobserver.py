@@ -0,0 +1,93 @@
+import os
+import re
+import sys
+import shutil
+import tempfile
+import subprocess
+
+# Minimum versions of the build tools able to take their jobs from a FIFO based jobserver
+MINIMUM_MAKE_VERSION = (4, 4)
+MINIMUM_NINJA_VERSION = (1, 13)
+
+# GNU make style jobserver, shared by all builds running on a machine
+# The jobserver is a named pipe (FIFO) holding one token per job which may run on top of the job every build is always allowed to run
+# Each make/ninja taking part reads a token before starting an additional job and writes it back once that job is done,
+# so the total number of jobs stays within what the machine can handle no matter how many builds are running
+class Jobserver(object):
+
+    # Create a jobserver holding the given number of tokens, in a new temporary FIFO unless told where to put it
+    def __init__(self, tokens, fifoPath = None):
+        if sys.platform == 'win32':
+            raise Exception("FIFO based jobservers are not supported on Windows")
+
+        self.temporaryDirectory = None
+        if fifoPath is None:
+            self.temporaryDirectory = tempfile.mkdtemp( prefix='kdeci-jobserver-' )
+            fifoPath = os.path.join( self.temporaryDirectory, 'fifo' )
+
+        self.fifoPath = fifoPath
+        os.mkfifo( self.fifoPath, 0o600 )
+
+        # We keep the FIFO open for both reading and writing for as long as we exist
+        # Otherwise builds would see the end of the file (or block) whenever nobody else happens to have it open
+        self.fifo = os.open( self.fifoPath, os.O_RDWR )
+        os.write( self.fifo, b'+' * tokens )
+        self.tokens = tokens
+
+    # Remove the jobserver again
+    def close(self):
+        if self.fifo is None:
+            return
+        os.close( self.fifo )
+        self.fifo = None
+        os.remove( self.fifoPath )
+        if self.temporaryDirectory is not None:
+            shutil.rmtree( self.temporaryDirectory, ignore_errors=True )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        self.close()
+
+# Generate the MAKEFLAGS which tell make and ninja to take their jobs from the jobserver at the given FIFO
+def makeflags( fifoPath, maximumJobs ):
+    return '-j{} --jobserver-auth=fifo:{}'.format( maximumJobs, fifoPath )
+
+# Parse the first version number found in the output of a tool
+def _toolVersion( command ):
+    try:
+        output = subprocess.check_output( command, stderr=subprocess.DEVNULL, text=True )
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+    match = re.search( r'(\d+)\.(\d+)', output )
+    if match is None:
+        return None
+    return ( int(match.group(1)), int(match.group(2)) )
+
+def _formatVersion( version ):
+    return '.'.join( str(part) for part in version ) if version is not None else '(unknown version)'
+
+# Determine whether the build tool of a configured build folder can take its jobs from a FIFO based jobserver
+# Returns a tuple of (supported, description of the build tool)
+def buildToolSupportsJobserver( buildPath ):
+    generator = None
+    try:
+        with open( os.path.join(buildPath, 'CMakeCache.txt'), 'r', errors='replace' ) as cacheFile:
+            for line in cacheFile:
+                if line.startswith('CMAKE_GENERATOR:'):
+                    generator = line.split('=', 1)[1].strip()
+                    break
+    except OSError:
+        pass
+
+    if generator == 'Ninja':
+        version = _toolVersion( ['ninja', '--version'] )
+        return ( version is not None and version >= MINIMUM_NINJA_VERSION, 'ninja {}'.format(_formatVersion(version)) )
+
+    if generator is not None and generator.endswith('Makefiles'):
+        version = _toolVersion( ['make', '--version'] )
+        return ( version is not None and version >= MINIMUM_MAKE_VERSION, 'make {}'.format(_formatVersion(version)) )
+
+    return ( False, 'generator {}'.format(generator) )
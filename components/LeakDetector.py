@@ -0,0 +1,136 @@
+import os
+import time
+from components import InstallDatabase
+
+# Snapshot of the folders of an install prefix, used to find files which were installed into it bypassing the staging directory ($DESTDIR)
+# Installing a file (or renaming one in place) always changes the modification time of the folder it lives in, so only the folders
+# which changed since the snapshot was taken need to be looked at, instead of every single file of the prefix
+# Overwriting an existing file leaves its folder alone though. Installing a project bypassing the staging directory overwrites the files
+# its previous build installed, so if we know those (from the install database) they are checked for changes one by one
+class DirectorySnapshot(object):
+
+    # Take the snapshot of the given install prefix
+    # If an install database is given, the folders are taken from the files it knows about rather than by going over the whole prefix
+    # and the files it knows the given project installed are watched for being overwritten
+    def __init__(self, rootPath, installDatabase = None, project = None):
+        self.rootPath = rootPath
+        self.timestamp = time.time()
+        self.files = {}
+
+        if installDatabase is None:
+            self.directories = self._scanDirectories()
+            return
+
+        installDatabase.load()
+        self.directories = self._databaseDirectories( installDatabase )
+        for relativePath in installDatabase.filesOf( project ):
+            filePath = os.path.join( self.rootPath, relativePath )
+            try:
+                self.files[ filePath ] = self._fileState( os.lstat(filePath) )
+            except OSError:
+                continue
+
+    # Determine what identifies the current state of a file: writing to it or replacing it changes at least one of these
+    # The change time is included as the modification time can be set to anything, which installers often do to preserve it
+    def _fileState(self, fileStat):
+        return ( fileStat.st_ino, fileStat.st_size, fileStat.st_mtime_ns, fileStat.st_ctime_ns )
+
+    # Grab the modification time of every folder below the root, without looking at any of the files
+    def _scanDirectories(self):
+        directories = {}
+        pendingPaths = [ self.rootPath ]
+        while pendingPaths:
+            path = pendingPaths.pop()
+            try:
+                directoryStat = os.stat( path )
+                entries = list( os.scandir(path) )
+            except OSError:
+                continue
+
+            directories[ path ] = directoryStat.st_mtime_ns
+            for entry in entries:
+                if entry.is_dir( follow_symlinks=False ):
+                    pendingPaths.append( entry.path )
+
+        return directories
+
+    # Grab the modification time of the root and of every folder holding files the install database knows about
+    def _databaseDirectories(self, installDatabase):
+        relativeDirectories = set()
+        for identifier in installDatabase.packages.keys():
+            for relativePath in installDatabase.filesOf( identifier ):
+                directory = os.path.dirname( relativePath )
+                while directory and directory not in relativeDirectories:
+                    relativeDirectories.add( directory )
+                    directory = os.path.dirname( directory )
+
+        directories = {}
+        for path in [ self.rootPath ] + [ os.path.join(self.rootPath, directory) for directory in relativeDirectories ]:
+            try:
+                directories[ path ] = os.stat( path ).st_mtime_ns
+            except OSError:
+                continue
+        return directories
+
+    # Find the files which have been created or replaced since the snapshot was taken, as well as watched files which were overwritten
+    # If an install database is given, files it knows another package provides are not reported, as those come from other builds sharing the prefix
+    # As those builds only register their files once they are in place, the database should be locked while looking for leaked files
+    def findLeakedFiles(self, installDatabase = None, project = None):
+        if installDatabase is not None:
+            installDatabase.load()
+
+        candidatePaths = set( self.files.keys() )
+        pendingPaths = []
+        for path, modificationTime in self.directories.items():
+            try:
+                if os.stat( path ).st_mtime_ns == modificationTime:
+                    # Nothing was added to (or removed from) this folder
+                    continue
+                entries = list( os.scandir(path) )
+            except OSError:
+                continue
+
+            for entry in entries:
+                if not entry.is_dir( follow_symlinks=False ):
+                    candidatePaths.add( entry.path )
+                # Folders we don't know about are new (or weren't watched), so everything in them needs to be looked at
+                elif entry.path not in self.directories:
+                    pendingPaths.append( entry.path )
+
+        while pendingPaths:
+            try:
+                entries = list( os.scandir(pendingPaths.pop()) )
+            except OSError:
+                continue
+
+            for entry in entries:
+                if entry.is_dir( follow_symlinks=False ):
+                    pendingPaths.append( entry.path )
+                else:
+                    candidatePaths.add( entry.path )
+
+        leakedFiles = []
+        for filePath in candidatePaths:
+            # The install database is maintained by us
+            if os.path.dirname(filePath) == self.rootPath and os.path.basename(filePath).startswith( os.path.splitext(InstallDatabase.DATABASE_NAME)[0] ):
+                continue
+
+            try:
+                fileStat = os.lstat( filePath )
+            except OSError:
+                continue
+
+            if filePath in self.files:
+                if self._fileState( fileStat ) == self.files[ filePath ]:
+                    continue
+            elif fileStat.st_ctime <= self.timestamp:
+                continue
+
+            if installDatabase is not None:
+                owner = installDatabase.owner( os.path.relpath(filePath, self.rootPath) )
+                if owner is not None and owner != project:
+                    continue
+
+            leakedFiles.append( filePath )
+
+        return sorted(leakedFiles)
@@ -1,112 +1,336 @@
 #!/bin/env python3
 
 import shutil
-import glob
 import os
-import fnmatch
 import re
+import stat
+import errno
+import tarfile
+import concurrent.futures
 
-def merge_folders(srcDir, dstDir, move_files = False):
+# Raised when the source and destination trees cannot be merged
+class MergeConflictError(Exception):
+    pass
 
-    copy_function = shutil.move \
-        if move_files \
-        else lambda s,d: shutil.copy2(s, d, follow_symlinks=False)
+# Files matching these patterns are overwritten all the time, so we don't warn about them
+_ignoredOverwritePatterns = re.compile('|'.join(map(lambda x: f'({x})', [
+    '.*/_vendor/.*\\.py',
+    '.*/site-packages/setuptools/.*',
+    '/__pycache__/',
+    '.*site-packages/.*distutils.*',
+    '.*site-packages/pkg_resources.*',
+    '.*\\.pyc$',
+])))
 
-    if not os.path.exists(dstDir):
-        os.makedirs(dstDir)
+def _overwrite_warnings_enabled():
+    return os.environ.get('KDECI_DEBUG_OVERWRITTEN_FILES', 'no').lower() in ['true', '1', 't', 'y', 'yes']
 
-    for root, dirs, files in os.walk(srcDir):
-        #print('{} {} {}'.format(root, dirs, files))
-        
-        for dir in dirs:
-            srcPath = os.path.join(root, dir)
-            dstPath = os.path.join(dstDir, os.path.relpath(srcPath, srcDir))
-            
-            # print("src: {}".format(srcPath))
-            # print("dst: {}".format(dstPath))
-
-            if not os.path.exists(dstPath):
-                # just copy normally if destination doesn't exist
-                if os.path.islink(srcPath):
-                    #print('# copy symlink {} -> {}'.format(srcPath, dstPath))
-                    copy_function(srcPath, dstPath)
-                else:
-                    #print('# mkdirs {}'.format(dstPath))
-                    os.makedirs(dstPath)
-            elif not os.path.isdir(dstPath):
-                # we cannot copy a folder into a file
-                print("src path: {}".format(srcPath))
-                print("dst path: {}".format(dstPath))
-                raise("Couldn't override a file with a folder")
-            elif os.path.islink(srcPath) and os.path.islink(dstPath):
-                srcLink = os.readlink(srcPath)
-                dstLink = os.readlink(dstPath)
-
-                if srcLink == dstLink:
-                    dirs.remove(dir)
+def _print_overwrite_warning(srcPath, dstPath):
+    if not _ignoredOverwritePatterns.match(dstPath):
+        print ('WARNING: overwriting a file: {} -> {}'.format(srcPath, dstPath))
+
+def _raise_conflict(srcPath, dstPath, message):
+    print("src path: {}".format(srcPath))
+    print("dst path: {}".format(dstPath))
+    raise MergeConflictError(message)
+
+# Copy the contents of a file, letting the kernel do the work where possible
+# copy_file_range() allows filesystems to share extents or do server side copies, shutil falls back to sendfile()/fcopyfile()
+def _copy_file_contents(srcPath, dstPath, size):
+    if hasattr(os, 'copy_file_range') and size > 0:
+        with open(srcPath, 'rb') as srcFile, open(dstPath, 'wb') as dstFile:
+            try:
+                copied = 0
+                while copied < size:
+                    chunk = os.copy_file_range(srcFile.fileno(), dstFile.fileno(), size - copied)
+                    if chunk == 0:
+                        break
+                    copied += chunk
+                return
+            except OSError as e:
+                # Not supported for this pair of files (e.g. across filesystems on older kernels), use the regular path
+                if e.errno not in [errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.EPERM]:
+                    raise
+
+    shutil.copyfile(srcPath, dstPath, follow_symlinks=False)
+
+# Equivalent of shutil.copy2(srcPath, dstPath, follow_symlinks=False) for a destination which doesn't exist
+def _copy_file(srcPath, dstPath, srcStat = None):
+    if srcStat is None:
+        srcStat = os.lstat(srcPath)
+
+    if stat.S_ISLNK(srcStat.st_mode):
+        os.symlink(os.readlink(srcPath), dstPath)
+        return
+
+    _copy_file_contents(srcPath, dstPath, srcStat.st_size)
+    shutil.copystat(srcPath, dstPath, follow_symlinks=False)
+
+# Equivalent of shutil.move(srcPath, dstPath)
+def _move_file(srcPath, dstPath, srcStat = None):
+    try:
+        os.replace(srcPath, dstPath)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        _copy_file(srcPath, dstPath, srcStat)
+        os.unlink(srcPath)
+
+# Equivalent of _copy_file() which hardlinks the file instead, falling back to a copy when that isn't possible
+# (different filesystems, or no hardlink support)
+def _link_file(srcPath, dstPath, srcStat = None):
+    if srcStat is None:
+        srcStat = os.lstat(srcPath)
+
+    if not stat.S_ISLNK(srcStat.st_mode):
+        try:
+            os.link(srcPath, dstPath)
+            return
+        except OSError:
+            pass
+
+    _copy_file(srcPath, dstPath, srcStat)
+
+# Bring a single file to dstPath by moving, hardlinking or copying it, replacing whatever is there already
+def transfer_file(srcPath, dstPath, move_files = False, link_files = False):
+    if os.path.lexists(dstPath) and not move_files:
+        os.unlink(dstPath)
+
+    if move_files:
+        _move_file(srcPath, dstPath)
+    elif link_files:
+        _link_file(srcPath, dstPath)
+    else:
+        _copy_file(srcPath, dstPath)
+
+# Determine how many workers should be used to copy files around
+def merge_jobs():
+    return int(os.environ.get('KDECI_MERGE_JOBS', '1'))
+
+class _Merger(object):
+
+    def __init__(self, copy_function, move_files, skip_paths, jobs):
+        self.copy_function = copy_function
+        self.move_files = move_files
+        self.skip_paths = skip_paths
+        self.warnOnOverwrite = _overwrite_warnings_enabled()
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=jobs) if jobs > 1 else None
+        self.futures = []
+
+    def copy(self, srcPath, dstPath, srcStat):
+        if self.executor is None:
+            self.copy_function(srcPath, dstPath, srcStat)
+        else:
+            self.futures.append(self.executor.submit(self.copy_function, srcPath, dstPath, srcStat))
+
+    def finish(self):
+        if self.executor is None:
+            return
+        try:
+            for future in self.futures:
+                future.result()
+        finally:
+            self.executor.shutdown()
+
+    # Merge the folder srcDir into dstDir, relativeDir being the position of both in the overall merge
+    # dstIsNew tells us that dstDir was just created, in which case there is no need to look at what it contains
+    def merge(self, srcDir, dstDir, relativeDir, dstIsNew):
+        # Gather what we already have at the destination once, rather than checking each path separately
+        dstEntries = {}
+        if not dstIsNew:
+            with os.scandir(dstDir) as iterator:
+                for entry in iterator:
+                    dstEntries[entry.name] = entry
+
+        with os.scandir(srcDir) as iterator:
+            srcEntries = list(iterator)
+
+        for entry in srcEntries:
+            srcPath = entry.path
+            dstPath = os.path.join(dstDir, entry.name)
+            relativePath = os.path.join(relativeDir, entry.name) if relativeDir else entry.name
+
+            srcIsLink = entry.is_symlink()
+            dstEntry = dstEntries.get(entry.name)
+            dstIsLink = dstEntry is not None and dstEntry.is_symlink()
+            # Same as os.path.exists(): symlinks pointing nowhere don't count
+            dstExists = dstEntry is not None and \
+                (not dstIsLink or dstEntry.is_dir() or dstEntry.is_file() or os.path.exists(dstPath))
+
+            # Symlinks to folders are handled as folders, just like os.walk() does
+            if entry.is_dir():
+                if not dstExists:
+                    # just copy normally if destination doesn't exist
+                    if srcIsLink:
+                        #print('# copy symlink {} -> {}'.format(srcPath, dstPath))
+                        self.copy_function(srcPath, dstPath, entry.stat(follow_symlinks=False))
+                    else:
+                        #print('# mkdirs {}'.format(dstPath))
+                        # somebody else might be creating the same folder, only skip scanning it if it is ours
+                        try:
+                            os.mkdir(dstPath)
+                            created = True
+                        except FileExistsError:
+                            created = False
+                        self.merge(srcPath, dstPath, relativePath, created)
+                elif not dstEntry.is_dir():
+                    # we cannot copy a folder into a file
+                    _raise_conflict(srcPath, dstPath, "Couldn't override a file with a folder")
+                elif srcIsLink and dstIsLink:
+                    if os.readlink(srcPath) != os.readlink(dstPath):
+                        _raise_conflict(srcPath, dstPath, "Couldn't override a symlink with a different path")
+                elif srcIsLink and not dstIsLink:
+                    # we cannot copy a symlink into a physical folder, error out!
+                    _raise_conflict(srcPath, dstPath, "Couldn't override a physical folder with a symlink")
                 else:
-                    print("src path: {}".format(srcPath))
-                    print("dst path: {}".format(dstPath))
-                    raise("Couldn't override a symlink with a different path")
-            elif not os.path.islink(srcPath) and os.path.islink(dstPath):
-                # copy the content of the physical folder into symlink
-                pass
-            elif os.path.islink(srcPath) and not os.path.islink(dstPath):
-                # we cannot copy a symlink into a physical folder, error out!
-                print("src path: {}".format(srcPath))
-                print("dst path: {}".format(dstPath))
-                raise("Couldn't override a physical folder with a symlink")
-            else:
-                # destination folder exists
-                pass
-        
-        
-        for file in files:
-            srcPath = os.path.join(root, file)
-            dstPath = os.path.join(dstDir, os.path.relpath(srcPath, srcDir))
-
-            if not os.path.exists(dstPath):
+                    # destination folder exists (possibly as a symlink), copy the content of the physical folder into it
+                    self.merge(srcPath, dstPath, relativePath, False)
+                continue
+
+            if self.skip_paths and relativePath in self.skip_paths:
+                continue
+
+            if not dstExists:
                 # just copy normally if destination doesn't exist
+                if dstEntry is not None:
+                    # get rid of the dangling symlink first
+                    os.unlink(dstPath)
                 #print('# copy file {} -> {}'.format(srcPath, dstPath))
-                copy_function(srcPath, dstPath)
-            
-            elif not os.path.isfile(dstPath):
-                print("src path: {}".format(srcPath))
-                print("dst path: {}".format(dstPath))
-                raise("Couldn't override not-a-file with a file")
-
-            elif os.path.islink(srcPath) and os.path.islink(dstPath):
-                srcLink = os.readlink(srcPath)
-                dstLink = os.readlink(dstPath)
-
-                if srcLink != dstLink:
-                    print("src path: {}".format(srcPath))
-                    print("dst path: {}".format(dstPath))
-                    raise("Couldn't override a symlink with a different path")
+                self.copy(srcPath, dstPath, entry.stat(follow_symlinks=False))
+
+            elif not dstEntry.is_file():
+                _raise_conflict(srcPath, dstPath, "Couldn't override not-a-file with a file")
+
+            elif srcIsLink and dstIsLink:
+                if os.readlink(srcPath) != os.readlink(dstPath):
+                    _raise_conflict(srcPath, dstPath, "Couldn't override a symlink with a different path")
 
             else:
-                ignoredPatterns = [
-                    '.*/_vendor/.*\.py',
-                    '.*/site-packages/setuptools/.*',
-                    '/__pycache__/',
-                    '.*site-packages/.*distutils.*',
-                    '.*site-packages/pkg_resources.*'
-                ]
-
-                patternString = '|'.join(map(lambda x: f'({x})', ignoredPatterns))
-                pattern = re.compile(patternString)
-
-                if os.environ.get('KDECI_DEBUG_OVERWRITTEN_FILES', 'no').lower() in ['true', '1', 't', 'y', 'yes'] and \
-                   not fnmatch.fnmatch(file, '*.pyc') and \
-                    not pattern.match(dstPath):
-                    print ('WARNING: overwriting a file: {} -> {}'.format(srcPath, dstPath))
+                if self.warnOnOverwrite:
+                    _print_overwrite_warning(srcPath, dstPath)
+
+                # Remove the old file first, the destination might be a hardlink we must not write through
+                if not self.move_files:
+                    os.unlink(dstPath)
 
                 #print('# overwrite file {} -> {}'.format(srcPath, dstPath))
-                copy_function(srcPath, dstPath)
+                self.copy(srcPath, dstPath, entry.stat(follow_symlinks=False))
+
+# Merge the contents of srcDir into dstDir
+# A custom copy_function(srcPath, dstPath) can be given to e.g. link files instead of copying them,
+# files whose normalised relative path is listed in skip_paths are left alone
+# With link_files files are hardlinked rather than copied where possible
+# With jobs > 1 (or KDECI_MERGE_JOBS set) files are copied by a pool of workers
+def merge_folders(srcDir, dstDir, move_files = False, copy_function = None, skip_paths = None, jobs = None, link_files = False):
+
+    if copy_function is None:
+        engine_function = _move_file if move_files else _link_file if link_files else _copy_file
+    else:
+        engine_function = lambda s, d, srcStat: copy_function(s, d)
+
+    if jobs is None:
+        jobs = merge_jobs()
+
+    try:
+        os.makedirs(dstDir)
+        dstIsNew = True
+    except FileExistsError:
+        dstIsNew = False
+
+    merger = _Merger(engine_function, move_files, skip_paths, jobs)
+    try:
+        merger.merge(srcDir, dstDir, '', dstIsNew)
+    finally:
+        merger.finish()
+
+
+# Apply the permissions and modification times of folders created while extracting, given as (path, tarinfo) tuples
+# This has to happen once nothing is being extracted into them anymore, deepest first so read-only folders don't get in the way
+def apply_directory_attributes(createdDirs):
+    for dirPath, member in sorted(createdDirs, key=lambda entry: entry[0], reverse=True):
+        os.chmod(dirPath, member.mode)
+        os.utime(dirPath, (member.mtime, member.mtime))
+
+# Extracts a package archive straight into dstDir, applying the same conflict
+# rules as merge_folders() does when merging an already extracted tree
+# Members listed in skip_paths (normalised relative paths) are left alone, which
+# allows another package to provide them instead
+# An archive which has been opened (and possibly read) already can be passed as opened_archive, so it isn't read again
+# If deferred_dirs is given, the folders we created are added to it instead of getting their attributes applied,
+# for callers which are extracting other archives into the same folders at the same time (see apply_directory_attributes)
+def extract_archive(archivePath, dstDir, skip_paths = None, opened_archive = None, deferred_dirs = None):
+
+    if not os.path.exists(dstDir):
+        os.makedirs(dstDir, exist_ok=True)
+
+    warnOnOverwrite = _overwrite_warnings_enabled()
+
+    # Make sure newer Python versions don't silently apply their own extraction filters
+    extraArgs = {'filter': 'fully_trusted'} if hasattr(tarfile, 'fully_trusted_filter') else {}
+
+    # Directories created by us get their permissions applied once all members are in place,
+    # otherwise a read-only directory would prevent us from extracting its contents
+    createdDirs = []
+    # Parent folders we know to exist already, other extractions may be creating them concurrently
+    knownDirs = set()
+
+    archive = opened_archive if opened_archive is not None else tarfile.open(name=archivePath, mode='r')
+    try:
+        for member in archive:
+            if skip_paths and os.path.normpath(member.name) in skip_paths:
+                continue
+
+            srcPath = '{}:{}'.format(archivePath, member.name)
+            dstPath = os.path.join(dstDir, member.name)
+
+            if member.isdir():
+                if not os.path.exists(dstPath):
+                    #print('# mkdirs {}'.format(dstPath))
+                    os.makedirs(dstPath, exist_ok=True)
+                    createdDirs.append((dstPath, member))
+                elif not os.path.isdir(dstPath):
+                    # we cannot copy a folder into a file
+                    _raise_conflict(srcPath, dstPath, "Couldn't override a file with a folder")
+                else:
+                    # destination folder exists (or is a symlink to a folder), merge into it
+                    pass
+                continue
+
+            if member.issym():
+                if os.path.islink(dstPath):
+                    if os.readlink(dstPath) != member.linkname:
+                        _raise_conflict(srcPath, dstPath, "Couldn't override a symlink with a different path")
+                    # identical symlink, nothing to do
+                    continue
+                elif os.path.isdir(dstPath):
+                    # we cannot copy a symlink into a physical folder, error out!
+                    _raise_conflict(srcPath, dstPath, "Couldn't override a physical folder with a symlink")
+
+            if os.path.lexists(dstPath):
+                if os.path.exists(dstPath) and not os.path.isfile(dstPath):
+                    _raise_conflict(srcPath, dstPath, "Couldn't override not-a-file with a file")
+
+                if warnOnOverwrite and os.path.exists(dstPath):
+                    _print_overwrite_warning(srcPath, dstPath)
+
+                # Remove the old file first, tarfile would otherwise write through symlinks and hardlinks
+                os.unlink(dstPath)
+
+            parentDir = os.path.dirname(dstPath)
+            if parentDir not in knownDirs:
+                os.makedirs(parentDir, exist_ok=True)
+                knownDirs.add(parentDir)
+
+            #print('# extract {} -> {}'.format(srcPath, dstPath))
+            archive.extract(member, path=dstDir, **extraArgs)
+    finally:
+        if opened_archive is None:
+            archive.close()
 
-                # print("src path: {}".format(srcPath))
-                # print("dst path: {}".format(dstPath))
-                # raise("Couldn't override a file")
+    if deferred_dirs is not None:
+        deferred_dirs.extend(createdDirs)
+    else:
+        apply_directory_attributes(createdDirs)
 
 
 # srcDir = './python-modules'
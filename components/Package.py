@@ -2,11 +2,18 @@ import os
 import sys
 import copy
 import json
+import stat
+import zlib
+import base64
 import gitlab
 import shutil
+import hashlib
+import tarfile
 import tempfile
+import subprocess
 import packaging.version
 from enum import Enum
+from components import CommonUtils
 
 class CacheStatus(Enum):
     FromRemote = 0,
@@ -91,7 +98,9 @@ class Registry(object):
             
     # Retrieve a package matching the supplied parameters
     # Returns a tuple containing a handle to the package archive and a dictionary of metadata surrounding the package
-    def retrieve(self, identifier, branch, onlyMetadata = False):
+    # With refreshMetadata set, the metadata of a package in the remote registry is always downloaded, even if we have it in the cache
+    # (this matters for details which may be updated after the package was published, like the Git revision it represents)
+    def retrieve(self, identifier, branch, onlyMetadata = False, refreshMetadata = False):
         # Get ready to search
         remotePackage = None
         cachedPackage = None
@@ -134,7 +143,9 @@ class Registry(object):
                 cachedPackage = entry
 
         # If we have a cachedPackage entry then we can assume we have a cache hit and we should use that
-        if cachedPackage:
+        # Unless we have been asked for the latest metadata and the package is in the remote registry as well
+        isRemotePackage = any( entry['identifier'] == identifier and entry['branch'] == normalisedBranch and entry['timestamp'] == remotePackage['timestamp'] for entry in self.remotePackages )
+        if cachedPackage and not (refreshMetadata and onlyMetadata and isRemotePackage):
             # Return the contents file and the corresponding metadata
             return ( localContentsPath, cachedPackage, CacheStatus.FromCache )
 
@@ -250,6 +261,120 @@ class Registry(object):
         # Processing complete!
         return list( fetchedPackages.values() )
 
+    # Determine whether the newest package for the given identifier and branch has the given content hash
+    # If it does, publishing a new package would only cause everyone using it to download and unpack the same files again
+    def hasContentHash(self, identifier, branch, contentHash):
+        packageMetadata = self._newestMetadata( identifier, branch )
+        return packageMetadata is not None and packageMetadata.get('contentHash', None) == contentHash
+
+    # Retrieve the metadata of the newest package for the given identifier and branch, None if there is no such package
+    # A package the registry lists but whose metadata it can't find counts as no package, any other trouble talking to the registry is passed on
+    def _newestMetadata(self, identifier, branch, refreshMetadata = False):
+        try:
+            packageContents, packageMetadata, cacheStatus = self.retrieve( identifier, branch, onlyMetadata=True, refreshMetadata=refreshMetadata )
+        except gitlab.exceptions.GitlabGetError as e:
+            if e.response_code != 404:
+                raise
+            return None
+        return packageMetadata
+
+    # Record that the newest package for the given identifier and branch represents another Git revision as well
+    # This is used when a build produces exactly the same package as before: rather than publishing it again, we update the metadata of the existing package
+    # Otherwise the package would keep claiming to be built from an older revision, and anything comparing revisions would think the project changed
+    def recordGitRevision(self, identifier, branch, gitRevision):
+        packageMetadata = self._newestMetadata( identifier, branch, refreshMetadata=True )
+        if packageMetadata is None or packageMetadata.get('gitRevision', None) == gitRevision:
+            return False
+        packageMetadata['gitRevision'] = gitRevision
+
+        # If the package is in the remote registry we upload the updated metadata to the existing package version
+        # When several files of a package share the same name Gitlab hands out the newest one, so the archive stays as it is and the metadata is replaced
+        if any( entry['identifier'] == identifier and entry['version'] == packageMetadata['version'] for entry in self.remotePackages ):
+            latestMetadata = tempfile.NamedTemporaryFile(delete=False, mode='w')
+            json.dump( packageMetadata, latestMetadata, indent = 4 )
+            latestMetadata.close()
+
+            self.remoteRegistry.generic_packages.upload(
+                package_name=identifier,
+                package_version=packageMetadata['version'],
+                file_name="metadata.json",
+                path=latestMetadata.name
+            )
+            os.remove( latestMetadata.name )
+
+        # Our cache may hold the same package as well, which has to agree with the registry
+        # Packages downloaded from the registry are cached under the normalised branch name, those we built ourselves under the actual one
+        for cacheBranch in set([ branch, self._normaliseBranchName(branch) ]):
+            localMetadataPath = os.path.join( self.localCachePath, "{0}-{1}.json".format(identifier, cacheBranch) )
+            if not os.path.exists( localMetadataPath ):
+                continue
+            with open( localMetadataPath, 'r' ) as localMetadataFile:
+                cachedMetadata = json.load( localMetadataFile )
+            if cachedMetadata.get('version', None) == packageMetadata['version']:
+                cachedMetadata['gitRevision'] = gitRevision
+                self._writeCachedMetadata( localMetadataPath, cachedMetadata )
+
+        return True
+
+    # Store a package in the local cache, just like it would be after downloading it from the registry
+    # If the cache already holds a package with the same contents it is left alone, as replacing it would invalidate it for everyone using it
+    # In that case only the Git revision the cached package represents is updated
+    # Returns the metadata of the stored package, or None if the cached package was kept
+    def storeInCache(self, archivePath, identifier, branch, gitRevision, additionalMetadata = {}):
+        localContentsPath = os.path.join( self.localCachePath, "{0}-{1}.tar".format(identifier, branch) )
+        localMetadataPath = os.path.join( self.localCachePath, "{0}-{1}.json".format(identifier, branch) )
+
+        cachedMetadata = None
+        if os.path.exists( localMetadataPath ):
+            with open( localMetadataPath, 'r' ) as localMetadataFile:
+                cachedMetadata = json.load( localMetadataFile )
+
+        contentHash = additionalMetadata.get('contentHash', None)
+        if cachedMetadata is not None and contentHash is not None and cachedMetadata.get('contentHash', None) == contentHash and os.path.exists( localContentsPath ):
+            if cachedMetadata.get('gitRevision', None) != gitRevision:
+                cachedMetadata['gitRevision'] = gitRevision
+                self._writeCachedMetadata( localMetadataPath, cachedMetadata )
+            return None
+
+        packageMetadata = self.generateMetadata( archivePath, identifier, branch, gitRevision, additionalMetadata )
+
+        # The cache may be shared with other machines, so the archive is copied next to its final location first and then moved in place
+        # That way nobody ever reads half an archive, and the metadata only points to it once it is there
+        latestContent = tempfile.NamedTemporaryFile(delete=False, dir=self.localCachePath)
+        latestContent.close()
+        try:
+            shutil.copy2( archivePath, latestContent.name )
+            os.chmod( latestContent.name, 0o644 )
+            os.replace( latestContent.name, localContentsPath )
+        except Exception:
+            if os.path.exists( latestContent.name ):
+                os.remove( latestContent.name )
+            raise
+
+        self._writeCachedMetadata( localMetadataPath, packageMetadata )
+        return packageMetadata
+
+    # Write the metadata of a package in the cache, replacing the previous version atomically so nobody ever reads half of it
+    def _writeCachedMetadata(self, localMetadataPath, packageMetadata):
+        latestMetadata = tempfile.NamedTemporaryFile(delete=False, mode='w', dir=self.localCachePath)
+        json.dump( packageMetadata, latestMetadata, indent = 4 )
+        latestMetadata.close()
+        os.chmod( latestMetadata.name, 0o644 )
+        os.replace( latestMetadata.name, localMetadataPath )
+
+        # Keep what we know about the cache up to date as well
+        self.cachedPackages = [ entry for entry in self.cachedPackages if not (entry['identifier'] == packageMetadata['identifier'] and entry['branch'] == packageMetadata['branch']) ]
+        self.cachedPackages.append( packageMetadata )
+
+    # Determine which Git revision the newest package for the given identifier and branch represents
+    # The metadata is always taken from the registry if the package is there, as the revision is updated whenever an identical package is built from a newer one
+    # Returns None if there is no such package, or it doesn't tell
+    def gitRevisionOf(self, identifier, branch):
+        packageMetadata = self._newestMetadata( identifier, branch, refreshMetadata=True )
+        if packageMetadata is None:
+            return None
+        return packageMetadata.get('gitRevision', None)
+
     def generateMetadata(self, archivePath, identifier, branch, gitRevision, additionalMetadata = {}):
         # Formulate the remote version number
         # While Git branches may contain slashes, the Gitlab generic package registry does not allow this so we need to normalise it first
@@ -317,3 +442,111 @@ class Registry(object):
 
         # All done now!
         return True
+
+# Manifests larger than this (in bytes of JSON) are stored compressed in the package metadata
+MANIFEST_COMPRESSION_THRESHOLD = 64 * 1024
+
+# Normalise the permissions of an entry for inclusion in a package, so they don't depend on the umask of the builder
+# Only whether a file is executable is kept, the file type bits are left alone
+def normaliseMode( mode ):
+    if stat.S_ISLNK( mode ):
+        return stat.S_IFMT( mode ) | 0o777
+    if stat.S_ISDIR( mode ) or mode & 0o111:
+        return stat.S_IFMT( mode ) | 0o755
+    return stat.S_IFMT( mode ) | 0o644
+
+# Determine the modification time given to all entries of a package
+# This is SOURCE_DATE_EPOCH if set, otherwise the time of the commit being built (or 0 if that can't be determined)
+def archiveTimestamp( sourcesPath ):
+    if 'SOURCE_DATE_EPOCH' in os.environ:
+        return int( os.environ['SOURCE_DATE_EPOCH'] )
+
+    try:
+        commitTime = subprocess.check_output( ['git', 'log', '-1', '--format=%ct'], cwd=sourcesPath, stderr=subprocess.DEVNULL )
+        return int( commitTime.strip() )
+    except (OSError, ValueError, subprocess.CalledProcessError):
+        return 0
+
+# Create a reproducible archive of the given entries of rootPath, writing it to archiveFile (an open file object)
+# Building the same tree twice results in the exact same archive: members are sorted and their times, owners and permissions are normalised
+def createArchive( archiveFile, rootPath, filenames, timestamp = 0 ):
+    def normaliseMember( tarinfo ):
+        tarinfo.mtime = timestamp
+        tarinfo.uid = tarinfo.gid = 0
+        tarinfo.uname = tarinfo.gname = ''
+        if tarinfo.isdir():
+            fileType = stat.S_IFDIR
+        elif tarinfo.issym():
+            fileType = stat.S_IFLNK
+        else:
+            fileType = stat.S_IFREG
+        tarinfo.mode = stat.S_IMODE( normaliseMode(fileType | tarinfo.mode) )
+        return tarinfo
+
+    # Folders are added in sorted order by tarfile itself
+    with tarfile.open( fileobj=archiveFile, mode='w', format=tarfile.PAX_FORMAT ) as archive:
+        for filename in sorted(filenames):
+            archive.add( os.path.join(rootPath, filename), arcname=filename, recursive=True, filter=normaliseMember )
+
+# Calculate the hash identifying the contents of a package, based on its manifest and its dependencies
+# Unlike the archive itself this doesn't depend on the time the package was built, so an unchanged rebuild has the same hash
+def contentHash( manifest, dependencies, runtimeDependencies ):
+    hashSource = json.dumps( {
+        'manifest': manifest,
+        'dependencies': dependencies,
+        'runtime-dependencies': runtimeDependencies,
+    }, sort_keys=True, separators=(',', ':') )
+    return hashlib.sha256( hashSource.encode('utf-8') ).hexdigest()
+
+# Generate the manifest of a package, describing every entry of the tree which ends up in the archive
+# Each entry is a [path, mode, size, hash] list, where the mode includes the file type bits and is normalised like in the archive
+# For symlinks the hash field holds the link target, folders have neither size nor hash
+def generateManifest( rootPath ):
+    entries = []
+    for root, dirs, files in os.walk( rootPath ):
+        dirs.sort()
+        for name in sorted(dirs + files):
+            fullPath = os.path.join( root, name )
+            relativePath = os.path.relpath( fullPath, rootPath ).replace( os.sep, '/' )
+            entryStat = os.lstat( fullPath )
+
+            if stat.S_ISLNK( entryStat.st_mode ):
+                entries.append( [relativePath, normaliseMode(entryStat.st_mode), 0, os.readlink(fullPath)] )
+            elif stat.S_ISDIR( entryStat.st_mode ):
+                entries.append( [relativePath, normaliseMode(entryStat.st_mode), 0, ''] )
+            else:
+                entries.append( [relativePath, normaliseMode(entryStat.st_mode), entryStat.st_size, CommonUtils.generateFileChecksum(fullPath)] )
+
+    # Keep it readable when small, compress it otherwise
+    encodedEntries = json.dumps( entries, separators=(',', ':') )
+    if len(encodedEntries) <= MANIFEST_COMPRESSION_THRESHOLD:
+        return { 'version': 1, 'encoding': 'none', 'entries': entries }
+
+    compressedEntries = base64.b64encode( zlib.compress(encodedEntries.encode('utf-8'), 9) ).decode('ascii')
+    return { 'version': 1, 'encoding': 'zlib+base64', 'data': compressedEntries }
+
+# Retrieve the manifest entries from a package's metadata, returns None for packages published without a manifest
+def loadManifest( packageMetadata ):
+    manifest = packageMetadata.get('manifest', None) if packageMetadata else None
+    if manifest is None or manifest.get('version', None) != 1:
+        return None
+
+    if manifest['encoding'] == 'none':
+        return manifest['entries']
+    if manifest['encoding'] == 'zlib+base64':
+        return json.loads( zlib.decompress(base64.b64decode(manifest['data'])).decode('utf-8') )
+
+    return None
+
+# Convert manifest entries into (normalised path, type) tuples, type being 'dir', 'symlink' or 'file'
+def manifestMembers( manifestEntries ):
+    members = []
+    for path, mode, size, hash in manifestEntries:
+        if stat.S_ISDIR( mode ):
+            memberType = 'dir'
+        elif stat.S_ISLNK( mode ):
+            memberType = 'symlink'
+        else:
+            memberType = 'file'
+        members.append( (os.path.normpath(path), memberType) )
+    return members
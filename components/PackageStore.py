@@ -0,0 +1,272 @@
+import os
+import sys
+import json
+import stat
+import errno
+import shutil
+import time
+import tarfile
+import tempfile
+from components import MergeFolders
+
+# ioctl used to ask Linux filesystems (btrfs, XFS, ...) for a copy-on-write clone of a file
+FICLONE = 0x40049409
+
+# Name of the manifest file stored alongside the contents of each extracted package
+MANIFEST_NAME = '.kdeci-store-manifest.json'
+
+# Store of extracted packages, shared between all jobs running on a runner
+# Every package version is only ever extracted once, install directories are then assembled by linking the files in from the store
+class Store(object):
+
+    # Setup the store at the given location, the size limit is in bytes
+    def __init__(self, storePath, linkMode = None, maximumSize = None):
+        self.storePath = storePath
+
+        # Determine how much space we are allowed to use (20GB unless we have been told otherwise)
+        if maximumSize is None:
+            maximumSize = int( float(os.environ.get('KDECI_PACKAGE_STORE_SIZE', '20')) * 1024 * 1024 * 1024 )
+        self.maximumSize = maximumSize
+
+        # Make sure the store exists
+        if not os.path.exists( self.storePath ):
+            os.makedirs( self.storePath, exist_ok=True )
+
+        # Determine how files should be brought into install directories: 'reflink', 'hardlink' or 'copy'
+        # Unless we have been told otherwise we try them in that order and remember the first one which works
+        self.linkMode = linkMode if linkMode else os.environ.get('KDECI_PACKAGE_STORE_LINK_MODE', None)
+
+        # Hardlinked files are only protected by being read only, which means nothing to root
+        # A build running as root would write straight into the store, so we make independent copies instead
+        # On Windows read only files can't be deleted, which would break removing or replacing them in the install directory
+        runningAsRoot = hasattr(os, 'geteuid') and os.geteuid() == 0
+        self.allowHardlinks = not runningAsRoot and sys.platform != 'win32'
+        if self.linkMode == 'hardlink' and not self.allowHardlinks:
+            print('## WARNING: not hardlinking from the package store {}, copying instead'.format('when running as root' if runningAsRoot else 'on Windows'))
+            self.linkMode = 'copy'
+
+        # Entries we have already checked (or extracted) during this run
+        self.verifiedEntries = set()
+
+    # Determine where a given package version lives in the store
+    def entryPath(self, identifier, version):
+        return os.path.join( self.storePath, identifier, version )
+
+    # Make sure the given package has been extracted into the store, returns the path to the extracted contents
+    def ensureExtracted(self, packageContents, packageMetadata):
+        entryPath = self.entryPath( packageMetadata['identifier'], packageMetadata['version'] )
+
+        # Do we have a usable copy already?
+        if entryPath in self.verifiedEntries:
+            return entryPath
+
+        if os.path.exists( entryPath ):
+            if self._verifyEntry( entryPath ):
+                self.verifiedEntries.add( entryPath )
+                self._markUsed( entryPath )
+                return entryPath
+
+            # Someone wrote into the store, so this copy can no longer be trusted
+            print('## WARNING: extracted package was modified, extracting it again: {}'.format(entryPath))
+            self._removeEntry( entryPath )
+
+        # Extract the package next to its final location, then move it in place
+        # That way other jobs using the store never see a half extracted package
+        os.makedirs( os.path.dirname(entryPath), exist_ok=True )
+        incomingPath = tempfile.mkdtemp( prefix='.incoming-', dir=os.path.dirname(entryPath) )
+        os.chmod( incomingPath, 0o755 )
+
+        extraArgs = {'filter': 'fully_trusted'} if hasattr(tarfile, 'fully_trusted_filter') else {}
+        with tarfile.open( name=packageContents, mode='r' ) as archive:
+            archive.extractall( path=incomingPath, **extraArgs )
+
+        # Record what the package contains, and make the files read only so nothing can write into the store through a hardlink
+        self._writeManifest( incomingPath )
+
+        try:
+            os.rename( incomingPath, entryPath )
+        except OSError:
+            # Another job beat us to it, use their copy
+            self._removeEntry( incomingPath )
+
+        self.verifiedEntries.add( entryPath )
+
+        # Make some room if we need to
+        self.evict( keep=self.verifiedEntries )
+        return entryPath
+
+    # Grab the list of entries of an extracted package, as (normalised path, type) tuples
+    def listEntryMembers(self, entryPath):
+        manifest = self._loadManifest( entryPath )
+        return [ (path, details['type']) for path, details in manifest.items() ]
+
+    # Bring the contents of an extracted package into the install directory, applying the usual merge rules
+    def linkInto(self, entryPath, installPath, skipPaths = None):
+        manifest = self._loadManifest( entryPath )
+
+        def linkFunction(srcPath, dstPath):
+            self._linkFile( srcPath, dstPath, manifest.get(os.path.relpath(srcPath, entryPath)) )
+
+        skipPaths = set(skipPaths) if skipPaths else set()
+        skipPaths.add( MANIFEST_NAME )
+        MergeFolders.merge_folders( entryPath, installPath, copy_function=linkFunction, skip_paths=skipPaths )
+
+    # Create dstPath as a link (or failing that, a copy) of srcPath
+    def _linkFile(self, srcPath, dstPath, details):
+        # Symlinks are simply recreated
+        if os.path.islink( srcPath ):
+            os.symlink( os.readlink(srcPath), dstPath )
+            return
+
+        # Reflinks share the data on disk but are otherwise independent copies
+        if self.linkMode in [None, 'reflink']:
+            try:
+                self._reflinkFile( srcPath, dstPath )
+                self.linkMode = 'reflink'
+                # Unlike hardlinks, these can be given back their original permissions
+                if details is not None:
+                    os.chmod( dstPath, details['mode'] )
+                return
+            except OSError:
+                if self.linkMode == 'reflink':
+                    raise
+                self.linkMode = 'hardlink' if self.allowHardlinks else 'copy'
+
+        # Hardlinks share the file itself, which is why files in the store are read only
+        if self.linkMode == 'hardlink':
+            try:
+                os.link( srcPath, dstPath )
+                return
+            except OSError as e:
+                # Fall back to copying if the store is on a different filesystem (or links aren't supported)
+                if e.errno not in [errno.EXDEV, errno.EPERM, errno.EMLINK, errno.ENOTSUP, errno.EOPNOTSUPP]:
+                    raise
+                self.linkMode = 'copy'
+
+        shutil.copy2( srcPath, dstPath, follow_symlinks=False )
+        if details is not None:
+            os.chmod( dstPath, details['mode'] )
+
+    # Clone a file using the filesystem's copy-on-write support
+    def _reflinkFile(self, srcPath, dstPath):
+        if not sys.platform.startswith('linux'):
+            raise OSError(errno.ENOTSUP, 'Reflinks are only supported on Linux')
+
+        import fcntl
+        with open(srcPath, 'rb') as srcFile, open(dstPath, 'wb') as dstFile:
+            try:
+                fcntl.ioctl( dstFile.fileno(), FICLONE, srcFile.fileno() )
+            except OSError:
+                dstFile.close()
+                os.unlink( dstPath )
+                raise
+        shutil.copystat( srcPath, dstPath )
+
+    # Record the contents of a freshly extracted package and protect the files against modification
+    def _writeManifest(self, entryPath):
+        manifest = {}
+        for root, dirs, files in os.walk( entryPath ):
+            for name in dirs + files:
+                fullPath = os.path.join( root, name )
+                relativePath = os.path.relpath( fullPath, entryPath )
+                fileStat = os.lstat( fullPath )
+
+                if stat.S_ISLNK( fileStat.st_mode ):
+                    manifest[ relativePath ] = { 'type': 'symlink' }
+                elif stat.S_ISDIR( fileStat.st_mode ):
+                    manifest[ relativePath ] = { 'type': 'dir' }
+                else:
+                    os.chmod( fullPath, stat.S_IMODE(fileStat.st_mode) & ~(stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH) )
+                    manifest[ relativePath ] = {
+                        'type': 'file',
+                        'mode': stat.S_IMODE(fileStat.st_mode),
+                        'size': fileStat.st_size,
+                        'mtime': fileStat.st_mtime_ns,
+                    }
+
+        with open( os.path.join(entryPath, MANIFEST_NAME), 'w' ) as manifestFile:
+            json.dump( manifest, manifestFile )
+
+    def _loadManifest(self, entryPath):
+        with open( os.path.join(entryPath, MANIFEST_NAME), 'r' ) as manifestFile:
+            return json.load( manifestFile )
+
+    # Make sure nothing has been written into the extracted package since we created it
+    # Anything writing into a file changes its size or modification time, so checking those is enough
+    def _verifyEntry(self, entryPath):
+        try:
+            manifest = self._loadManifest( entryPath )
+        except (OSError, ValueError):
+            return False
+
+        for relativePath, details in manifest.items():
+            if details['type'] != 'file':
+                continue
+            try:
+                fileStat = os.lstat( os.path.join(entryPath, relativePath) )
+            except OSError:
+                return False
+            if fileStat.st_size != details['size'] or fileStat.st_mtime_ns != details['mtime']:
+                return False
+
+        return True
+
+    # Mark an extracted package as recently used, this is what eviction is based on
+    def _markUsed(self, entryPath):
+        try:
+            os.utime( os.path.join(entryPath, MANIFEST_NAME) )
+        except OSError:
+            pass
+
+    # Remove the least recently used extracted packages until we are within our size limit
+    # Packages used recently may still be linked into an install directory by another job, so those are left alone
+    def evict(self, keep = None, minimumAge = 3600):
+        keep = keep if keep else set()
+        entries = []
+        for identifier in os.listdir( self.storePath ):
+            identifierPath = os.path.join( self.storePath, identifier )
+            if identifier.startswith('.') or not os.path.isdir( identifierPath ):
+                continue
+
+            for version in os.listdir( identifierPath ):
+                entryPath = os.path.join( identifierPath, version )
+                if version.startswith('.incoming-'):
+                    continue
+
+                # The manifest tells us how large the package is, without having to look at every file
+                try:
+                    lastUsed = os.stat( os.path.join(entryPath, MANIFEST_NAME) ).st_mtime
+                    manifest = self._loadManifest( entryPath )
+                except (OSError, ValueError):
+                    continue
+                size = sum( details['size'] for details in manifest.values() if details['type'] == 'file' )
+                entries.append( (lastUsed, size, entryPath) )
+
+        totalSize = sum( size for lastUsed, size, entryPath in entries )
+
+        # Oldest first...
+        for lastUsed, size, entryPath in sorted(entries):
+            if totalSize <= self.maximumSize:
+                break
+            if entryPath in keep or lastUsed > time.time() - minimumAge:
+                continue
+
+            print('## Evicting extracted package (last used {}): {}'.format(time.asctime(time.localtime(lastUsed)), entryPath))
+            try:
+                self._removeEntry( entryPath )
+            except OSError:
+                continue
+            totalSize -= size
+
+            # Clean up after the last version of a package
+            try:
+                os.rmdir( os.path.dirname(entryPath) )
+            except OSError:
+                pass
+
+    def _removeEntry(self, entryPath):
+        # Make sure we are allowed to remove everything (Windows refuses to delete read only files)
+        def makeWritable(function, path, excinfo):
+            os.chmod( path, stat.S_IWUSR | stat.S_IRUSR )
+            function( path )
+        shutil.rmtree( entryPath, onerror=makeWritable )
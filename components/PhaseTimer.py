@@ -0,0 +1,91 @@
+import os
+import json
+import time
+import atexit
+
+# Keeps track of how long each phase of a build takes, in wall clock time as well as CPU time (our own and that of the commands we ran)
+# Phases run one after the other: beginning a phase ends the one before it
+# The timings are written when the process exits, no matter how it exits, as a Chrome trace (for chrome://tracing or https://ui.perfetto.dev) and a summary
+class PhaseTimer(object):
+
+    # Setup the timer, writing to the given paths (either of which may be None) on exit
+    # Anything given in details (project, branch, platform, ...) is included in the summary
+    def __init__(self, tracePath = None, summaryPath = None, details = None):
+        self.tracePath = tracePath
+        self.summaryPath = summaryPath
+        self.details = details or {}
+        self.phases = []
+        self.currentPhase = None
+        self.start = time.time()
+        atexit.register( self.write )
+
+    # Determine how much CPU time has been used so far, by ourselves and by the commands we ran (once they finished)
+    def _cpuTime(self):
+        times = os.times()
+        return times.user + times.system + times.children_user + times.children_system
+
+    # Begin a phase, ending the current one if there is one
+    def begin(self, name):
+        self.end()
+        self.currentPhase = {'name': name, 'start': time.time(), 'cpuStart': self._cpuTime()}
+
+    # End the current phase, if there is one
+    def end(self):
+        if self.currentPhase is None:
+            return
+
+        phase = self.currentPhase
+        self.currentPhase = None
+        phaseEnd = time.time()
+        self.phases.append( {
+            'name': phase['name'],
+            'start': phase['start'],
+            'end': phaseEnd,
+            'wall': phaseEnd - phase['start'],
+            'cpu': self._cpuTime() - phase['cpuStart'],
+        } )
+
+    # Write the timings recorded so far
+    # A phase still running at this point is where the build stopped (most likely because something failed), so it is marked as incomplete
+    def write(self):
+        phases = list( self.phases )
+        if self.currentPhase is not None:
+            self.end()
+            phases.append( dict(self.phases.pop(), incomplete=True) )
+
+        runEnd = time.time()
+        summary = dict( self.details )
+        summary.update( {
+            'start': self.start,
+            'end': runEnd,
+            'wall': runEnd - self.start,
+            'phases': phases,
+        } )
+
+        try:
+            if self.summaryPath is not None:
+                with open( self.summaryPath, 'w' ) as summaryFile:
+                    json.dump( summary, summaryFile, indent = 1 )
+
+            if self.tracePath is not None:
+                microseconds = lambda moment: int( (moment - self.start) * 1000000 )
+                events = [ {'name': 'process_name', 'ph': 'M', 'pid': 1, 'args': {'name': self.details.get('project', 'build')}} ]
+                for phase in phases:
+                    events.append( {
+                        'name': phase['name'], 'cat': 'phase', 'ph': 'X', 'pid': 1, 'tid': 1,
+                        'ts': microseconds(phase['start']), 'dur': microseconds(phase['end']) - microseconds(phase['start']),
+                        'args': {'cpu': round(phase['cpu'], 3), 'incomplete': phase.get('incomplete', False)},
+                    } )
+                with open( self.tracePath, 'w' ) as traceFile:
+                    json.dump( {'traceEvents': events, 'displayTimeUnit': 'ms', 'otherData': dict(self.details, start=self.start)}, traceFile )
+        except OSError as e:
+            # Missing timings are no reason to fail a build
+            print('## WARNING: unable to write the build timings: {}'.format(e))
+
+# Load the summary written by a PhaseTimer, None if there is none (or it can't be read)
+def loadSummary( summaryPath ):
+    try:
+        with open( summaryPath, 'r' ) as summaryFile:
+            return json.load( summaryFile )
+    except (OSError, ValueError):
+        return None
@@ -0,0 +1,102 @@
+import os
+import json
+import time
+import hashlib
+import tarfile
+import tempfile
+from components import MergeFolders
+
+# Bump this whenever the way snapshots are created changes, so old snapshots are no longer used
+SNAPSHOT_FORMAT = 1
+
+# Cache of ready made install prefixes, keyed by the exact set of package versions they were assembled from
+# Jobs which resolve the same set of dependencies (like all merge requests of a project) can then restore a single archive instead of unpacking every package again
+class SnapshotCache(object):
+
+    # Setup the cache at the given location, the size limit is in bytes
+    def __init__(self, cachePath, maximumSize = None):
+        self.cachePath = cachePath
+
+        # Determine how much space we are allowed to use (20GB unless we have been told otherwise)
+        if maximumSize is None:
+            maximumSize = int( float(os.environ.get('KDECI_PREFIX_SNAPSHOT_CACHE_SIZE', '20')) * 1024 * 1024 * 1024 )
+        self.maximumSize = maximumSize
+
+        # Make sure the cache exists
+        if not os.path.exists( self.cachePath ):
+            os.makedirs( self.cachePath, exist_ok=True )
+
+    # Calculate the fingerprint of a set of packages, given as a list of package metadata
+    def fingerprint(self, packagesMetadata, platform):
+        packageVersions = sorted( (metadata['identifier'], metadata['version']) for metadata in packagesMetadata )
+        fingerprintSource = json.dumps( {
+            'format': SNAPSHOT_FORMAT,
+            'platform': str(platform),
+            'packages': packageVersions,
+        }, sort_keys=True )
+        return hashlib.sha256( fingerprintSource.encode('utf-8') ).hexdigest()
+
+    # Determine where the snapshot for a given fingerprint lives
+    def snapshotPath(self, fingerprint):
+        return os.path.join( self.cachePath, fingerprint + '.tar' )
+
+    # Restore the snapshot with the given fingerprint into the install directory
+    # Returns whether a snapshot was available
+    def restore(self, fingerprint, installPath):
+        snapshotPath = self.snapshotPath( fingerprint )
+        if not os.path.exists( snapshotPath ):
+            return False
+
+        # Mark the snapshot as recently used, this is what eviction is based on
+        try:
+            os.utime( snapshotPath )
+        except OSError:
+            pass
+
+        MergeFolders.extract_archive( snapshotPath, installPath )
+        return True
+
+    # Create a snapshot of the install directory for the given fingerprint
+    def store(self, fingerprint, installPath):
+        snapshotPath = self.snapshotPath( fingerprint )
+
+        # Write the archive next to its final location first, so nobody picks up a half written snapshot
+        snapshotFile = tempfile.NamedTemporaryFile( delete=False, dir=self.cachePath, prefix='.incoming-', suffix='.tar' )
+        with tarfile.open( fileobj=snapshotFile, mode='w' ) as archive:
+            for filename in sorted( os.listdir(installPath) ):
+                archive.add( os.path.join(installPath, filename), arcname=filename, recursive=True )
+        snapshotFile.close()
+
+        os.replace( snapshotFile.name, snapshotPath )
+
+        # Make some room if we need to
+        self.evict( keep=snapshotPath )
+
+    # Remove the least recently used snapshots until we are within our size limit
+    def evict(self, keep = None):
+        snapshots = []
+        for filename in os.listdir( self.cachePath ):
+            if not filename.endswith('.tar') or filename.startswith('.incoming-'):
+                continue
+            fullPath = os.path.join( self.cachePath, filename )
+            try:
+                fileStat = os.stat( fullPath )
+            except OSError:
+                continue
+            snapshots.append( (fileStat.st_mtime, fileStat.st_size, fullPath) )
+
+        totalSize = sum( size for lastUsed, size, fullPath in snapshots )
+
+        # Oldest first...
+        for lastUsed, size, fullPath in sorted(snapshots):
+            if totalSize <= self.maximumSize:
+                break
+            if fullPath == keep:
+                continue
+
+            print('## Evicting prefix snapshot (last used {}): {}'.format(time.asctime(time.localtime(lastUsed)), fullPath))
+            try:
+                os.remove( fullPath )
+            except OSError:
+                continue
+            totalSize -= size
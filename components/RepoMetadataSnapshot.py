@@ -0,0 +1,111 @@
+import os
+import json
+import time
+import gzip
+import yaml
+import hashlib
+import tempfile
+import urllib.request
+from components import Dependencies
+
+# Identifies a file as being a repo-metadata snapshot
+SNAPSHOT_FORMAT = 'kdeci-repo-metadata-snapshot'
+# Bump this whenever the layout of snapshots changes
+SNAPSHOT_VERSION = 1
+
+# A repo-metadata snapshot is a single gzip compressed JSON document holding everything Dependencies.Resolver needs:
+#  - format / version: identify the file and the layout of the rest of it
+#  - contentHash: SHA-256 of the projects and branch rules, used to verify the snapshot and to tell whether two snapshots differ
+#  - revision: the repo-metadata commit the snapshot was made from (if known)
+#  - projects: the metadata of each project, keyed by repository path
+#  - branchRules: the contents of branch-rules.yml
+# This allows jobs to download a single small file instead of cloning the whole repo-metadata repository
+
+# Calculate the content hash of a set of projects and branch rules
+def contentHash( projects, branchRules ):
+    hashSource = json.dumps( {'projects': projects, 'branchRules': branchRules}, sort_keys=True, separators=(',', ':'), default=str )
+    return hashlib.sha256( hashSource.encode('utf-8') ).hexdigest()
+
+# Create a snapshot from a repo-metadata checkout
+def create( projectsMetadata, branchRules ):
+    projects = Dependencies.readProjectsMetadata( projectsMetadata )
+    with open( branchRules, 'r' ) as branchRulesFile:
+        rules = yaml.load( branchRulesFile, Loader=Dependencies.YamlLoader )
+
+    # Make sure everything survives the trip through JSON unchanged, so the content hash matches once loaded again
+    projects = json.loads( json.dumps(projects, default=str) )
+    rules = json.loads( json.dumps(rules, default=str) )
+
+    return {
+        'format': SNAPSHOT_FORMAT,
+        'version': SNAPSHOT_VERSION,
+        'contentHash': contentHash( projects, rules ),
+        'revision': Dependencies.gitCheckoutHead( projectsMetadata ),
+        'projects': projects,
+        'branchRules': rules,
+    }
+
+# Write a snapshot to disk, replacing any previous version atomically
+# The output only depends on the contents of the snapshot, so it can be compared and cached like any other file
+def write( snapshot, snapshotPath ):
+    snapshotDirectory = os.path.dirname( os.path.abspath(snapshotPath) )
+    snapshotFile = tempfile.NamedTemporaryFile( delete=False, dir=snapshotDirectory, prefix='.incoming-' )
+    with gzip.GzipFile( fileobj=snapshotFile, mode='wb', mtime=0 ) as compressedFile:
+        compressedFile.write( json.dumps(snapshot, sort_keys=True, separators=(',', ':')).encode('utf-8') )
+    snapshotFile.close()
+    os.chmod( snapshotFile.name, 0o644 )
+    os.replace( snapshotFile.name, snapshotPath )
+
+# Load a snapshot from disk, making sure it is one we understand and that it is intact
+def load( snapshotPath ):
+    with gzip.open( snapshotPath, 'rb' ) as compressedFile:
+        snapshot = json.loads( compressedFile.read().decode('utf-8') )
+
+    if not isinstance(snapshot, dict) or snapshot.get('format') != SNAPSHOT_FORMAT:
+        raise Exception("Not a repo-metadata snapshot: {}".format(snapshotPath))
+    if snapshot.get('version') != SNAPSHOT_VERSION:
+        raise Exception("Unsupported repo-metadata snapshot version {} (expected {}): {}".format(snapshot.get('version'), SNAPSHOT_VERSION, snapshotPath))
+    if snapshot.get('contentHash') != contentHash( snapshot['projects'], snapshot['branchRules'] ):
+        raise Exception("Repo-metadata snapshot is corrupted (content hash mismatch): {}".format(snapshotPath))
+
+    return snapshot
+
+# Retrieve a snapshot given either a local path or a http(s) URL
+# Downloaded snapshots are kept in cachePath (if given) and reused as long as they are younger than maximumAge seconds
+def retrieve( location, cachePath = None, maximumAge = None ):
+    if not location.startswith('http://') and not location.startswith('https://'):
+        return load( location )
+
+    # Determine how long we may keep using a downloaded snapshot (an hour unless we have been told otherwise)
+    if maximumAge is None:
+        maximumAge = int( os.environ.get('KDECI_REPO_METADATA_SNAPSHOT_MAX_AGE', '3600') )
+
+    # Without a cache we download it every time
+    if cachePath is None:
+        cachePath = tempfile.gettempdir()
+    os.makedirs( cachePath, exist_ok=True )
+    cachedPath = os.path.join( cachePath, 'repo-metadata-snapshot-{}.json.gz'.format(hashlib.sha256(location.encode('utf-8')).hexdigest()[:16]) )
+
+    if os.path.exists( cachedPath ) and time.time() - os.path.getmtime( cachedPath ) < maximumAge:
+        try:
+            return load( cachedPath )
+        except Exception:
+            pass
+
+    downloadedFile = tempfile.NamedTemporaryFile( delete=False, dir=cachePath, prefix='.incoming-' )
+    try:
+        with urllib.request.urlopen( location ) as response:
+            downloadedFile.write( response.read() )
+        downloadedFile.close()
+        snapshot = load( downloadedFile.name )
+        os.replace( downloadedFile.name, cachedPath )
+        return snapshot
+    except Exception as e:
+        downloadedFile.close()
+        if os.path.exists( downloadedFile.name ):
+            os.remove( downloadedFile.name )
+        # An outdated snapshot is still better than not being able to build at all
+        if not os.path.exists( cachedPath ):
+            raise
+        print('## WARNING: unable to download the repo-metadata snapshot from {}, using the cached copy: {}'.format(location, e))
+        return load( cachedPath )
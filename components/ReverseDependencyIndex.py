@@ -0,0 +1,170 @@
+import os
+import json
+import hashlib
+import tempfile
+from components import CommonUtils
+
+# Bump this whenever the layout of the index changes, so old indexes are no longer used
+INDEX_FORMAT = 1
+
+# Index of which projects in a working directory (the ext_* projects of a superbuild like Krita's 3rdparty folder) depend on which
+# The index can be kept on disk: when it is updated only the projects whose configuration changed since are resolved again,
+# after which questions like "what needs to be rebuilt if X changes" are answered without looking at any configuration at all
+class ReverseDependencyIndex(object):
+
+    # Setup the index for the projects in workingDirectory, resolved for the given branch using a DependencyGraph
+    # If indexPath is given the index is loaded from (and saved to) there
+    def __init__(self, workingDirectory, dependencyGraph, branch, indexPath = None):
+        self.workingDirectory = workingDirectory
+        self.dependencyGraph = dependencyGraph
+        self.branch = branch
+        self.indexPath = indexPath
+
+        # Details of each project: the fingerprint of its configuration and its direct build dependencies
+        self.projects = {}
+        # Reverse of the above, built when first needed
+        self.dependents = None
+
+        self.key = self._indexKey()
+        self._load()
+
+    # Calculate the key of the index, covering everything besides the project configurations which influences dependency resolution
+    def _indexKey(self):
+        resolver = self.dependencyGraph.dependencyResolver
+        keySource = json.dumps( {
+            'format': INDEX_FORMAT,
+            'branch': self.branch,
+            'platform': str(resolver.platform),
+            'projects': sorted( (repositoryPath, metadata['identifier']) for repositoryPath, metadata in resolver.projects.items() ),
+            'branchRules': resolver.branchRules,
+            'globalConfiguration': fileFingerprint( os.path.join(CommonUtils.scriptsBaseDirectory(), 'config', 'global.yml') ),
+            'overrideConfiguration': fileFingerprint( os.environ.get('KDECI_GLOBAL_CONFIG_OVERRIDE_PATH', None) ),
+        }, sort_keys=True, default=str )
+        return hashlib.sha256( keySource.encode('utf-8') ).hexdigest()
+
+    def _load(self):
+        if self.indexPath is None or not os.path.exists( self.indexPath ):
+            return
+
+        try:
+            with open( self.indexPath, 'r' ) as indexFile:
+                index = json.load( indexFile )
+        except (OSError, ValueError):
+            return
+
+        if index.get('key') == self.key:
+            self.projects = index['projects']
+
+    def _save(self):
+        if self.indexPath is None:
+            return
+
+        try:
+            os.makedirs( os.path.dirname(os.path.abspath(self.indexPath)), exist_ok=True )
+            indexFile = tempfile.NamedTemporaryFile( mode='w', delete=False, dir=os.path.dirname(os.path.abspath(self.indexPath)), prefix='.incoming-' )
+            json.dump( {'key': self.key, 'projects': self.projects}, indexFile )
+            indexFile.close()
+            os.replace( indexFile.name, self.indexPath )
+        except OSError as e:
+            # Not being able to store the index only makes the next update slower
+            print('## WARNING: unable to store the reverse dependency index at {}: {}'.format(self.indexPath, e))
+
+    # Find the projects in the working directory: ext_* folders (or ext_* folders within those) containing a CMakeLists.txt
+    def _findProjects(self):
+        projects = {}
+        for entry in sorted( os.listdir(self.workingDirectory) ):
+            entryPath = os.path.join( self.workingDirectory, entry )
+            if not entry.startswith('ext_') or not os.path.isdir( entryPath ):
+                continue
+
+            if os.path.exists( os.path.join(entryPath, 'CMakeLists.txt') ):
+                projects[ entry ] = entryPath
+                continue
+
+            for subEntry in sorted( os.listdir(entryPath) ):
+                subEntryPath = os.path.join( entryPath, subEntry )
+                if subEntry.startswith('ext_') and os.path.exists( os.path.join(subEntryPath, 'CMakeLists.txt') ):
+                    projects[ subEntry ] = subEntryPath
+
+        return projects
+
+    # Bring the index up to date with the working directory, returns the projects which were (re-)resolved
+    def update(self, debug = False):
+        foundProjects = self._findProjects()
+        changedProjects = set()
+
+        # Forget about projects which disappeared
+        for projectName in list( self.projects.keys() ):
+            if projectName not in foundProjects:
+                del self.projects[ projectName ]
+                changedProjects.add( projectName )
+
+        for projectName, projectPath in foundProjects.items():
+            fingerprint = [
+                fileFingerprint( os.path.join(projectPath, '.kde-ci.yml') ),
+                fileFingerprint( os.path.join(CommonUtils.scriptsBaseDirectory(), 'config', projectName + '.yml') ),
+                projectPath,
+            ]
+            if projectName in self.projects and self.projects[ projectName ]['fingerprint'] == fingerprint:
+                continue
+
+            self.dependencyGraph.addLocalProject( projectName, projectPath )
+            dependencies = sorted( self.dependencyGraph.buildDependencies(projectName, self.branch).keys() )
+            if debug:
+                print("##  project: {} depends: {}".format(projectName, dependencies))
+
+            self.projects[ projectName ] = { 'fingerprint': fingerprint, 'dependencies': dependencies }
+            changedProjects.add( projectName )
+
+        if changedProjects:
+            self.dependents = None
+            self._save()
+
+        return changedProjects
+
+    # Retrieve the direct build dependencies of a project
+    def dependenciesOf(self, projectName):
+        if projectName not in self.projects:
+            return []
+        return self.projects[ projectName ]['dependencies']
+
+    # Retrieve the projects which directly depend on a project
+    def dependentsOf(self, projectName):
+        if self.dependents is None:
+            self.dependents = {}
+            for dependent, details in self.projects.items():
+                for dependency in details['dependencies']:
+                    self.dependents.setdefault( dependency, set() ).add( dependent )
+        return self.dependents.get( projectName, set() )
+
+    # Determine which projects are affected, directly or indirectly, by a change to the given projects (not including those projects themselves)
+    def affectedBy(self, projectNames):
+        affected = set()
+        pending = list( projectNames )
+        while pending:
+            for dependent in self.dependentsOf( pending.pop() ):
+                if dependent not in affected:
+                    affected.add( dependent )
+                    pending.append( dependent )
+        return affected - set(projectNames)
+
+    # Generate the reverse dependencies mapping (dependency -> set of projects depending on it) of the indexed projects
+    # If onlyProjects is given, only those projects (as dependents and as dependencies) are considered
+    def reverseDependencies(self, onlyProjects = None):
+        checkAllowed = lambda name: (name in onlyProjects) if not onlyProjects is None else True
+
+        reverseDeps = {}
+        for projectName, details in self.projects.items():
+            if not checkAllowed(projectName):
+                continue
+            for dependency in details['dependencies']:
+                if checkAllowed(dependency):
+                    reverseDeps.setdefault( dependency, set() ).add( projectName )
+        return reverseDeps
+
+# Cheap fingerprint of a file, which changes whenever the file is written to (or created or removed)
+def fileFingerprint( path ):
+    if path is None or not os.path.exists( path ):
+        return None
+    fileStat = os.stat( path )
+    return [ fileStat.st_mtime_ns, fileStat.st_size ]
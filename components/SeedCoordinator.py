@@ -0,0 +1,71 @@
+import os
+import json
+import time
+import socket
+
+# Coordinates a seed run shared by several machines, through marker files in a folder all of them can reach (like a shared KDECI_CACHE_PATH)
+# Every machine runs the same seed: before building a project it claims it, and once done it leaves a marker saying how the build went
+# Projects claimed by another machine are left to that machine, and anything depending on them waits until its marker shows up
+class Coordinator(object):
+
+    # Setup coordination in the given folder, which should be unique to the run (so markers of previous runs don't get in the way)
+    # A claim which hasn't been refreshed for staleAfter seconds is assumed to belong to a machine which went away, and may be taken over
+    def __init__(self, coordinationPath, staleAfter = 600):
+        self.coordinationPath = coordinationPath
+        self.staleAfter = staleAfter
+        self.node = '{}:{}'.format( socket.gethostname(), os.getpid() )
+        os.makedirs( self.coordinationPath, exist_ok=True )
+
+    def _markerPath(self, identifier, branch, kind):
+        return os.path.join( self.coordinationPath, '{}-{}.{}'.format(identifier, branch.replace('/', '-'), kind) )
+
+    # Determine how a project is doing: 'done' or 'failed' once built, 'claimed' while being built and None if nobody took it yet
+    def status(self, identifier, branch):
+        for kind in ['done', 'failed', 'claim']:
+            if os.path.exists( self._markerPath(identifier, branch, kind) ):
+                return 'claimed' if kind == 'claim' else kind
+        return None
+
+    # Try to claim a project for ourselves, returns whether we got it
+    def claim(self, identifier, branch):
+        claimPath = self._markerPath( identifier, branch, 'claim' )
+        self._releaseIfStale( claimPath )
+
+        # Creating the file exclusively is atomic, so only one machine can ever win this
+        try:
+            claimFile = os.open( claimPath, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644 )
+        except FileExistsError:
+            return False
+
+        with os.fdopen( claimFile, 'w' ) as claimFile:
+            json.dump( {'node': self.node, 'claimed': int(time.time())}, claimFile )
+        return True
+
+    # Remove a claim nobody refreshed for too long
+    def _releaseIfStale(self, claimPath):
+        try:
+            if time.time() - os.stat( claimPath ).st_mtime < self.staleAfter:
+                return
+        except FileNotFoundError:
+            return
+
+        # Several machines may notice at the same time, renaming it away first makes sure only one of them actually removes it
+        stalePath = '{}.stale-{}'.format( claimPath, self.node.replace(':', '-') )
+        try:
+            os.rename( claimPath, stalePath )
+        except FileNotFoundError:
+            return
+        print('## Taking over stale claim: {}'.format(os.path.basename(claimPath)))
+        os.remove( stalePath )
+
+    # Show the other machines we are still busy with a project we claimed
+    def refresh(self, identifier, branch):
+        try:
+            os.utime( self._markerPath(identifier, branch, 'claim') )
+        except FileNotFoundError:
+            pass
+
+    # Record the outcome of building a project we claimed, status being 'done' or 'failed'
+    def finish(self, identifier, branch, status):
+        with open( self._markerPath(identifier, branch, status), 'w' ) as markerFile:
+            json.dump( {'node': self.node, 'finished': int(time.time())}, markerFile )
@@ -0,0 +1,184 @@
+import time
+import heapq
+import concurrent.futures
+
+# How long we assume building a project takes if we don't know any better (and have nothing to go on at all)
+DEFAULT_DURATION = 600
+
+# Schedules the builds of a seed run: every project is built once all the projects of the seed it depends on have been built,
+# with as many builds running at the same time as the budget allows
+class Scheduler(object):
+
+    # Setup the scheduler for the given projects (a dictionary of identifier -> branch) and their dependencies (identifier -> dictionary of dependencies)
+    # At most parallelBuilds builds are run at once, and if a memory budget is given (in bytes) no more builds than fit in it assuming each needs memoryPerBuild
+    # If a SeedCoordinator is given the run is shared with other machines, checking in with them every pollInterval seconds
+    # If the expected durations (identifier -> seconds) of the builds are given, the projects starting the longest chains of builds are built first
+    def __init__(self, projects, dependencies, parallelBuilds = 1, memoryBudget = None, memoryPerBuild = None, coordinator = None, pollInterval = 30, durations = None):
+        self.projects = dict(projects)
+        self.parallelBuilds = max( 1, parallelBuilds )
+        self.memoryBudget = memoryBudget
+        self.memoryPerBuild = memoryPerBuild if memoryPerBuild else 0
+        self.coordinator = coordinator
+        self.pollInterval = pollInterval
+
+        # We only need to wait for dependencies this seed is building
+        # For the others we simply assume another seed job has built them
+        self.dependencies = {
+            identifier: set( dependencies.get(identifier, {}) ).intersection( self.projects.keys() ) - {identifier}
+            for identifier in self.projects
+        }
+
+        # Projects we have no duration for are assumed to take as long as the typical project does
+        knownDurations = sorted( duration for identifier, duration in (durations or {}).items() if identifier in self.projects and duration is not None )
+        typicalDuration = knownDurations[ len(knownDurations) // 2 ] if knownDurations else DEFAULT_DURATION
+        self.durations = { identifier: (durations or {}).get(identifier, None) or typicalDuration for identifier in self.projects }
+
+        # Determine the length of the longest chain of builds each project starts, including its own build
+        # Nothing depending on a project can start before it is built, so the projects with the longest chains are the ones holding up the run
+        dependents = {}
+        for identifier, projectDependencies in self.dependencies.items():
+            for dependency in projectDependencies:
+                dependents.setdefault( dependency, set() ).add( identifier )
+
+        self.criticalPath = {}
+        def chainLength(identifier):
+            if identifier not in self.criticalPath:
+                self.criticalPath[ identifier ] = self.durations[ identifier ] + max( [chainLength(dependent) for dependent in dependents.get(identifier, [])] or [0] )
+            return self.criticalPath[ identifier ]
+
+        for identifier in self.projects:
+            chainLength( identifier )
+
+        # Everything we know about the state of the run
+        self.finished = []
+        self.failed = []
+        self.pending = list( self.projects.keys() )
+        # Projects among the finished (or failed) ones which another machine built
+        self.builtElsewhere = []
+
+        # When the run started, and when each project became ready to build, started building and finished building
+        self.runStart = None
+        self.readyTimes = {}
+        self.startTimes = {}
+        self.endTimes = {}
+
+    # Determine whether we can start another build, given the builds currently running
+    def _canStartBuild(self, runningBuilds):
+        if runningBuilds >= self.parallelBuilds:
+            return False
+        if self.memoryBudget is not None and runningBuilds > 0 and (runningBuilds + 1) * self.memoryPerBuild > self.memoryBudget:
+            return False
+        return True
+
+    # Find the projects whose dependencies have all been built, those starting the longest chain of builds first
+    # Projects with chains of the same length are kept in the order they were given in
+    def readyProjects(self):
+        readyProjects = [ identifier for identifier in self.pending if self.dependencies[ identifier ].issubset( self.finished ) ]
+        return sorted( readyProjects, key=lambda identifier: -self.criticalPath[ identifier ] )
+
+    # Estimate how long (in seconds) building all pending projects will take, by playing the run through with the expected durations
+    def expectedDuration(self):
+        concurrentBuilds = self.parallelBuilds
+        if self.memoryBudget is not None and self.memoryPerBuild:
+            concurrentBuilds = max( 1, min(concurrentBuilds, self.memoryBudget // self.memoryPerBuild) )
+
+        finished = set( self.finished )
+        pending = [ identifier for identifier in self.projects if identifier in self.pending ]
+        pending.sort( key=lambda identifier: -self.criticalPath[ identifier ] )
+        runningBuilds = []
+        currentTime = 0
+
+        while pending or runningBuilds:
+            for identifier in list( pending ):
+                if len(runningBuilds) >= concurrentBuilds:
+                    break
+                if self.dependencies[ identifier ].issubset( finished ):
+                    pending.remove( identifier )
+                    heapq.heappush( runningBuilds, (currentTime + self.durations[identifier], identifier) )
+
+            # Projects depending on something which won't be built (like a failed project) never start
+            if not runningBuilds:
+                break
+
+            currentTime, identifier = heapq.heappop( runningBuilds )
+            finished.add( identifier )
+
+        return currentTime
+
+    # Catch up with what the other machines taking part in the run did
+    # Returns whether there are projects being built by them we may have to wait for
+    def _checkCoordinator(self):
+        waitingOnOthers = False
+        for identifier in list( self.pending ):
+            status = self.coordinator.status( identifier, self.projects[identifier] )
+            if status == 'done':
+                print('## Project was built by another machine: {}'.format(identifier))
+                self.pending.remove( identifier )
+                self.finished.append( identifier )
+                self.builtElsewhere.append( identifier )
+            elif status == 'failed':
+                print('## Failed building a project on another machine: {}'.format(identifier))
+                self.pending.remove( identifier )
+                self.failed.append( identifier )
+                self.builtElsewhere.append( identifier )
+            elif status == 'claimed':
+                waitingOnOthers = True
+        return waitingOnOthers
+
+    # Run the builds, buildFunction is called with the identifier and branch of each project and should raise an exception if the build fails
+    # Once a build fails no further builds are started, those already running are allowed to finish
+    # Returns whether all projects were built successfully
+    def run(self, buildFunction):
+        runningBuilds = {}
+        self.runStart = time.time()
+        with concurrent.futures.ThreadPoolExecutor( max_workers=self.parallelBuilds ) as executor:
+            while True:
+                waitingOnOthers = False
+                if self.coordinator is not None:
+                    waitingOnOthers = self._checkCoordinator()
+                    for identifier in runningBuilds.values():
+                        self.coordinator.refresh( identifier, self.projects[identifier] )
+
+                # Start everything we are allowed to start
+                if not self.failed:
+                    readyProjects = self.readyProjects()
+                    for identifier in readyProjects:
+                        self.readyTimes.setdefault( identifier, time.time() )
+
+                    for identifier in readyProjects:
+                        if not self._canStartBuild( len(runningBuilds) ):
+                            break
+                        # Another machine may have beaten us to it
+                        if self.coordinator is not None and not self.coordinator.claim( identifier, self.projects[identifier] ):
+                            waitingOnOthers = True
+                            continue
+                        self.pending.remove( identifier )
+                        self.startTimes[ identifier ] = time.time()
+                        runningBuilds[ executor.submit(buildFunction, identifier, self.projects[identifier]) ] = identifier
+
+                # Nothing running means we are either done, or stuck because of a failure
+                # Unless other machines are still building projects we are waiting for, in which case we check back on them later
+                if not runningBuilds:
+                    if waitingOnOthers and self.pending and not self.failed:
+                        time.sleep( self.pollInterval )
+                        continue
+                    break
+
+                timeout = self.pollInterval if self.coordinator is not None else None
+                completedBuilds, remainingBuilds = concurrent.futures.wait( runningBuilds.keys(), timeout=timeout, return_when=concurrent.futures.FIRST_COMPLETED )
+                for future in completedBuilds:
+                    identifier = runningBuilds.pop( future )
+                    self.endTimes[ identifier ] = time.time()
+                    try:
+                        future.result()
+                        self.finished.append( identifier )
+                        status = 'done'
+                    except Exception as e:
+                        print('## Failed building a project: {} ({})'.format(identifier, e))
+                        self.failed.append( identifier )
+                        status = 'failed'
+
+                    if self.coordinator is not None:
+                        self.coordinator.finish( identifier, self.projects[identifier], status )
+
+        return not self.failed and not self.pending
@@ -0,0 +1,59 @@
+import os
+import json
+import time
+import tempfile
+import threading
+
+# Bump this whenever the layout of the state file changes, so old state files are no longer used
+STATE_FORMAT = 1
+
+# Progress of a seed run, kept on disk so a later run can resume where it stopped
+# For every project we record the branch and Git revision it was built from, the package version that resulted from it and how the build went
+class State(object):
+
+    # Load the state from the given file, if there is one
+    # The state only applies to runs using the same options (platform, extra CMake arguments, ...), otherwise it is discarded
+    def __init__(self, statePath, options):
+        self.statePath = statePath
+        self.options = options
+        self.projects = {}
+        self.lock = threading.Lock()
+
+        if not os.path.exists( self.statePath ):
+            return
+
+        try:
+            with open( self.statePath, 'r' ) as stateFile:
+                state = json.load( stateFile )
+        except (OSError, ValueError):
+            return
+
+        if state.get('format') == STATE_FORMAT and state.get('options') == self.options:
+            self.projects = state['projects']
+
+    # Write the state back to disk, replacing the previous version atomically
+    def _save(self):
+        stateFile = tempfile.NamedTemporaryFile( mode='w', delete=False, dir=os.path.dirname(os.path.abspath(self.statePath)), prefix='.seed-state-' )
+        json.dump( {'format': STATE_FORMAT, 'options': self.options, 'projects': self.projects}, stateFile, indent = 1 )
+        stateFile.close()
+        os.replace( stateFile.name, self.statePath )
+
+    # Record the outcome of building a project, status being 'built' or 'failed'
+    # As builds may be running in parallel this can be called from several threads at once
+    def record(self, identifier, branch, gitRevision, status, packageVersion = None):
+        with self.lock:
+            self.projects[ identifier ] = {
+                'branch': branch,
+                'gitRevision': gitRevision,
+                'packageVersion': packageVersion,
+                'status': status,
+                'finished': int(time.time()),
+            }
+            self._save()
+
+    # Determine whether a project was successfully built from the given branch and Git revision
+    def isBuilt(self, identifier, branch, gitRevision):
+        details = self.projects.get( identifier, None )
+        if details is None:
+            return False
+        return details['status'] == 'built' and details['branch'] == branch and details['gitRevision'] == gitRevision
@@ -0,0 +1,245 @@
+import html
+import json
+import time
+
+# Timeline of a seed run: the phases the run went through and, for every project, when it was ready to build, when it was built and how that went
+# The timeline can be written as a Chrome trace (for chrome://tracing or https://ui.perfetto.dev) and as a static HTML Gantt chart
+class Timeline(object):
+
+    # Setup an empty timeline for a run building at most the given number of projects at once
+    def __init__(self, slots):
+        self.slots = max( 1, slots )
+        self.phases = []
+        self.builds = {}
+
+    # Record a phase of the run (cloning, resolving dependencies, building, ...)
+    def addPhase(self, name, start, end):
+        self.phases.append( {'name': name, 'start': start, 'end': end} )
+
+    # Record the build of a project
+    # waitingSince is when the project could have been built had its dependencies been ready, readyTime when they actually were
+    # If the build was broken down in phases (as a list of dictionaries with name, start and end) those are recorded as well
+    def addBuild(self, identifier, start, end, status, dependencies, waitingSince = None, readyTime = None, phases = None):
+        waitingSince = waitingSince if waitingSince is not None else start
+        readyTime = readyTime if readyTime is not None else start
+        self.builds[ identifier ] = {
+            'start': start,
+            'end': end,
+            'status': status,
+            'dependencies': sorted( dependencies ),
+            'waitingOnDependencies': max( 0, readyTime - waitingSince ),
+            'queued': max( 0, start - readyTime ),
+            'phases': phases or [],
+        }
+
+    # Find the chain of builds which determined how long the run took
+    # Starting from the build which finished last, we go back through the dependency which finished last every time, as that is what it was waiting for
+    def criticalPath(self):
+        if not self.builds:
+            return []
+
+        path = [ max( self.builds, key=lambda identifier: self.builds[identifier]['end'] ) ]
+        while True:
+            dependencies = [ dependency for dependency in self.builds[ path[-1] ]['dependencies'] if dependency in self.builds ]
+            if not dependencies:
+                break
+            path.append( max( dependencies, key=lambda identifier: self.builds[identifier]['end'] ) )
+
+        return list( reversed(path) )
+
+    # Find the periods during which fewer builds were running than could have been, as a list of (start, end, idle slots)
+    # Periods shorter than minimumLength seconds (like the moment between one build ending and the next starting) are left out
+    def idlePeriods(self, minimumLength = 1):
+        if not self.builds:
+            return []
+
+        # Go over every moment a build started or ended, keeping count of how many were running in between
+        events = []
+        for build in self.builds.values():
+            events.append( (build['start'], 1) )
+            events.append( (build['end'], -1) )
+        events.sort()
+
+        periods = []
+        runningBuilds = 0
+        for (eventTime, change), (nextTime, nextChange) in zip( events, events[1:] ):
+            runningBuilds += change
+            if nextTime <= eventTime or runningBuilds >= self.slots:
+                continue
+
+            idleSlots = self.slots - runningBuilds
+            # Merge with the previous period if it continues it
+            if periods and periods[-1][1] == eventTime and periods[-1][2] == idleSlots:
+                periods[-1] = ( periods[-1][0], nextTime, idleSlots )
+            else:
+                periods.append( (eventTime, nextTime, idleSlots) )
+
+        return [ period for period in periods if period[1] - period[0] >= minimumLength ]
+
+    # Spread the builds over rows (one per build slot) such that builds in the same row don't overlap
+    def _assignRows(self):
+        rows = {}
+        rowEnds = []
+        for identifier in sorted( self.builds, key=lambda identifier: self.builds[identifier]['start'] ):
+            build = self.builds[ identifier ]
+            for row, rowEnd in enumerate( rowEnds ):
+                if rowEnd <= build['start']:
+                    break
+            else:
+                row = len( rowEnds )
+                rowEnds.append( 0 )
+            rowEnds[ row ] = build['end']
+            rows[ identifier ] = row
+        return rows
+
+    # Determine when the timeline starts and ends
+    def _bounds(self):
+        times = [ phase['start'] for phase in self.phases ] + [ phase['end'] for phase in self.phases ]
+        times += [ build['start'] for build in self.builds.values() ] + [ build['end'] for build in self.builds.values() ]
+        if not times:
+            now = time.time()
+            return ( now, now )
+        return ( min(times), max(times) )
+
+    # Write the timeline in the Chrome trace event format
+    def writeChromeTrace(self, tracePath):
+        runStart, runEnd = self._bounds()
+        criticalPath = set( self.criticalPath() )
+        rows = self._assignRows()
+        microseconds = lambda moment: int( (moment - runStart) * 1000000 )
+
+        # The run phases, the builds (one thread per build slot) and the idle slots each get a process of their own
+        events = [
+            {'name': 'process_name', 'ph': 'M', 'pid': 1, 'args': {'name': 'Seed'}},
+            {'name': 'process_name', 'ph': 'M', 'pid': 2, 'args': {'name': 'Builds'}},
+            {'name': 'process_name', 'ph': 'M', 'pid': 3, 'args': {'name': 'Idle build slots'}},
+        ]
+
+        for phase in self.phases:
+            events.append( {'name': phase['name'], 'cat': 'phase', 'ph': 'X', 'pid': 1, 'tid': 1, 'ts': microseconds(phase['start']), 'dur': microseconds(phase['end']) - microseconds(phase['start'])} )
+
+        for row in sorted( set(rows.values()) ):
+            events.append( {'name': 'thread_name', 'ph': 'M', 'pid': 2, 'tid': row + 1, 'args': {'name': 'Slot {}'.format(row + 1)}} )
+
+        for identifier, build in self.builds.items():
+            events.append( {
+                'name': identifier,
+                'cat': 'critical' if identifier in criticalPath else 'build',
+                'ph': 'X', 'pid': 2, 'tid': rows[identifier] + 1,
+                'ts': microseconds(build['start']), 'dur': microseconds(build['end']) - microseconds(build['start']),
+                'args': {
+                    'status': build['status'],
+                    'criticalPath': identifier in criticalPath,
+                    'waitingOnDependencies': round(build['waitingOnDependencies'], 3),
+                    'queued': round(build['queued'], 3),
+                    'dependencies': build['dependencies'],
+                },
+            } )
+            for phase in build['phases']:
+                events.append( {'name': phase['name'], 'cat': 'build-phase', 'ph': 'X', 'pid': 2, 'tid': rows[identifier] + 1, 'ts': microseconds(phase['start']), 'dur': microseconds(phase['end']) - microseconds(phase['start'])} )
+
+        for start, end, idleSlots in self.idlePeriods():
+            events.append( {'name': '{} idle'.format(idleSlots), 'cat': 'idle', 'ph': 'X', 'pid': 3, 'tid': 1, 'ts': microseconds(start), 'dur': microseconds(end) - microseconds(start), 'args': {'idleSlots': idleSlots}} )
+
+        with open( tracePath, 'w' ) as traceFile:
+            json.dump( {'traceEvents': events, 'displayTimeUnit': 'ms', 'otherData': {'runStart': runStart}}, traceFile )
+
+    # Write the timeline as a static HTML page showing a Gantt chart of the run, followed by a table of the builds
+    def writeHtmlReport(self, reportPath):
+        runStart, runEnd = self._bounds()
+        runDuration = max( runEnd - runStart, 0.001 )
+        criticalPath = self.criticalPath()
+        rows = self._assignRows()
+        position = lambda start, end: 'left: {:.3f}%; width: {:.3f}%'.format( (start - runStart) * 100 / runDuration, max(end - start, 0) * 100 / runDuration )
+        formatDuration = lambda seconds: '{}:{:02d}:{:02d}'.format( int(seconds // 3600), int(seconds % 3600 // 60), int(seconds % 60) )
+
+        chartRows = []
+        chartRows.append( ('Seed', [ '<div class="bar phase" style="{}" title="{}">{}</div>'.format(
+            position(phase['start'], phase['end']),
+            html.escape('{}: {}'.format(phase['name'], formatDuration(phase['end'] - phase['start']))),
+            html.escape(phase['name'])
+        ) for phase in self.phases ]) )
+
+        for row in range( max(rows.values(), default=-1) + 1 ):
+            bars = []
+            for identifier, build in self.builds.items():
+                if rows[ identifier ] != row:
+                    continue
+                classes = ['bar', build['status']]
+                if identifier in criticalPath:
+                    classes.append('critical')
+                bars.append( '<div class="{}" style="{}" title="{}">{}</div>'.format(
+                    ' '.join(classes),
+                    position(build['start'], build['end']),
+                    html.escape('{}: {} ({}), waited {} on dependencies, queued {}'.format(identifier, formatDuration(build['end'] - build['start']), build['status'], formatDuration(build['waitingOnDependencies']), formatDuration(build['queued']))),
+                    html.escape(identifier)
+                ) )
+            chartRows.append( ('Slot {}'.format(row + 1), bars) )
+
+        chartRows.append( ('Idle', [ '<div class="bar idle" style="{}" title="{}"></div>'.format(
+            position(start, end),
+            html.escape('{} idle build slots for {}'.format(idleSlots, formatDuration(end - start)))
+        ) for start, end, idleSlots in self.idlePeriods() ]) )
+
+        tableRows = []
+        for identifier in sorted( self.builds, key=lambda identifier: self.builds[identifier]['start'] ):
+            build = self.builds[ identifier ]
+            tableRows.append( '<tr{}><td>{}</td><td>{}</td><td>{}</td><td>{}</td><td>{}</td><td>{}</td><td>{}</td></tr>'.format(
+                ' class="critical"' if identifier in criticalPath else '',
+                html.escape(identifier),
+                html.escape(build['status']),
+                formatDuration(build['start'] - runStart),
+                formatDuration(build['end'] - build['start']),
+                formatDuration(build['waitingOnDependencies']),
+                formatDuration(build['queued']),
+                html.escape(', '.join('{} {}'.format(phase['name'], formatDuration(phase['end'] - phase['start'])) for phase in build['phases'])),
+            ) )
+
+        idleTime = sum( (end - start) * idleSlots for start, end, idleSlots in self.idlePeriods() )
+        report = HTML_TEMPLATE.format(
+            generated=html.escape( time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(runStart)) ),
+            duration=formatDuration( runDuration ),
+            slots=self.slots,
+            idleTime=formatDuration( idleTime ),
+            criticalPath=html.escape( ' -> '.join(criticalPath) ),
+            chart='\n'.join( '<div class="row"><div class="label">{}</div><div class="lane">{}</div></div>'.format(html.escape(label), ''.join(bars)) for label, bars in chartRows ),
+            table='\n'.join( tableRows ),
+        )
+
+        with open( reportPath, 'w' ) as reportFile:
+            reportFile.write( report )
+
+HTML_TEMPLATE = """<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<title>Seed timeline</title>
+<style>
+body {{ font-family: sans-serif; font-size: 13px; }}
+.row {{ display: flex; height: 22px; margin-bottom: 2px; }}
+.label {{ width: 80px; flex: none; }}
+.lane {{ position: relative; flex: auto; background: #f4f4f4; }}
+.bar {{ position: absolute; top: 0; bottom: 0; overflow: hidden; white-space: nowrap; font-size: 11px; line-height: 22px; box-sizing: border-box; border-right: 1px solid #fff; }}
+.phase {{ background: #9bb7d4; }}
+.done {{ background: #8fc98f; }}
+.failed {{ background: #e08080; }}
+.skipped {{ background: #d0d0d0; }}
+.bar.critical {{ background: #f0a030; }}
+.idle {{ background: repeating-linear-gradient(45deg, #e0e0e0, #e0e0e0 4px, #f8f8f8 4px, #f8f8f8 8px); }}
+table {{ border-collapse: collapse; margin-top: 20px; }}
+td, th {{ border: 1px solid #ccc; padding: 2px 6px; text-align: left; }}
+tr.critical {{ background: #fbe3c0; }}
+</style>
+</head>
+<body>
+<h1>Seed timeline</h1>
+<p>Started {generated}, took {duration} with {slots} build slots. Build slot time left idle: {idleTime}.</p>
+<p>Critical path (highlighted): {criticalPath}</p>
+{chart}
+<table>
+<tr><th>Project</th><th>Status</th><th>Started after</th><th>Build</th><th>Waiting on dependencies</th><th>Queued</th><th>Phases</th></tr>
+{table}
+</table>
+</body>
+</html>
+"""
@@ -0,0 +1,24 @@
+#!/usr/bin/python3
+import os
+import sys
+import argparse
+from components import CommonUtils, RepoMetadataSnapshot
+
+# Capture our command line parameters
+parser = argparse.ArgumentParser(description='Utility to generate a repo-metadata snapshot, usable by run-ci-build.py through KDECI_REPO_METADATA_SNAPSHOT instead of a repo-metadata checkout')
+parser.add_argument('--repo-metadata', type=str, default=os.environ.get('KDECI_REPO_METADATA_PATH', os.path.join(CommonUtils.scriptsBaseDirectory(), 'repo-metadata')))
+parser.add_argument('--output', type=str, required=True)
+arguments = parser.parse_args()
+
+# Gather everything up...
+snapshot = RepoMetadataSnapshot.create( os.path.join(arguments.repo_metadata, 'projects-invent'), os.path.join(arguments.repo_metadata, 'branch-rules.yml') )
+
+# And write it out
+RepoMetadataSnapshot.write( snapshot, arguments.output )
+
+print('## Generated repo-metadata snapshot: {}'.format(arguments.output))
+print('##    revision: {}'.format(snapshot['revision']))
+print('##    content hash: {}'.format(snapshot['contentHash']))
+print('##    projects: {}'.format(len(snapshot['projects'])))
+
+sys.exit(0)
@@ -2,18 +2,15 @@
 import os
 import sys
 import yaml
-import tarfile
 import tempfile
 import argparse
 import subprocess
 import multiprocessing
-from components import CommonUtils, Package, EnvironmentHandler, TestHandler, PlatformFlavor, EnvFileUtils, MergeFolders
+from components import CommonUtils, Package, EnvironmentHandler, TestHandler, PlatformFlavor, EnvFileUtils, MergeFolders, DependencyUnpacker, PackageStore, PrefixSnapshot, InstallDatabase, LeakDetector, DependencyGraph, Jobserver, PhaseTimer
 from components.CiConfigurationUtils import *
 import shutil
 import copy
 import time
-import datetime
-import json
 
 # Capture our command line parameters
 parser = argparse.ArgumentParser(description='Utility to perform a CI run for a KDE project.')
@@ -107,16 +104,34 @@ if configuration['Options']['in-source-build']:
 # Determine where to unpack the dependencies to
 installPath = os.path.join( baseWorkDirectoryPath, '_install' )
 
+# When the install directory is shared between builds we keep track of which package installed which files
+installDatabase = None
+
 if 'KDECI_SHARED_INSTALL_PATH' in os.environ:
     installPath = os.environ['KDECI_SHARED_INSTALL_PATH']
+    installDatabase = InstallDatabase.Database(installPath)
 
 # Determine where we will stage the installation
 installStagingPath = os.path.join( baseWorkDirectoryPath, '_staging' )
 
+####
+# Keep track of how long each phase of the build takes
+####
+
+# The timings are written next to the sources when we exit (so Gitlab can keep them as job artifacts), unless we've been told to put them elsewhere
+timingsPath = os.environ.get('KDECI_TIMINGS_PATH', sourcesPath)
+phaseTimer = PhaseTimer.PhaseTimer( os.path.join(timingsPath, 'ci-timings-trace.json'), os.path.join(timingsPath, 'ci-timings-summary.json'), {
+    'project': arguments.project,
+    'branch': arguments.branch,
+    'platform': str(platform),
+})
+
 ####
 # Fetch project sources
 ####
 
+phaseTimer.begin('git fetch')
+
 # In order to resolve project dependencies later, we need to ensure all remote refs have been fetched
 if 'CI_REPOSITORY_URL' in os.environ and os.path.exists('.git/shallow'):
     subprocess.check_call("git fetch --quiet --unshallow --tags {0} +refs/heads/*:refs/heads/*".format(os.environ['CI_REPOSITORY_URL']), shell=True)
@@ -128,6 +143,7 @@ elif 'CI_REPOSITORY_URL' in os.environ:
 ####
 
 # Bring our dependency resolver online...
+phaseTimer.begin('resolver startup')
 dependencyResolver = prepareDependenciesResolver(platform)
 
 defaultBuildType = 'Debug'
@@ -157,51 +173,103 @@ if not (arguments.skip_dependencies_fetch and arguments.only_build):
     gitlabInstance = os.environ.pop('KDECI_GITLAB_SERVER')
 
     # Bring the package archive up
+    phaseTimer.begin('registry open')
     packageRegistry = Package.Registry( localCachePath, gitlabInstance, gitlabToken, packageProject )
 
     ####
     # Now resolve both build and runtime dependencies, then fetch the build dependencies!
     ####
 
+    phaseTimer.begin('dependency resolution')
+
+    # Everything shares a single dependency graph, which knows about our checkout and uses the registry for everything else
+    dependencyGraph = DependencyGraph.Graph( dependencyResolver, packageRegistry=packageRegistry )
+    dependencyGraph.addLocalProject( arguments.project, sourcesPath, configuration )
+
     # Resolve the dependencies of this project
-    projectBuildDependencies = dependencyResolver.resolve( configuration['Dependencies'], arguments.branch )
+    projectBuildDependencies = dependencyGraph.buildDependencies( arguments.project, arguments.branch )
     # As well as the runtime dependencies
-    projectRuntimeDependencies = dependencyResolver.resolve( configuration['RuntimeDependencies'], arguments.branch )
+    projectRuntimeDependencies = dependencyGraph.runtimeDependencies( arguments.project, arguments.branch )
 
 dependenciesToUnpack = []
+restoredFromSnapshot = False
+prefixSnapshotCache = None
 
 if not arguments.skip_dependencies_fetch:
+    phaseTimer.begin('dependency fetch')
+
     # skip retrieving dependencies which are already prepared
     dependenciesToRetrieve = \
         projectBuildDependencies \
         if arguments.skip_deps is None \
         else dict(item for item in projectBuildDependencies.items() if item[0] not in arguments.skip_deps)
 
-    # Now we can retrieve the build time dependencies
-    allDependencies = packageRegistry.retrieveDependencies( dependenciesToRetrieve )
-
-    dependenciesToUnpack = \
-        allDependencies \
-        if arguments.skip_deps is None \
-        else [item for item in allDependencies if item[1]['identifier'] not in arguments.skip_deps]
+    # Jobs resolving exactly the same set of package versions can share a snapshot of the assembled install directory
+    # Snapshots can only be restored into an empty install directory, so they are never used with a shared one
+    if 'KDECI_PREFIX_SNAPSHOT_PATH' in os.environ and not 'KDECI_SHARED_INSTALL_PATH' in os.environ:
+        if os.path.exists(installPath) and os.listdir(installPath):
+            print('## Not using prefix snapshots as the install directory is not empty: {}'.format(installPath))
+        else:
+            prefixSnapshotCache = PrefixSnapshot.SnapshotCache(os.environ['KDECI_PREFIX_SNAPSHOT_PATH'])
+
+    if prefixSnapshotCache is not None:
+        # Determine which package versions we need, this only requires their metadata
+        neededPackages = packageRegistry.retrieveDependencies( dependenciesToRetrieve, onlyMetadata=True )
+        if not arguments.skip_deps is None:
+            neededPackages = [item for item in neededPackages if item[1]['identifier'] not in arguments.skip_deps]
+
+        snapshotFingerprint = prefixSnapshotCache.fingerprint([packageMetadata for c, packageMetadata, s in neededPackages], platform)
+
+        phaseTimer.begin('unpack')
+        if prefixSnapshotCache.restore(snapshotFingerprint, installPath):
+            print('## Restored install directory from prefix snapshot: {}'.format(snapshotFingerprint))
+            dependenciesToUnpack = neededPackages
+            restoredFromSnapshot = True
+        else:
+            print('## No prefix snapshot available yet: {}'.format(snapshotFingerprint))
+
+# When a package store is available on this runner, packages are extracted there once and then linked into the install directory
+packageStore = None
+if 'KDECI_PACKAGE_STORE_PATH' in os.environ:
+    packageStore = PackageStore.Store(os.environ['KDECI_PACKAGE_STORE_PATH'])
+    print('## Using package store: {}'.format(packageStore.storePath))
+
+# Install the given packages (as returned by Package.Registry) into the install directory, kind being what they are for ('build' or 'runtime')
+# Packages are unpacked level by level in dependency order, members of the same level don't depend on each other so each level is unpacked concurrently
+def installPackages(packages, kind):
+    # packages which are already installed in the right version don't need to be touched again
+    packagesToInstall = packages
+
+    if installDatabase is not None:
+        packagesToInstall = []
+        with installDatabase.locked():
+            for item in packages:
+                projectId = item[1]['identifier']
+                installedVersion = installDatabase.installedVersion(projectId)
+
+                if installedVersion == item[1]['version']:
+                    print('## Dependency is already installed: {} ({})'.format(projectId, installedVersion))
+                    continue
+
+                if installedVersion is not None:
+                    # remove the files of the previous version, so only what changed is touched
+                    print('## Replacing installed dependency: {} ({} -> {})'.format(projectId, installedVersion, item[1]['version']))
+                    installDatabase.remove(projectId)
+
+                packagesToInstall.append(item)
 
     # sort the dependencies in the correct order
-
+    # dependencies we are not installing here (skipped, already installed or not needed) are there already as far as we are concerned
+    identifiersToInstall = set(packageMetadata['identifier'] for packageContents, packageMetadata, cacheStatus in packagesToInstall)
     projectToDepMap = []
 
-    for packageContents, packageMetadata, cacheStatus in dependenciesToUnpack:
+    for packageContents, packageMetadata, cacheStatus in packagesToInstall:
         projectId = packageMetadata['identifier']
-        deps = packageMetadata['dependencies']
-        projectToDepMap.append((projectId, list(deps.keys())))
-
-    # for project, deps in projectToDepMap:
-    #     print (f'{project}: {deps}')
+        deps = [dep for dep in packageMetadata['dependencies'].keys() if dep in identifiersToInstall]
+        projectToDepMap.append((projectId, deps))
 
     providedDeps = []
-    installDepsOrder = []
-
-    if not arguments.skip_deps is None:
-        providedDeps.extend(arguments.skip_deps)
+    installDepsLevels = []
 
     while projectToDepMap:
         batchToInstall = []
@@ -209,36 +277,51 @@ if not arguments.skip_dependencies_fetch:
             if all(dep in providedDeps for dep in deps):
                 batchToInstall.append(project)
 
+        if not batchToInstall:
+            raise Exception("Circular dependencies between the {} dependencies: {}".format(kind, ', '.join(project for project, deps in projectToDepMap)))
+
         projectToDepMap = [(project, dep)
                         for project,dep in projectToDepMap
                         if not project in batchToInstall]
 
-        installDepsOrder.extend(batchToInstall)
+        installDepsLevels.append(batchToInstall)
         providedDeps.extend(batchToInstall)
 
     # And then unpack them
-    for project in installDepsOrder:
-        packageContents, packageMetadata, cacheStatus = \
-            next((c,m,s) for c,m,s in dependenciesToUnpack if m['identifier'] == project)
+    for level, batchToInstall in enumerate(installDepsLevels):
+        packagesToUnpack = [next((c,m,s) for c,m,s in packagesToInstall if m['identifier'] == project)
+                            for project in batchToInstall]
+
+        DependencyUnpacker.unpackLevel(packagesToUnpack, installPath, level, packageStore, installDatabase)
+
+if not arguments.skip_dependencies_fetch and not restoredFromSnapshot:
+    # Now we can retrieve the build time dependencies
+    phaseTimer.begin('dependency fetch')
+    allDependencies = packageRegistry.retrieveDependencies( dependenciesToRetrieve )
+    phaseTimer.begin('unpack')
 
-        print('## Unpacking dependency: {} ({})'.format(packageMetadata['identifier'], cacheStatus.name))
+    dependenciesToUnpack = \
+        allDependencies \
+        if arguments.skip_deps is None \
+        else [item for item in allDependencies if item[1]['identifier'] not in arguments.skip_deps]
 
-        # Open the archive file
-        archive = tarfile.open( name=packageContents, mode='r' )
+    installPackages(dependenciesToUnpack, 'build')
 
-        with tempfile.TemporaryDirectory() as tmpDir:
-            # Extract it's contents into a temporary directory
-            archive.extractall( path=tmpDir )
-            # Merge it into the install directory
-            MergeFolders.merge_folders(tmpDir, installPath, move_files=True)
+    # Save the result so the next job using the same dependencies doesn't have to do all of this again
+    if prefixSnapshotCache is not None and dependenciesToUnpack:
+        print('## Creating prefix snapshot: {}'.format(snapshotFingerprint))
+        prefixSnapshotCache.store(snapshotFingerprint, installPath)
 
 if arguments.only_deps:
+    phaseTimer.end()
     sys.exit(0)
 
 ####
 # Perform final steps needed to get ready to start the build process
 ####
 
+phaseTimer.begin('environment')
+
 # Determine what our build environment should be comprised of....
 buildEnvironment = EnvironmentHandler.generateFor( installPrefix=installPath )
 
@@ -337,6 +420,7 @@ if not arguments.env is None or arguments.only_env:
                               buildEnvironment)
     if arguments.only_env:
         print("## env file generated, exiting...")
+        phaseTimer.end()
         sys.exit(0)
 
 print("## Starting build process...")
@@ -345,6 +429,8 @@ print("## Starting build process...")
 # Configure the project!
 ####
 
+phaseTimer.begin('configure')
+
 # Begin building up our configure command
 # There are some parameters which are universal to all platforms..
 cmakeCommand = [
@@ -454,12 +540,35 @@ except Exception:
 # Compile the project!!
 ####
 
-beforeInstallTimestamp = datetime.datetime.now().timestamp()
+phaseTimer.begin('build')
+
+# Take note of what the install directory looks like, so we can find out whether the build installed anything into it directly
+# In a shared install directory the install database tells us which folders there are, and which files a previous build of ours installed
+leakSnapshotStart = time.time()
+leakSnapshot = LeakDetector.DirectorySnapshot(installPath, installDatabase, arguments.project)
+print("## Took a snapshot of the install directory in {:.2f}s".format(time.time() - leakSnapshotStart))
 
 # Determine the appropriate number of CPU cores we should use when running builds
-cpuCount = int(multiprocessing.cpu_count())
+# When several builds share the machine (like in a parallel seed run) we will have been told how many are ours
+cpuCount = int(os.environ.get('KDECI_BUILD_PARALLELISM', multiprocessing.cpu_count()))
 
 makeCommand = "cmake --build . --parallel {cpuCount} --target {customTarget}"
+compileEnvironment = buildEnvironment
+
+# If we have been given a jobserver, make/ninja take their jobs from it rather than us telling them how many to run
+# That way builds sharing the machine together never run more jobs than the jobserver allows
+if 'KDECI_JOBSERVER_FIFO' in os.environ:
+    jobserverSupported, buildTool = Jobserver.buildToolSupportsJobserver(buildPath)
+    if jobserverSupported:
+        print("## Using jobserver {} ({})".format(os.environ['KDECI_JOBSERVER_FIFO'], buildTool))
+        makeCommand = "cmake --build . --target {customTarget}"
+        compileEnvironment = dict(buildEnvironment)
+        compileEnvironment.pop('CMAKE_BUILD_PARALLEL_LEVEL', None)
+        compileEnvironment['MAKEFLAGS'] = Jobserver.makeflags(os.environ['KDECI_JOBSERVER_FIFO'], cpuCount)
+    else:
+        # Without the jobserver nothing limits the number of jobs of all builds together, so we fall back to the share of the cores we've been given, if any
+        cpuCount = int(os.environ.get('KDECI_JOBSERVER_FALLBACK_PARALLELISM', cpuCount))
+        print("## WARNING: not using jobserver {}, it is not supported by {}, running {} jobs".format(os.environ['KDECI_JOBSERVER_FIFO'], buildTool, cpuCount))
 
 # Finalise the command we will be running
 commandToRun = makeCommand.format( cpuCount=cpuCount, maximumLoad=cpuCount+1, customTarget = buildTarget )
@@ -467,7 +576,7 @@ commandToRun = makeCommand.format( cpuCount=cpuCount, maximumLoad=cpuCount+1, cu
 # Compile the project
 try:
     print( "## RUNNING: " + commandToRun )
-    subprocess.check_call( commandToRun, stdout=sys.stdout, stderr=sys.stderr, shell=True, cwd=buildPath, env=buildEnvironment )
+    subprocess.check_call( commandToRun, stdout=sys.stdout, stderr=sys.stderr, shell=True, cwd=buildPath, env=compileEnvironment )
 except Exception:
     print("## Failed to build the project")
     sys.exit(1)
@@ -477,6 +586,7 @@ except Exception:
 ####
 
 if run_tests and configuration['Options']['test-before-installing']:
+    phaseTimer.begin('tests')
     # Run the tests!
     print("## RUNNING PROJECT TESTS")
     testResult = TestHandler.run( configuration, sourcesPath, buildPath, installPath, buildEnvironment )
@@ -488,6 +598,8 @@ if run_tests and configuration['Options']['test-before-installing']:
 # Install the project...
 ####
 
+phaseTimer.begin('install')
+
 # Set the appropriate environment variables to ensure we can capture make install's output later on
 buildEnvironment['DESTDIR'] = installStagingPath
 buildEnvironment['INSTALL_ROOT'] = installStagingPath
@@ -513,6 +625,8 @@ except Exception:
 # Run post-install scripts
 ####
 
+phaseTimer.begin('post-install scripts')
+
 scriptsAllowed = None
 
 if 'KDECI_POST_INSTALL_SCRIPTS_FILTER' in os.environ:
@@ -545,27 +659,30 @@ for name, script in configuration['PostInstallScripts'].items():
         print("## Failed to run post-install script the project")
         sys.exit(1)
 
-leakedFiles = []
-
-for root, dirs, files in os.walk(installPath):
-    for name in files:
-        filePath = os.path.join(root, name)
-        fileTimeStamp = os.path.getctime(filePath)
-        #print("file: {} timestamp: {}".format(filePath, fileTimeStamp))
-        if fileTimeStamp > beforeInstallTimestamp:
-            leakedFiles.append(filePath)
+# Only folders which changed since the snapshot are listed again, files other packages sharing the install directory provide are ignored
+# Other builds register their files while holding the lock of the install database, so we hold it as well to see their files with an owner
+phaseTimer.begin('leak check')
+leakCheckStart = time.time()
+if installDatabase is not None:
+    with installDatabase.locked():
+        leakedFiles = leakSnapshot.findLeakedFiles(installDatabase, arguments.project)
+else:
+    leakedFiles = leakSnapshot.findLeakedFiles()
+print("## Checked for leaked files in {:.2f}s".format(time.time() - leakCheckStart))
 
 if leakedFiles:
     print("## ERROR: some files seem to have been installed bypassing the _staging directory ($DESTDIR environment variable)!")
-    print("##  timestamp: {}".format(time.asctime(time.localtime(beforeInstallTimestamp))))
+    print("##  timestamp: {}".format(time.asctime(time.localtime(leakSnapshot.timestamp))))
     for filePath in leakedFiles:
-        print("##  leaked file: {}, {}".format(filePath, time.asctime(time.localtime(os.path.getctime(filePath)))))
+        print("##  leaked file: {}, {}".format(filePath, time.asctime(time.localtime(os.lstat(filePath).st_ctime))))
     if arguments.fail_on_leaked_stage_files:
         print('## Exiting... (\'--fail-on-leaked-stage-files\' is set)')
         sys.exit(1)
     else:
         print('## Ignoring... (set \'--fail-on-leaked-stage-files\' to fail on leaked files)')
 
+phaseTimer.begin('install checks')
+
 if configuration['Options']['pkg-config-sanity-check'] != 'none':
     commandToRun = '{} -u {} --prefix {} --destdir {} {}'.format(
         sys.executable,
@@ -616,80 +733,114 @@ if useCcacheForBuilds:
 # Capture the installation if needed and deploy the staged install to the final install directory
 ####
 
+phaseTimer.begin('deploy')
+
 # We want to capture the tree as it is inside the install directory and don't want any trailing slashes in the archive as this isn't standards compliant
 # Therefore we list everything in the install directory and add each of those to the archive, rather than adding the whole install directory
 filesToInclude = os.listdir( pathToArchive )
 
+# Are we supposed to be publishing this particular package to the archive?
+publishPackage = (gitlabToken is not None or arguments.publish_to_cache) and not arguments.skip_publishing
+
+# Determine how the staged files get into the installation directory
+# When both are on the same filesystem we can avoid copying any data: files are hardlinked if the staging directory is still needed
+# to build the package archive, or simply moved over otherwise. 'copy' and 'hardlink' can be forced with KDECI_DEPLOY_MODE
+deployMode = os.environ.get('KDECI_DEPLOY_MODE', 'auto')
+if deployMode == 'auto':
+    os.makedirs(installPath, exist_ok=True)
+    if os.stat(pathToArchive).st_dev != os.stat(installPath).st_dev:
+        deployMode = 'copy'
+    elif publishPackage:
+        deployMode = 'hardlink'
+    else:
+        deployMode = 'move'
+
 # Copy the files into the installation directory
 # This is so later tests can rely on the project having been installed
 # While we ran 'make install' just before this didn't install it as we diverted the installation to allow us to cleanly capture it
-for filename in filesToInclude:
-    fullPath = os.path.join(pathToArchive, filename)
-    print("Copying {} -> {}".format(fullPath, os.path.join(installPath, filename)))
-    if os.path.isdir(fullPath):
-        dstFullPath = os.path.join(installPath, filename)
-        MergeFolders.merge_folders(fullPath, dstFullPath)
-    else:
-        shutil.copy2(fullPath, os.path.join(installPath, filename))
+def deployStagedFiles():
+    for filename in filesToInclude:
+        fullPath = os.path.join(pathToArchive, filename)
+        print("Deploying ({}) {} -> {}".format(deployMode, fullPath, os.path.join(installPath, filename)))
+        if os.path.isdir(fullPath):
+            dstFullPath = os.path.join(installPath, filename)
+            MergeFolders.merge_folders(fullPath, dstFullPath, move_files=(deployMode == 'move'), link_files=(deployMode == 'hardlink'))
+        else:
+            MergeFolders.transfer_file(fullPath, os.path.join(installPath, filename), move_files=(deployMode == 'move'), link_files=(deployMode == 'hardlink'))
+
+# In a shared install directory, get rid of whatever a previous build of this project installed first and register what we have installed afterwards
+# Locally built projects get a version which never matches a package
+# The database stays locked throughout, as other builds sharing the install directory would otherwise take our files for leaked ones
+if installDatabase is not None:
+    stagedFiles = InstallDatabase.listFiles(pathToArchive)
+    with installDatabase.locked():
+        installDatabase.remove(arguments.project)
+        deployStagedFiles()
+        installDatabase.record(arguments.project, 'local-{}'.format(os.environ.get('CI_COMMIT_SHA', 'unknown')), stagedFiles)
+else:
+    deployStagedFiles()
 
 # Are we supposed to be publishing this particular package to the archive?
-if (gitlabToken is not None or arguments.publish_to_cache) and not arguments.skip_publishing:
-    # Create a temporary file, then open the file as a tar archive for writing
-    # We don't want it to be deleted as storePackage will move the archive into it's cache
-    archiveFile = tempfile.NamedTemporaryFile(delete=False)
-    archive = tarfile.open( fileobj=archiveFile, mode='w' )
+if publishPackage:
+    phaseTimer.begin('packaging')
 
-    # Add all the files which need to be in the archive into the archive
-    for filename in filesToInclude:
-        fullPath = os.path.join(pathToArchive, filename)
-        archive.add( fullPath, arcname=filename, recursive=True )
+    # Describe what the package contains, so consumers don't need to open the archive to find out
+    # This also tells us whether anything changed since the last time the package was published
+    packageManifest = Package.generateManifest(pathToArchive)
+    packageContentHash = Package.contentHash(packageManifest, projectBuildDependencies, projectRuntimeDependencies)
 
-    # Close the archive, which will write it out to disk, finishing what we need to do here
-    archive.close()
+    # Create a temporary file, then write a reproducible archive of everything which needs to be in the package into it
+    # We don't want it to be deleted as storePackage will move the archive into it's cache
+    archiveFile = tempfile.NamedTemporaryFile(delete=False)
+    Package.createArchive( archiveFile, pathToArchive, filesToInclude, Package.archiveTimestamp(sourcesPath) )
     archiveFile.close()
 
     # With the archive being generated, we can now prepare some metadata...
     packageMetadata = {
         'dependencies': projectBuildDependencies,
-        'runtime-dependencies': projectRuntimeDependencies
+        'runtime-dependencies': projectRuntimeDependencies,
+        'manifest': packageManifest,
+        'contentHash': packageContentHash
     }
 
+    phaseTimer.begin('upload')
+
     if gitlabToken is not None:
         # Grab the Git revision (SHA-1 hash) we are building
         # This is always present in Gitlab CI builds
         gitRevision = os.environ['CI_COMMIT_SHA']
 
-        print('## Publishing package: {} branch: {} sha1: {}'.format(arguments.project, arguments.branch, gitRevision))
-        print('##    metadata: {}'.format(packageMetadata))
+        # Publishing a package identical to the newest one would only make everyone downstream fetch it again
+        if packageRegistry.hasContentHash(arguments.project, arguments.branch, packageContentHash):
+            print('## Skipping publishing of unchanged package: {} branch: {} content hash: {}'.format(arguments.project, arguments.branch, packageContentHash))
+            # The existing package now represents this revision as well
+            if packageRegistry.recordGitRevision(arguments.project, arguments.branch, gitRevision):
+                print('##    recorded revision {} for the existing package'.format(gitRevision))
+        else:
+            print('## Publishing package: {} branch: {} sha1: {}'.format(arguments.project, arguments.branch, gitRevision))
+            print('##    metadata: {}'.format({key: value for key, value in packageMetadata.items() if key != 'manifest'}))
 
-        # Publish our package to the registry
-        packageRegistry.upload(archiveFile.name, arguments.project, arguments.branch, gitRevision, packageMetadata)
+            # Publish our package to the registry
+            packageRegistry.upload(archiveFile.name, arguments.project, arguments.branch, gitRevision, packageMetadata)
 
     if arguments.publish_to_cache:
-        packageNameFile = '{}-{}.tar'.format(arguments.project, arguments.branch)
-        packageMetadataFile = '{}-{}.json'.format(arguments.project, arguments.branch)
-
-        normalisedBranch = packageRegistry._normaliseBranchName(arguments.branch)
-
-        packageTimestamp = int( os.path.getmtime(archiveFile.name) )
-        versionForGitlab = "{0}-{1}".format(normalisedBranch, packageTimestamp)
-
         gitRevision = os.environ.get('CI_COMMIT_SHA', 'unknown')
-        fullPackageMetadata = packageRegistry.generateMetadata(archiveFile.name, arguments.project, arguments.branch, gitRevision, packageMetadata)
 
-        print('## Copying package to chache: {} branch: {}'.format(arguments.project, arguments.branch))
-        print('##    metadata: {}'.format(fullPackageMetadata))
-        print('##    package file: {}'.format(packageNameFile))
-        print('##    location: {}'.format(localCachePath))
-
-        shutil.copy2(archiveFile.name, os.path.join(localCachePath, packageNameFile))
-        with open(os.path.join(localCachePath, packageMetadataFile), 'w') as f:
-            f.write(json.dumps(fullPackageMetadata, indent = 4))
+        # The cache is left alone if it already holds a package with the same contents, replacing it would invalidate it for everyone using it
+        # Only the revision the cached package represents is updated in that case
+        fullPackageMetadata = packageRegistry.storeInCache(archiveFile.name, arguments.project, arguments.branch, gitRevision, packageMetadata)
+        if fullPackageMetadata is None:
+            print('## Skipping copying of unchanged package to cache: {} branch: {} content hash: {}'.format(arguments.project, arguments.branch, packageContentHash))
+        else:
+            print('## Copied package to cache: {} branch: {}'.format(arguments.project, arguments.branch))
+            print('##    metadata: {}'.format({key: value for key, value in fullPackageMetadata.items() if key != 'manifest'}))
+            print('##    location: {}'.format(localCachePath))
 
     # Cleanup the temporary archive file as it is no longer needed
     os.remove( archiveFile.name )
 
 if removeInstallFoldersAfterBuild:
+    phaseTimer.begin('cleanup')
     print('## Removing install folder: {}'.format(installPath))
     shutil.rmtree(installPath)
     print('## Removing staging folder: {}'.format(installStagingPath))
@@ -697,20 +848,20 @@ if removeInstallFoldersAfterBuild:
 
 # If this is a build only run then bail here
 if arguments.only_build:
+    phaseTimer.end()
     sys.exit(0)
 
 ####
 # Retrieve runtime dependencies if they are needed, and rebuild our environment
 ####
 
-# Now we can retrieve the build time dependencies
+phaseTimer.begin('runtime dependencies')
+
+# Now we can retrieve the runtime dependencies
 dependenciesToUnpack = packageRegistry.retrieveDependencies( projectRuntimeDependencies, runtime=True )
-# And then unpack them
-for packageContents, packageMetadata, cacheStatus in dependenciesToUnpack:
-    # Open the archive file
-    archive = tarfile.open( name=packageContents, mode='r' )
-    # Extract it's contents into the install directory
-    archive.extractall( path=installPath )
+# And then unpack them, the same way as the build dependencies as most of them are installed already
+# Extracting them over those would write through the links into the package store, and leave them out of the install database
+installPackages(dependenciesToUnpack, 'runtime')
 
 # Regenerate our environment in case the newly installed software uses directories previously not used
 buildEnvironment = EnvironmentHandler.generateFor( installPrefix=installPath )
@@ -725,6 +876,7 @@ for key, value in configuration['Environment'].items():
 ####
 
 if run_tests and not configuration['Options']['test-before-installing']:
+    phaseTimer.begin('tests')
     # Run the tests!
     print("## RUNNING PROJECT TESTS")
     testResult = TestHandler.run( configuration, sourcesPath, buildPath, installPath, buildEnvironment )
@@ -740,6 +892,7 @@ if run_tests and not configuration['Options']['test-before-installing']:
 # If we aren't running on Linux then we skip this, as we consider that to be the canonical platform for code coverage...
 # Additionally, as coverage information requires tests to have been run, skip extracting coverage information if tests have been disabled
 if run_tests and useCoverageBuild:
+    phaseTimer.begin('coverage')
     # Determine the command we need to run
     # We ask GCovr to exclude the build directory by default as we don't want generated artifacts (like moc files) getting included as well
     # Sometimes projects will want to customise things slightly so we provide for that as well
@@ -758,5 +911,6 @@ if run_tests and useCoverageBuild:
 # Run complete!
 ####
 
+phaseTimer.end()
 print("## CI Run Completed Successfully!")
 sys.exit(0)
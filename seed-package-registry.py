@@ -1,11 +1,15 @@
 #!/usr/bin/python3
 import os
 import sys
-import copy
+import json
+import time
 import yaml
 import argparse
+import threading
 import subprocess
-from components import CommonUtils, Dependencies, PlatformFlavor, Package
+import multiprocessing
+import concurrent.futures
+from components import CommonUtils, Dependencies, PlatformFlavor, Package, SeedScheduler, Jobserver, SeedState, GitClone, SeedCoordinator, BuildHistory, SeedTimeline, PhaseTimer
 from components.CiConfigurationUtils import *
 
 
@@ -17,12 +21,45 @@ parser.add_argument('--extra-cmake-args', type=str, nargs='+', action='append',
 parser.add_argument('--skip-dependencies-fetch', default=False, action='store_true')
 parser.add_argument('--publish-to-cache', default=False, action='store_true')
 parser.add_argument('--missing-only', default=False, action='store_true')
+parser.add_argument('--changed-only', default=False, action='store_true', help='Only build projects which changed since their newest package was built, along with everything depending on them')
+parser.add_argument('--parallel-builds', type=int, default=int(os.environ.get('KDECI_SEED_PARALLEL_BUILDS', '1')), help='Number of projects to build at the same time')
+parser.add_argument('--memory-budget', type=float, default=None, help='Memory (in GB) all builds running at the same time may use together')
+parser.add_argument('--memory-per-build', type=float, default=4, help='Memory (in GB) a single build is assumed to need')
+parser.add_argument('--jobserver', default=False, action='store_true', help='Share the cores between the builds running at the same time through a make jobserver')
+parser.add_argument('--resume', default=False, action='store_true', help='Skip projects which were built by a previous run from the same revision, as long as none of their dependencies need to be rebuilt')
+parser.add_argument('--state-file', type=str, default=None, help='Where to keep track of the progress of the run (defaults to seed-state.json in the working directory)')
+parser.add_argument('--coordination-id', type=str, default=os.environ.get('KDECI_SEED_COORDINATION_ID', None), help='Share the run with all other machines running this seed with the same identifier (like the pipeline id), coordinating through KDECI_CACHE_PATH')
+parser.add_argument('--clone-jobs', type=int, default=int(os.environ.get('KDECI_SEED_CLONE_JOBS', '4')), help='Number of projects to clone at the same time')
+parser.add_argument('--clone-mode', type=str, choices=['full', 'blobless', 'shallow'], default=GitClone.cloneMode(), help='How to clone projects when no mirror is used (shallow clones lack the history needed to resolve @same)')
+parser.add_argument('--mirror-path', type=str, default=os.environ.get('KDECI_GIT_MIRROR_PATH', None), help='Folder holding local mirrors of the repositories, which clones take their objects from')
+parser.add_argument('--history-file', type=str, default=os.environ.get('KDECI_SEED_HISTORY_PATH', None), help='Where to keep track of how long building each project takes (defaults to seed-build-history.json in KDECI_CACHE_PATH, or the working directory)')
+parser.add_argument('--timeline-directory', type=str, default=None, help='Where to write the timeline of the run, as seed-timeline.json (Chrome trace) and seed-timeline.html (defaults to the working directory)')
+parser.add_argument('--log-directory', type=str, default=None, help='Where to store the build logs when running several builds at once')
 arguments = parser.parse_args()
 platform = PlatformFlavor.PlatformFlavor(arguments.platform)
 
 if arguments.missing_only and not arguments.publish_to_cache:
     print ("WARNING: argument --missing-only has no effect without --publish-to-cache")
 
+if arguments.changed_only and not 'KDECI_CACHE_PATH' in os.environ:
+    print ("ERROR: argument --changed-only requires KDECI_CACHE_PATH to be set, to find the packages built previously")
+    sys.exit(1)
+
+# When several machines share a run, each of them needs to be able to get at the packages the others built
+if arguments.coordination_id:
+    if not 'KDECI_CACHE_PATH' in os.environ:
+        print ("ERROR: argument --coordination-id requires KDECI_CACHE_PATH to be set to a folder shared by all machines taking part")
+        sys.exit(1)
+    if 'KDECI_SHARED_INSTALL_PATH' in os.environ:
+        print ("ERROR: argument --coordination-id can't be used with KDECI_SHARED_INSTALL_PATH, as the projects built by other machines won't be installed there")
+        sys.exit(1)
+    if arguments.skip_dependencies_fetch:
+        print ("ERROR: argument --coordination-id can't be used with --skip-dependencies-fetch, as the projects built by other machines have to be fetched")
+        sys.exit(1)
+    if not arguments.publish_to_cache and not 'KDECI_GITLAB_TOKEN' in os.environ:
+        print ("ERROR: argument --coordination-id requires --publish-to-cache (or KDECI_GITLAB_TOKEN to publish to the registry), so other machines can use the packages built")
+        sys.exit(1)
+
 ####
 # Prepare to work
 ####
@@ -54,124 +91,329 @@ projectsToBuild = dependencyResolver.resolve( seedConfiguration, None )
 ####
 
 # Setup a place to store the information
+# The dependency graph is shared with the --skip-deps calculation below, so every project is only ever resolved once
 projectBuildDependencies = {}
+dependencyGraph = dependencyGraphFor(workingDirectory, dependencyResolver)
 
-# Go over all the projects we will be building
-for identifier, branch in projectsToBuild.items():
-    # Retrieve the full details from the Dependencies project database
-    project = dependencyResolver.projectsByIdentifier[ identifier ]
-
-    if project['hasrepo']:
-        # Construct the URL to clone
-        gitUrl = "https://invent.kde.org/{0}.git".format( project['repopath'] )
+# Determine the Git revision of a checkout
+def gitRevisionOf(path):
+    if not os.path.exists(path):
+        return None
+    process = subprocess.Popen("git log --format=%H -1", stdin=subprocess.PIPE, stdout=subprocess.PIPE, shell=True, cwd=path)
+    revision = process.stdout.readline().strip().decode('utf-8')
+    process.wait()
+    return revision
 
-        # Clone it!
-        commandToRun = "git clone {0} --branch={1} {2}/".format( gitUrl, branch, identifier )
-        subprocess.check_call( commandToRun, stdout=sys.stdout, stderr=sys.stderr, shell=True, cwd=workingDirectory )
+projectRevisions = {}
 
-    configuration = loadProjectConfiguration(os.path.join(workingDirectory, identifier), identifier)
+# Clone a single project, if it has a repository and we don't have a checkout of it yet
+def cloneProject(identifier, branch):
+    # Retrieve the full details from the Dependencies project database
+    project = dependencyResolver.projectsByIdentifier[ identifier ]
+    projectPath = os.path.join( workingDirectory, identifier )
+
+    # When resuming, the checkouts of the previous run are still around and are used as they are
+    if arguments.resume and os.path.exists(projectPath):
+        print('## Reusing existing checkout of {}'.format(identifier))
+        return
+
+    if not project['hasrepo']:
+        return
+
+    # Construct the URL to clone, and clone it!
+    gitUrl = "https://invent.kde.org/{0}.git".format( project['repopath'] )
+    GitClone.cloneProject( gitUrl, project['repopath'], branch, projectPath, arguments.mirror_path, arguments.clone_mode )
+
+# Clone all the projects first, as most of the time goes to waiting on the network several clones are run at the same time
+# Resolving dependencies is done afterwards, as it changes the working directory of the process and thus can't be done from several threads at once
+cloneStart = time.time()
+with concurrent.futures.ThreadPoolExecutor( max_workers=max(1, arguments.clone_jobs) ) as executor:
+    clones = { executor.submit(cloneProject, identifier, branch): identifier for identifier, branch in projectsToBuild.items() }
+    for future in concurrent.futures.as_completed( clones ):
+        # Any failure to clone is fatal, as we can't build what we don't have
+        future.result()
+cloneEnd = time.time()
+print('## Cloned {} projects in {:.0f}s'.format(len(projectsToBuild), cloneEnd - cloneStart))
 
-    # The Dependency Resolver requires the current working directory to be in the project it is resolving (due to @same)
-    # Therefore we need to switch there first
-    os.chdir( os.path.join( workingDirectory, identifier ) )
-    # Resolve the dependencies for this project now
-    dependencies = dependencyResolver.resolve( configuration['Dependencies'], branch )
-    # And save them to our list...
-    projectBuildDependencies[ identifier ] = dependencies
-    # Now that we are done we can change back
-    os.chdir( workingDirectory )
+# Go over all the projects we will be building
+for identifier, branch in projectsToBuild.items():
+    # Resolve the dependencies for this project now, and save them to our list...
+    projectBuildDependencies[ identifier ] = dependencyGraph.buildDependencies( identifier, branch )
+    projectRevisions[ identifier ] = gitRevisionOf( os.path.join(workingDirectory, identifier) )
+
+# Make sure we won't be waiting forever for projects which depend on each other
+dependencyGraph.checkCycles( projectsToBuild )
+
+# If we only have to build what changed, find the projects whose newest package (in the cache or the registry) was built from another revision
+# Everything depending on those, directly or through projects outside of the seed, has to be built again as well
+if arguments.changed_only:
+    changedProjects = set()
+    for identifier, branch in projectsToBuild.items():
+        packagedRevision = dependencyGraph.registry().gitRevisionOf( identifier, branch )
+        if projectRevisions[ identifier ] is None or packagedRevision != projectRevisions[ identifier ]:
+            print('## Project {} changed: {} -> {}'.format(identifier, packagedRevision, projectRevisions[ identifier ]))
+            changedProjects.add( identifier )
+
+    affectedProjects = set( changedProjects )
+    for identifier, branch in projectsToBuild.items():
+        if changedProjects.intersection( dependencyGraph.closure(identifier, branch).keys() ):
+            affectedProjects.add( identifier )
+
+    # The scheduler takes care of building them in the right order
+    print('## Projects changed: \"{}\"'.format(' '.join(sorted(changedProjects))))
+    print('## Projects to be rebuilt because of changed dependencies: \"{}\"'.format(' '.join(sorted(affectedProjects - changedProjects))))
+    projectsToBuild = { identifier: branch for identifier, branch in projectsToBuild.items() if identifier in affectedProjects }
+
+resolveEnd = time.time()
 
 ####
 # Now we can start to build these projects
 ####
 
 builtProjects = {}
-
-while len(projectsToBuild) != 0:
-    # Make a copy to work on...
-    workingProjectsList = copy.deepcopy(projectsToBuild)
-    # Go over all the products in our list
-    for identifier, branch in workingProjectsList.items():
-        # Grab the products dependencies
-        projectDeps = projectBuildDependencies[ identifier ]
-        # Eliminate from this any dependencies this seed file is not building
-        # For those dependencies we simply assume another seed job has built them
-        # This also has the nice side effect of telling us if there is anything left we are still waiting to build
-        remainingDependencies = list( set(projectDeps).intersection(projectsToBuild) )
-
-        # Do we have anything left?
-        if len(remainingDependencies) > 0:
-            # Not it's turn unfortunately
-            continue
-
-        # We have a winner!
-        # Remove it from the list of projects to build....
-        del projectsToBuild[ identifier ]
-
-        localCachePath = os.environ.get('KDECI_CACHE_PATH', None)
-        if not localCachePath is None and arguments.publish_to_cache and arguments.missing_only:
-            if os.path.exists(os.path.join(localCachePath, '{}-{}.json'.format(identifier, branch))):
-                print('## Skipping build of {} since a package exists in the cache'.format(identifier))
-                continue
-
-        # Then start the build process - find where the sources are...
-        projectSources = os.path.join( workingDirectory, identifier )
-
-        # We need to set CI_COMMIT_SHA in the environment to match the hash of the project we are building
-        process = subprocess.Popen("git log --format=%H -1", stdin=subprocess.PIPE, stdout=subprocess.PIPE, shell=True, cwd=projectSources)
-        os.environ['CI_COMMIT_SHA'] = process.stdout.readline().strip().decode('utf-8')
-
-        # Prepare the command needed to build the project...
-        commandToRun = "{0} -u {1}/run-ci-build.py --project {2} --branch {3} --platform {4} --only-build --fail-on-leaked-stage-files".format(
-            sys.executable,
-            CommonUtils.scriptsBaseDirectory(),
-            identifier,
-            branch,
-            platform
-        )
-
-        if arguments.skip_dependencies_fetch:
-            # just forward skip-dependencies-fetch argument to the lower-level tool
-            commandToRun += ' --skip-dependencies-fetch'
-
-        if arguments.publish_to_cache:
-            # just forward publish-to-cache argument to the lower-level tool
-            commandToRun += ' --publish-to-cache'
-
-        if arguments.extra_cmake_args:
-            # necessary since we cannot use the 'extend' action for the arguments due to requiring Python < 3.8
-            flat_args = [item for sublist in arguments.extra_cmake_args for item in sublist]
-            commandToRun += ' ' + ' '.join(['--extra-cmake-args=' + arg for arg in flat_args])
-
-        if 'KDECI_SHARED_INSTALL_PATH' in os.environ:
-            existingProjects = {}
-            for id, branch in projectBuildDependencies[identifier].items():
-                if id in builtProjects:
-                    existingProjects[id] = branch
-
-            if existingProjects:
-                exisitingDeps = set()
-
+rebuiltProjects = set()
+skippedProjects = set()
+buildPhases = {}
+
+# Keep track of our progress, so a later run can resume where we stopped
+# What we record is only valid for runs building with the same options
+seedState = SeedState.State( os.path.abspath(arguments.state_file) if arguments.state_file else os.path.join(workingDirectory, 'seed-state.json'), {
+    'platform': str(platform),
+    'extra-cmake-args': arguments.extra_cmake_args,
+    'publish-to-cache': arguments.publish_to_cache,
+})
+
+# Determine how many builds we can run at once
+# The cores of the machine are shared between the builds running at the same time
+buildParallelism = max(1, multiprocessing.cpu_count() // arguments.parallel_builds)
+memoryBudget = int(arguments.memory_budget * 1024 * 1024 * 1024) if arguments.memory_budget else None
+memoryPerBuild = int(arguments.memory_per_build * 1024 * 1024 * 1024)
+
+# Rather than giving each build a fixed share of the cores, builds can take their jobs from a shared jobserver instead
+# Each build always runs one job of its own, so the jobserver holds the remaining cores
+# If we have been given a jobserver already (like one shared by all runners on this machine) we simply pass that one on
+jobserver = None
+if arguments.jobserver and not 'KDECI_JOBSERVER_FIFO' in os.environ:
+    jobserver = Jobserver.Jobserver(max(0, multiprocessing.cpu_count() - arguments.parallel_builds))
+    os.environ['KDECI_JOBSERVER_FIFO'] = jobserver.fifoPath
+    print('## Started jobserver with {} tokens: {}'.format(jobserver.tokens, jobserver.fifoPath))
+
+# When running several builds at once their output goes to a log file per project, as interleaving it would make it unreadable
+logDirectory = os.path.abspath(arguments.log_directory) if arguments.log_directory else os.path.join(workingDirectory, 'seed-logs')
+if arguments.parallel_builds > 1:
+    os.makedirs(logDirectory, exist_ok=True)
+
+dependencyGraphLock = threading.Lock()
+
+# Keep track of how long builds take, so we know which projects to build first next time
+historyPath = arguments.history_file
+if historyPath is None:
+    historyPath = os.path.join(os.environ.get('KDECI_CACHE_PATH', workingDirectory), 'seed-build-history.json')
+buildHistory = BuildHistory.History(os.path.abspath(historyPath), platform)
+
+def buildProject(identifier, branch):
+    localCachePath = os.environ.get('KDECI_CACHE_PATH', None)
+    if not localCachePath is None and arguments.publish_to_cache and arguments.missing_only:
+        if os.path.exists(os.path.join(localCachePath, '{}-{}.json'.format(identifier, branch))):
+            print('## Skipping build of {} since a package exists in the cache'.format(identifier))
+            skippedProjects.add( identifier )
+            return
+
+    # Then start the build process - find where the sources are...
+    projectSources = os.path.join( workingDirectory, identifier )
+    gitRevision = projectRevisions[ identifier ]
+
+    # Projects built by a previous run don't need to be built again, unless something they depend on was rebuilt since
+    if arguments.resume and seedState.isBuilt(identifier, branch, gitRevision):
+        rebuiltDependencies = rebuiltProjects.intersection( projectBuildDependencies[identifier].keys() )
+        if not rebuiltDependencies:
+            print('## Skipping build of {} since it was already built from revision {}'.format(identifier, gitRevision))
+            builtProjects[ identifier ] = branch
+            skippedProjects.add( identifier )
+            return
+        print('## Rebuilding {} as its dependencies were rebuilt: {}'.format(identifier, ' '.join(sorted(rebuiltDependencies))))
+
+    # We need to set CI_COMMIT_SHA in the environment to match the hash of the project we are building
+    # As other builds may be running at the same time, each build gets an environment of its own
+    buildEnvironment = dict(os.environ)
+    buildEnvironment['CI_COMMIT_SHA'] = gitRevision
+
+    # Each build writes the timings of its phases next to its sources, we make sure we don't pick up those of an earlier build
+    timingsSummaryPath = os.path.join(projectSources, 'ci-timings-summary.json')
+    buildEnvironment['KDECI_TIMINGS_PATH'] = projectSources
+    if os.path.exists(timingsSummaryPath):
+        os.remove(timingsSummaryPath)
+
+    # With a jobserver the build tool may run up to as many jobs as there are cores, the jobserver keeps the total in check
+    # Build tools which can't take part in the jobserver don't have it to keep them in check, so they have to stay within their share of the cores
+    if 'KDECI_JOBSERVER_FIFO' in os.environ:
+        buildEnvironment['KDECI_BUILD_PARALLELISM'] = str(multiprocessing.cpu_count())
+        buildEnvironment['KDECI_JOBSERVER_FALLBACK_PARALLELISM'] = str(buildParallelism)
+    elif arguments.parallel_builds > 1:
+        buildEnvironment['KDECI_BUILD_PARALLELISM'] = str(buildParallelism)
+
+    # Prepare the command needed to build the project...
+    commandToRun = "{0} -u {1}/run-ci-build.py --project {2} --branch {3} --platform {4} --only-build".format(
+        sys.executable,
+        CommonUtils.scriptsBaseDirectory(),
+        identifier,
+        branch,
+        platform
+    )
+
+    # Builds running at the same time in a shared install directory see each other's leaked files as well
+    # Those would fail whichever build happened to check first rather than the one at fault, so they are only reported then
+    if not (arguments.parallel_builds > 1 and 'KDECI_SHARED_INSTALL_PATH' in os.environ):
+        commandToRun += ' --fail-on-leaked-stage-files'
+
+    if arguments.skip_dependencies_fetch:
+        # just forward skip-dependencies-fetch argument to the lower-level tool
+        commandToRun += ' --skip-dependencies-fetch'
+
+    if arguments.publish_to_cache:
+        # just forward publish-to-cache argument to the lower-level tool
+        commandToRun += ' --publish-to-cache'
+
+    if arguments.extra_cmake_args:
+        # necessary since we cannot use the 'extend' action for the arguments due to requiring Python < 3.8
+        flat_args = [item for sublist in arguments.extra_cmake_args for item in sublist]
+        commandToRun += ' ' + ' '.join(['--extra-cmake-args=' + arg for arg in flat_args])
+
+    if 'KDECI_SHARED_INSTALL_PATH' in os.environ:
+        existingProjects = {}
+        for id, dependencyBranch in projectBuildDependencies[identifier].items():
+            if id in builtProjects:
+                existingProjects[id] = dependencyBranch
+
+        if existingProjects:
+            exisitingDeps = set()
+
+            # The dependency graph is shared with the other builds running at the same time
+            with dependencyGraphLock:
                 for projectId in existingProjects.keys():
                     exisitingDeps.update(lazyResolveProjectDeps(workingDirectory, projectId, existingProjects[projectId], dependencyResolver))
                     exisitingDeps.add(projectId)
 
-                commandToRun += ' --skip-deps ' + ' '.join(exisitingDeps)
-
-        print('## Run project build: {}'.format(commandToRun))
-
-        # Then run it!
-        try:
-            subprocess.check_call( commandToRun, stdout=sys.stdout, stderr=sys.stderr, shell=True, cwd=projectSources )
-        except:
-            print('## Failed building a project: {}'.format(identifier))
-            print('## Projects built: \"{}\"'.format((' '.join(builtProjects.keys()))))
-            print('## Projects **not** built: \"{}\"'.format(' '.join(projectsToBuild.keys())))
-            raise
-
-        # Add it to the list of projects we've built
-        builtProjects[ identifier ] = branch
-
+            commandToRun += ' --skip-deps ' + ' '.join(exisitingDeps)
+
+    print('## Run project build: {}'.format(commandToRun))
+
+    # Then run it!
+    buildStart = time.time()
+    try:
+        if arguments.parallel_builds > 1:
+            logPath = os.path.join(logDirectory, '{}.log'.format(identifier))
+            print('## Build log of {}: {}'.format(identifier, logPath))
+            with open(logPath, 'w') as logFile:
+                returnCode = subprocess.call( commandToRun, stdout=logFile, stderr=subprocess.STDOUT, shell=True, cwd=projectSources, env=buildEnvironment )
+
+            if returnCode != 0:
+                # Show the end of the log, which is where the reason for the failure will be
+                with open(logPath, 'r', errors='replace') as logFile:
+                    logTail = logFile.readlines()[-50:]
+                print('## Last lines of the build log of {}:\n{}'.format(identifier, ''.join(logTail)))
+                raise Exception('run-ci-build.py exited with code {}'.format(returnCode))
+        else:
+            subprocess.check_call( commandToRun, stdout=sys.stdout, stderr=sys.stderr, shell=True, cwd=projectSources, env=buildEnvironment )
+    except Exception:
+        seedState.record(identifier, branch, gitRevision, 'failed')
+        raise
+    finally:
+        timingsSummary = PhaseTimer.loadSummary(timingsSummaryPath)
+        if timingsSummary is not None:
+            buildPhases[ identifier ] = timingsSummary['phases']
+
+    print('## Finished building {} in {:.0f}s'.format(identifier, time.time() - buildStart))
+    buildHistory.record(identifier, time.time() - buildStart)
+
+    # Note down which package came out of it, if we can tell
+    packageVersion = None
+    localCachePath = os.environ.get('KDECI_CACHE_PATH', None)
+    if not localCachePath is None and arguments.publish_to_cache:
+        packageMetadataPath = os.path.join(localCachePath, '{}-{}.json'.format(identifier, branch))
+        if os.path.exists(packageMetadataPath):
+            with open(packageMetadataPath, 'r') as packageMetadataFile:
+                packageVersion = json.load(packageMetadataFile).get('version', None)
+
+    seedState.record(identifier, branch, gitRevision, 'built', packageVersion)
+
+    # Add it to the list of projects we've built
+    builtProjects[ identifier ] = branch
+    rebuiltProjects.add( identifier )
+
+# If we are sharing the run with other machines, we claim each project before building it so only one of them does
+coordinator = None
+if arguments.coordination_id:
+    coordinationPath = os.path.join(os.environ['KDECI_CACHE_PATH'], 'seed-coordination', arguments.coordination_id)
+    coordinator = SeedCoordinator.Coordinator(coordinationPath, int(os.environ.get('KDECI_SEED_CLAIM_TIMEOUT', '600')))
+    print('## Coordinating with other machines through: {}'.format(coordinationPath))
+
+# Format a duration in seconds for display
+def formatDuration(seconds):
+    return '{}h {:02d}m'.format(int(seconds // 3600), int(seconds % 3600 // 60))
+
+expectedDurations = { identifier: buildHistory.expectedDuration(identifier) for identifier in projectsToBuild }
+scheduler = SeedScheduler.Scheduler( projectsToBuild, projectBuildDependencies, arguments.parallel_builds, memoryBudget, memoryPerBuild, coordinator, int(os.environ.get('KDECI_SEED_POLL_INTERVAL', '30')), expectedDurations )
+
+# Let everyone know when to expect us to be done, the longest chain of builds being the least it will take whatever the number of builds we run at once
+# Builds we skip (like those already built when resuming) make it go quicker than this
+expectedDuration = scheduler.expectedDuration()
+longestChain = max( scheduler.criticalPath.values() or [0] )
+print('## Expected to finish in {} (around {}), the longest chain of builds takes {}'.format(
+    formatDuration(expectedDuration),
+    time.strftime('%H:%M', time.localtime(time.time() + expectedDuration)),
+    formatDuration(longestChain)
+))
+unknownProjects = [ identifier for identifier, duration in expectedDurations.items() if duration is None ]
+if unknownProjects:
+    print('## No build history yet for {} of {} projects, assuming they take as long as the typical project'.format(len(unknownProjects), len(expectedDurations)))
+
+# The jobserver has to go away even if something goes wrong, otherwise its FIFO is left behind
+try:
+    seedSucceeded = scheduler.run( buildProject )
+finally:
+    if jobserver is not None:
+        jobserver.close()
+buildEnd = time.time()
+
+# Write the timeline of the run, showing where the time went
+# Only the builds we ran ourselves are included, the waiting on dependencies being counted from the moment we were ready to start building
+timeline = SeedTimeline.Timeline( arguments.parallel_builds )
+timeline.addPhase( 'clone', cloneStart, cloneEnd )
+timeline.addPhase( 'resolve', cloneEnd, resolveEnd )
+timeline.addPhase( 'build', scheduler.runStart, buildEnd )
+for identifier, buildStart in scheduler.startTimes.items():
+    if identifier in scheduler.failed:
+        status = 'failed'
+    elif identifier in skippedProjects:
+        status = 'skipped'
+    else:
+        status = 'done'
+    timeline.addBuild( identifier, buildStart, scheduler.endTimes.get(identifier, buildEnd), status, scheduler.dependencies[identifier], scheduler.runStart, scheduler.readyTimes.get(identifier, None), buildPhases.get(identifier, None) )
+
+timelineDirectory = os.path.abspath(arguments.timeline_directory) if arguments.timeline_directory else workingDirectory
+os.makedirs(timelineDirectory, exist_ok=True)
+timeline.writeChromeTrace( os.path.join(timelineDirectory, 'seed-timeline.json') )
+timeline.writeHtmlReport( os.path.join(timelineDirectory, 'seed-timeline.html') )
+print('## Timeline of the run: {}'.format(os.path.join(timelineDirectory, 'seed-timeline.html')))
+print('## Critical path: {}'.format(' -> '.join(timeline.criticalPath())))
+
+# Show where the time of the builds went, summed over all of them
+phaseTotals = {}
+for phases in buildPhases.values():
+    for phase in phases:
+        wall, cpu = phaseTotals.get(phase['name'], (0, 0))
+        phaseTotals[ phase['name'] ] = ( wall + phase['wall'], cpu + phase['cpu'] )
+for name, (wall, cpu) in sorted(phaseTotals.items(), key=lambda item: -item[1][0]):
+    print('## Time spent in {}: {} (CPU time: {})'.format(name, formatDuration(wall), formatDuration(cpu)))
+
+if not seedSucceeded:
+    print('## Failed building projects: \"{}\"'.format(' '.join(scheduler.failed)))
+    print('## Projects built: \"{}\"'.format((' '.join(builtProjects.keys()))))
+    if scheduler.builtElsewhere:
+        print('## Projects built (or failed) by other machines: \"{}\"'.format(' '.join(scheduler.builtElsewhere)))
+    print('## Projects **not** built: \"{}\"'.format(' '.join(scheduler.failed + scheduler.pending)))
+    sys.exit(1)
 
 ####
 # We're done!
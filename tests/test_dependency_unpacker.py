@@ -0,0 +1,95 @@
+import io
+import os
+import stat
+import shutil
+import tarfile
+import tempfile
+import unittest
+
+from components import DependencyUnpacker, InstallDatabase, Package
+
+# Unpacking a level of packages which don't depend on each other, but may ship the same files
+class UnpackLevelTest(unittest.TestCase):
+
+    def setUp(self):
+        self.workDirectory = tempfile.mkdtemp()
+        self.installPath = os.path.join(self.workDirectory, 'install')
+
+    def tearDown(self):
+        # Unpacked folders may be read-only
+        for root, dirs, files in os.walk(self.workDirectory):
+            for directory in dirs:
+                os.chmod(os.path.join(root, directory), 0o755)
+        shutil.rmtree(self.workDirectory)
+
+    # Create a package holding the given files (given as {name: contents}) below a read-only share/data folder
+    def createPackage(self, identifier, files):
+        archivePath = os.path.join(self.workDirectory, identifier + '.tar')
+        with tarfile.open(archivePath, 'w') as archive:
+            for name in ['share', 'share/data']:
+                member = tarfile.TarInfo(name)
+                member.type = tarfile.DIRTYPE
+                member.mode = 0o555
+                member.mtime = 1000
+                archive.addfile(member)
+
+            for name, contents in files.items():
+                member = tarfile.TarInfo('share/data/' + name)
+                member.size = len(contents)
+                member.mode = 0o644
+                archive.addfile(member, io.BytesIO(contents.encode('utf-8')))
+
+        packageMetadata = {'identifier': identifier, 'version': identifier + '-1'}
+        return (archivePath, packageMetadata, Package.CacheStatus.FromCache)
+
+    def readFile(self, relativePath):
+        with open(os.path.join(self.installPath, relativePath), 'r') as file:
+            return file.read()
+
+    # Regular files shipped by several packages are provided by the identifier sorting last, whatever order the packages come in
+    def test_plan_last_identifier_wins(self):
+        skipPaths, sequentialPackages = DependencyUnpacker.planLevel({
+            'kcoreaddons': [('share', 'dir'), ('share/common', 'file'), ('share/kcoreaddons', 'file')],
+            'ki18n': [('share', 'dir'), ('share/common', 'file')],
+            'attica': [('share', 'dir'), ('share/common', 'file')],
+        })
+        self.assertEqual(skipPaths, {'attica': {'share/common'}, 'kcoreaddons': {'share/common'}, 'ki18n': set()})
+        self.assertEqual(sequentialPackages, [])
+
+    # Packages disagreeing on the type of an entry are left to a sequential unpack, without skipping anything
+    def test_plan_type_conflicts_are_sequential(self):
+        skipPaths, sequentialPackages = DependencyUnpacker.planLevel({
+            'kcoreaddons': [('lib', 'symlink'), ('share/common', 'file')],
+            'ki18n': [('lib', 'dir'), ('lib/libki18n.so', 'file'), ('share/common', 'file')],
+            'attica': [('share/common', 'file')],
+        })
+        self.assertEqual(sequentialPackages, ['kcoreaddons', 'ki18n'])
+        self.assertEqual(skipPaths, {'attica': {'share/common'}, 'kcoreaddons': set(), 'ki18n': set()})
+
+    # Two packages sharing a read-only folder and a file, unpacked together
+    def test_overlapping_packages(self):
+        packages = [
+            self.createPackage('ki18n', {'common.txt': 'ki18n', 'ki18n.txt': 'ki18n'}),
+            self.createPackage('kcoreaddons', {'common.txt': 'kcoreaddons', 'kcoreaddons.txt': 'kcoreaddons'}),
+        ]
+        installDatabase = InstallDatabase.Database(self.installPath)
+        DependencyUnpacker.unpackLevel(packages, self.installPath, 1, None, installDatabase)
+
+        self.assertEqual(self.readFile('share/data/common.txt'), 'ki18n')
+        self.assertEqual(self.readFile('share/data/ki18n.txt'), 'ki18n')
+        self.assertEqual(self.readFile('share/data/kcoreaddons.txt'), 'kcoreaddons')
+
+        # The folders only got their attributes once both packages were done with them
+        for relativePath in ['share', 'share/data']:
+            directoryStat = os.stat(os.path.join(self.installPath, relativePath))
+            self.assertEqual(stat.S_IMODE(directoryStat.st_mode), 0o555)
+            self.assertEqual(directoryStat.st_mtime, 1000)
+
+        # Both packages own the file they ship, even though only one of them provided it
+        reloadedDatabase = InstallDatabase.Database(self.installPath)
+        self.assertIn(os.path.join('share', 'data', 'common.txt'), reloadedDatabase.filesOf('kcoreaddons'))
+        self.assertIn(os.path.join('share', 'data', 'common.txt'), reloadedDatabase.filesOf('ki18n'))
+        self.assertEqual(reloadedDatabase.installedVersion('kcoreaddons'), 'kcoreaddons-1')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,154 @@
+import io
+import os
+import shutil
+import tarfile
+import tempfile
+import unittest
+
+from components import MergeFolders
+from components.MergeFolders import MergeConflictError
+
+# The conflict rules shared by merge_folders() (merging an extracted tree) and extract_archive() (extracting a package directly)
+class MergeConflictTest(unittest.TestCase):
+
+    def setUp(self):
+        self.workDirectory = tempfile.mkdtemp()
+        self.srcDir = os.path.join(self.workDirectory, 'src')
+        self.dstDir = os.path.join(self.workDirectory, 'dst')
+        os.makedirs(self.srcDir)
+        os.makedirs(self.dstDir)
+
+    def tearDown(self):
+        shutil.rmtree(self.workDirectory)
+
+    def writeFile(self, path, contents):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as file:
+            file.write(contents)
+
+    def readFile(self, path):
+        with open(path, 'r') as file:
+            return file.read()
+
+    # Create an archive holding the given members, given as (name, type, contents or link target)
+    def createArchive(self, members):
+        archivePath = os.path.join(self.workDirectory, 'package.tar')
+        with tarfile.open(archivePath, 'w') as archive:
+            for name, memberType, payload in members:
+                member = tarfile.TarInfo(name)
+                member.type = memberType
+                member.mode = 0o755 if memberType == tarfile.DIRTYPE else 0o644
+                if memberType == tarfile.SYMTYPE:
+                    member.linkname = payload
+                    archive.addfile(member)
+                elif memberType == tarfile.REGTYPE:
+                    member.size = len(payload)
+                    archive.addfile(member, io.BytesIO(payload.encode('utf-8')))
+                else:
+                    archive.addfile(member)
+        return archivePath
+
+    def test_merge_file_with_folder(self):
+        os.makedirs(os.path.join(self.srcDir, 'share'))
+        self.writeFile(os.path.join(self.dstDir, 'share'), 'file')
+        with self.assertRaisesRegex(MergeConflictError, "Couldn't override a file with a folder"):
+            MergeFolders.merge_folders(self.srcDir, self.dstDir)
+
+    def test_merge_folder_with_file(self):
+        self.writeFile(os.path.join(self.srcDir, 'share'), 'file')
+        os.makedirs(os.path.join(self.dstDir, 'share'))
+        with self.assertRaisesRegex(MergeConflictError, "Couldn't override not-a-file with a file"):
+            MergeFolders.merge_folders(self.srcDir, self.dstDir)
+
+    def test_merge_physical_folder_with_symlink(self):
+        os.makedirs(os.path.join(self.srcDir, 'lib64'))
+        os.symlink('lib64', os.path.join(self.srcDir, 'lib'))
+        os.makedirs(os.path.join(self.dstDir, 'lib'))
+        with self.assertRaisesRegex(MergeConflictError, "Couldn't override a physical folder with a symlink"):
+            MergeFolders.merge_folders(self.srcDir, self.dstDir)
+
+    def test_merge_folder_symlinks(self):
+        for directory in [self.srcDir, self.dstDir]:
+            os.makedirs(os.path.join(directory, 'lib64'))
+            os.makedirs(os.path.join(directory, 'lib32'))
+        os.symlink('lib64', os.path.join(self.srcDir, 'lib'))
+        os.symlink('lib64', os.path.join(self.dstDir, 'lib'))
+        # Identical symlinks are fine
+        MergeFolders.merge_folders(self.srcDir, self.dstDir)
+        self.assertEqual(os.readlink(os.path.join(self.dstDir, 'lib')), 'lib64')
+
+        os.unlink(os.path.join(self.dstDir, 'lib'))
+        os.symlink('lib32', os.path.join(self.dstDir, 'lib'))
+        with self.assertRaisesRegex(MergeConflictError, "Couldn't override a symlink with a different path"):
+            MergeFolders.merge_folders(self.srcDir, self.dstDir)
+
+    def test_merge_into_symlinked_folder(self):
+        # A physical folder is merged into a symlink to a folder at the destination
+        self.writeFile(os.path.join(self.srcDir, 'lib', 'libfoo.so'), 'library')
+        os.makedirs(os.path.join(self.dstDir, 'lib64'))
+        os.symlink('lib64', os.path.join(self.dstDir, 'lib'))
+        MergeFolders.merge_folders(self.srcDir, self.dstDir)
+        self.assertTrue(os.path.islink(os.path.join(self.dstDir, 'lib')))
+        self.assertEqual(self.readFile(os.path.join(self.dstDir, 'lib64', 'libfoo.so')), 'library')
+
+    def test_merge_overwrites_files(self):
+        self.writeFile(os.path.join(self.srcDir, 'bin', 'tool'), 'new')
+        self.writeFile(os.path.join(self.srcDir, 'bin', 'skipped'), 'new')
+        self.writeFile(os.path.join(self.dstDir, 'bin', 'tool'), 'old')
+        self.writeFile(os.path.join(self.dstDir, 'bin', 'skipped'), 'old')
+        # The destination might be hardlinked from elsewhere, which must be left alone
+        os.link(os.path.join(self.dstDir, 'bin', 'tool'), os.path.join(self.workDirectory, 'linked'))
+
+        MergeFolders.merge_folders(self.srcDir, self.dstDir, skip_paths={os.path.join('bin', 'skipped')})
+        self.assertEqual(self.readFile(os.path.join(self.dstDir, 'bin', 'tool')), 'new')
+        self.assertEqual(self.readFile(os.path.join(self.dstDir, 'bin', 'skipped')), 'old')
+        self.assertEqual(self.readFile(os.path.join(self.workDirectory, 'linked')), 'old')
+
+    def test_extract_file_with_folder(self):
+        self.writeFile(os.path.join(self.dstDir, 'share'), 'file')
+        archivePath = self.createArchive([('share', tarfile.DIRTYPE, None)])
+        with self.assertRaisesRegex(MergeConflictError, "Couldn't override a file with a folder"):
+            MergeFolders.extract_archive(archivePath, self.dstDir)
+
+    def test_extract_folder_with_file(self):
+        os.makedirs(os.path.join(self.dstDir, 'share'))
+        archivePath = self.createArchive([('share', tarfile.REGTYPE, 'file')])
+        with self.assertRaisesRegex(MergeConflictError, "Couldn't override not-a-file with a file"):
+            MergeFolders.extract_archive(archivePath, self.dstDir)
+
+    def test_extract_physical_folder_with_symlink(self):
+        os.makedirs(os.path.join(self.dstDir, 'lib'))
+        archivePath = self.createArchive([('lib', tarfile.SYMTYPE, 'lib64')])
+        with self.assertRaisesRegex(MergeConflictError, "Couldn't override a physical folder with a symlink"):
+            MergeFolders.extract_archive(archivePath, self.dstDir)
+
+    def test_extract_symlinks(self):
+        os.makedirs(os.path.join(self.dstDir, 'lib64'))
+        os.symlink('lib64', os.path.join(self.dstDir, 'lib'))
+        # Identical symlinks are fine, and folders are extracted into symlinked folders
+        MergeFolders.extract_archive(self.createArchive([
+            ('lib', tarfile.SYMTYPE, 'lib64'),
+            ('lib/libfoo.so', tarfile.REGTYPE, 'library'),
+        ]), self.dstDir)
+        self.assertEqual(os.readlink(os.path.join(self.dstDir, 'lib')), 'lib64')
+        self.assertEqual(self.readFile(os.path.join(self.dstDir, 'lib64', 'libfoo.so')), 'library')
+
+        with self.assertRaisesRegex(MergeConflictError, "Couldn't override a symlink with a different path"):
+            MergeFolders.extract_archive(self.createArchive([('lib', tarfile.SYMTYPE, 'lib32')]), self.dstDir)
+
+    def test_extract_overwrites_files(self):
+        self.writeFile(os.path.join(self.dstDir, 'bin', 'tool'), 'old')
+        self.writeFile(os.path.join(self.dstDir, 'bin', 'skipped'), 'old')
+        os.link(os.path.join(self.dstDir, 'bin', 'tool'), os.path.join(self.workDirectory, 'linked'))
+
+        archivePath = self.createArchive([
+            ('bin/tool', tarfile.REGTYPE, 'new'),
+            ('bin/skipped', tarfile.REGTYPE, 'new'),
+        ])
+        MergeFolders.extract_archive(archivePath, self.dstDir, skip_paths={os.path.join('bin', 'skipped')})
+        self.assertEqual(self.readFile(os.path.join(self.dstDir, 'bin', 'tool')), 'new')
+        self.assertEqual(self.readFile(os.path.join(self.dstDir, 'bin', 'skipped')), 'old')
+        self.assertEqual(self.readFile(os.path.join(self.workDirectory, 'linked')), 'old')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,128 @@
+import os
+import json
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+import gitlab
+from components import Package
+
+# Stand-in for the generic package registry of a Gitlab project, holding packages as {(name, version): {filename: contents}}
+class FakeRemoteRegistry(object):
+
+    def __init__(self):
+        self.files = {}
+        self.failure = None
+        self.packages = mock.Mock()
+        self.packages.list.side_effect = self.listPackages
+        self.generic_packages = mock.Mock()
+        self.generic_packages.download.side_effect = self.download
+        self.generic_packages.upload.side_effect = self.upload
+
+    def addPackage(self, identifier, version, metadata):
+        self.files[ (identifier, version) ] = {'metadata.json': json.dumps(metadata).encode('utf-8')}
+
+    def listPackages(self, **kwargs):
+        packages = []
+        for identifier, version in self.files:
+            # The name keyword of mock.Mock names the mock itself, so the attribute has to be set afterwards
+            package = mock.Mock(version=version)
+            package.name = identifier
+            packages.append(package)
+        return packages
+
+    def download(self, package_name, package_version, file_name, **kwargs):
+        if self.failure is not None:
+            raise gitlab.exceptions.GitlabGetError(response_code=self.failure)
+        try:
+            return self.files[ (package_name, package_version) ][ file_name ]
+        except KeyError:
+            raise gitlab.exceptions.GitlabGetError(response_code=404)
+
+    def upload(self, package_name, package_version, file_name, path):
+        with open(path, 'rb') as uploadedFile:
+            self.files.setdefault( (package_name, package_version), {} )[ file_name ] = uploadedFile.read()
+
+class RegistryRevisionTest(unittest.TestCase):
+
+    def setUp(self):
+        self.workDirectory = tempfile.mkdtemp()
+        self.cachePath = os.path.join(self.workDirectory, 'cache')
+        self.remoteRegistry = FakeRemoteRegistry()
+
+        gitlabPatcher = mock.patch.object(Package.gitlab, 'Gitlab')
+        gitlabServer = gitlabPatcher.start()
+        gitlabServer.return_value.projects.get.return_value = self.remoteRegistry
+        self.addCleanup(gitlabPatcher.stop)
+
+    def tearDown(self):
+        shutil.rmtree(self.workDirectory)
+
+    def openRegistry(self):
+        return Package.Registry(self.cachePath, 'https://invent.kde.org/', None, 'teams/ci-artifacts/test')
+
+    def createArchive(self, contents):
+        archivePath = os.path.join(self.workDirectory, 'archive.tar')
+        with open(archivePath, 'w') as archiveFile:
+            archiveFile.write(contents)
+        return archivePath
+
+    # A package whose copy to the cache was skipped because the build produced the same contents should still represent the new revision
+    def test_skipped_cache_copy_records_revision(self):
+        archivePath = self.createArchive('contents')
+        registry = self.openRegistry()
+        self.assertIsNotNone(registry.storeInCache(archivePath, 'kcoreaddons', 'master', 'revision-1', {'contentHash': 'hash'}))
+        self.assertIsNone(registry.storeInCache(archivePath, 'kcoreaddons', 'master', 'revision-2', {'contentHash': 'hash'}))
+
+        # A later run (like a seed run with --changed-only) sees the project as unchanged at revision-2
+        self.assertEqual(self.openRegistry().gitRevisionOf('kcoreaddons', 'master'), 'revision-2')
+
+    # Different contents are stored as a new package
+    def test_changed_contents_are_stored(self):
+        registry = self.openRegistry()
+        registry.storeInCache(self.createArchive('contents'), 'kcoreaddons', 'master', 'revision-1', {'contentHash': 'hash-1'})
+        self.assertIsNotNone(registry.storeInCache(self.createArchive('other contents'), 'kcoreaddons', 'master', 'revision-2', {'contentHash': 'hash-2'}))
+
+        reopenedRegistry = self.openRegistry()
+        self.assertEqual(reopenedRegistry.gitRevisionOf('kcoreaddons', 'master'), 'revision-2')
+        self.assertTrue(reopenedRegistry.hasContentHash('kcoreaddons', 'master', 'hash-2'))
+
+    # A package whose publishing to the registry was skipped should still represent the new revision, even for runners which have it cached
+    def test_skipped_publish_records_revision(self):
+        metadata = {'identifier': 'kcoreaddons', 'branch': 'master', 'version': 'master-1000', 'timestamp': 1000, 'gitRevision': 'revision-1', 'contentHash': 'hash', 'dependencies': {}}
+        self.remoteRegistry.addPackage('kcoreaddons', 'master-1000', metadata)
+
+        # This runner has the package in its cache already
+        os.makedirs(self.cachePath)
+        with open(os.path.join(self.cachePath, 'kcoreaddons-master.json'), 'w') as cachedMetadataFile:
+            json.dump(metadata, cachedMetadataFile)
+
+        registry = self.openRegistry()
+        self.assertTrue(registry.hasContentHash('kcoreaddons', 'master', 'hash'))
+        self.assertTrue(registry.recordGitRevision('kcoreaddons', 'master', 'revision-2'))
+        # Recording the same revision again changes nothing
+        self.assertFalse(registry.recordGitRevision('kcoreaddons', 'master', 'revision-2'))
+
+        self.assertEqual(self.openRegistry().gitRevisionOf('kcoreaddons', 'master'), 'revision-2')
+        with open(os.path.join(self.cachePath, 'kcoreaddons-master.json'), 'r') as cachedMetadataFile:
+            self.assertEqual(json.load(cachedMetadataFile)['gitRevision'], 'revision-2')
+
+        # Other runners with an older copy in their cache get the revision from the registry
+        with open(os.path.join(self.cachePath, 'kcoreaddons-master.json'), 'w') as cachedMetadataFile:
+            json.dump(metadata, cachedMetadataFile)
+        self.assertEqual(self.openRegistry().gitRevisionOf('kcoreaddons', 'master'), 'revision-2')
+
+    # Packages the registry can't find count as missing, other failures are not hidden
+    def test_registry_failures(self):
+        self.remoteRegistry.files[ ('kcoreaddons', 'master-1000') ] = {}
+        registry = self.openRegistry()
+        self.assertIsNone(registry.gitRevisionOf('kcoreaddons', 'master'))
+        self.assertFalse(registry.hasContentHash('kcoreaddons', 'master', 'hash'))
+
+        self.remoteRegistry.failure = 500
+        with self.assertRaises(gitlab.exceptions.GitlabGetError):
+            registry.gitRevisionOf('kcoreaddons', 'master')
+
+if __name__ == '__main__':
+    unittest.main()